@@ -22,6 +22,10 @@ state_manager = get_state_manager()
 
 print("[SimpleAdmin] Initialized with realtime state manager")
 
+# Сколько пользователей отдает /api/realtime/users без параметра limit и не больше скольких с ним
+USERS_DEFAULT_LIMIT = 200
+USERS_MAX_LIMIT = 5000
+
 # Простой HTML шаблон
 SIMPLE_TEMPLATE = """
 <!DOCTYPE html>
@@ -554,21 +558,27 @@ def get_realtime_stats():
 
 @app.route('/api/realtime/users', methods=['GET'])
 def get_realtime_users():
-    """Получить всех пользователей с актуальными данными."""
-    users = state_manager.get_all_users()
+    """Получить пользователей с актуальными данными, начиная с недавно обновленных.
 
-    # Импортируем актуальную конфигурацию
+    Параметр limit ограничивает число пользователей в ответе
+    (по умолчанию USERS_DEFAULT_LIMIT, не больше USERS_MAX_LIMIT).
+    """
+    # Берем актуальную конфигурацию из каталога в памяти
     try:
-        from config import load_stands
-        stands = load_stands()
-        total_stands = len(stands)
+        from config import get_stand_catalog
+        catalog = get_stand_catalog()
+        stand_mask, total_stands = catalog.mask, len(catalog)
     except:
-        total_stands = 5
+        stand_mask, total_stands = 0, 0
 
+    # Индекс по updated_at уже упорядочен - сортировать и обходить всех не нужно
+    limit = request.args.get('limit', USERS_DEFAULT_LIMIT, type=int)
+    limit = max(1, min(limit, USERS_MAX_LIMIT))
     result = []
-    for user_id, user_data in users.items():
-        completed = sum(1 for status in user_data.get('stand_status', {}).values() if status.get('done', False))
-        total_user_stands = len(user_data.get('stand_status', {}))
+    for user_id, user_data in state_manager.query_users('recent', limit):
+        # Маска текущего каталога отсекает стенды, которые еще не синхронизированы лениво
+        completed = user_data.completed_count(stand_mask)
+        total_user_stands = total_stands
 
         result.append({
             'user_id': user_id,
@@ -587,17 +597,14 @@ def get_realtime_users():
             'updated_at': user_data.get('updated_at', datetime.now().isoformat())
         })
 
-    # Сортируем по времени последнего обновления
-    result.sort(key=lambda x: x['updated_at'], reverse=True)
     return jsonify(result)
 
 @app.route('/api/realtime/stands', methods=['GET'])
 def get_realtime_stands():
     """Получить актуальную конфигурацию стендов."""
     try:
-        from config import load_stands
-        stands = load_stands()
-        return jsonify(stands)
+        from config import get_stand_catalog
+        return jsonify(list(get_stand_catalog().stands))
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -614,7 +621,7 @@ def clear_realtime_state():
 def force_refresh_state():
     """Принудительно обновить состояние из файла."""
     try:
-        state_manager._load()
+        state_manager.reload()
         return jsonify({'success': True, 'message': 'Состояние обновлено из файла'})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -729,8 +736,8 @@ def delete_stand():
 def reload_config():
     """Перезагрузить конфигурацию стендов."""
     try:
-        from config import load_stands
-        stands = load_stands()
+        from config import refresh_stand_catalog
+        stands = refresh_stand_catalog(force=True)
         return jsonify({'success': True, 'message': f'Конфигурация перезагружена. Загружено {len(stands)} стендов'})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""Асинхронный интерфейс к менеджеру состояния для ботов на asyncio."""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from user_record import UserRecord
+
+
+class AsyncRealtimeStateManager:
+    """Асинхронная обертка над RealtimeStateManager (или RemoteStateManager).
+
+    Вызовы, которые берут блокировку состояния, ходят на диск (холодное
+    хранилище) или в сокет сервера состояния, выполняются в небольшом пуле
+    потоков и не останавливают цикл событий. Запись на диск и так выполняет
+    фоновый поток менеджера. Чтение снимка и статистики не блокируется
+    и выполняется сразу.
+    """
+
+    def __init__(self, manager=None, max_workers: int = 4):
+        if manager is None:
+            from realtime_state import get_state_manager
+            manager = get_state_manager()
+        self.manager = manager
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='state-async')
+        # Транзакции одного пользователя в цикле событий выполняются по очереди:
+        # id -> [блокировка, число ожидающих и выполняющихся транзакций]
+        self._user_locks: Dict[str, list] = {}
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def get_user(self, user_id: int) -> UserRecord:
+        """Получает данные пользователя, создавая его при первом обращении."""
+        return await self._run(self.manager.get_user, user_id)
+
+    async def peek_user(self, user_id: int) -> Optional[UserRecord]:
+        return await self._run(self.manager.peek_user, user_id)
+
+    async def has_user(self, user_id: int) -> bool:
+        return await self._run(self.manager.has_user, user_id)
+
+    async def update_user(self, user_id: int, updates: Dict[str, Any]):
+        await self._run(self.manager.update_user, user_id, updates)
+
+    async def update_users(self, updates: Dict[Any, Dict[str, Any]]) -> int:
+        return await self._run(self.manager.update_users, updates)
+
+    async def query_users(self, index: str, limit: Optional[int] = None) -> List[Tuple[str, UserRecord]]:
+        return await self._run(self.manager.query_users, index, limit)
+
+    async def get_all_users(self) -> Dict[str, Any]:
+        return await self._run(self.manager.get_all_users)
+
+    async def get_stats(self) -> Dict[str, Any]:
+        return await self._run(self.manager.get_stats)
+
+    def snapshot(self):
+        """Последний опубликованный снимок (у локального менеджера - без блокировки)."""
+        return self.manager.snapshot()
+
+    async def flush(self, timeout: Optional[float] = None) -> bool:
+        """Дожидается записи на диск всех изменений, сделанных до вызова."""
+        return await self._run(self.manager.flush, timeout)
+
+    async def reload(self):
+        await self._run(self.manager.reload)
+
+    async def clear_all(self):
+        await self._run(self.manager.clear_all)
+
+    @asynccontextmanager
+    async def transaction(self, user_id: int) -> AsyncIterator[UserRecord]:
+        """Изменяет копию записи и фиксирует отличающиеся поля одним обновлением.
+
+        Транзакции одного пользователя внутри цикла событий выполняются по
+        очереди; блокировка состояния между await не удерживается, поэтому
+        от изменений из других потоков и процессов блок не изолирован.
+        При исключении изменения отбрасываются.
+        """
+        key = str(user_id)
+        entry = self._user_locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                original = await self.get_user(user_id)
+                record = original.copy()
+                yield record
+                fields = original.diff(record)
+                if fields:
+                    await self.update_user(user_id, {field: record[field] for field in fields if field in record})
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._user_locks[key]
+
+    async def events(self, max_pending: int = 0) -> AsyncIterator[Any]:
+        """Асинхронно перебирает события изменения состояния (StateChangeEvent).
+
+        Подписка действует, пока идет перебор; max_pending > 0 ограничивает
+        очередь непрочитанных событий, лишние события при этом отбрасываются.
+        """
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue(max_pending)
+
+        def put(event):
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                print("[AsyncState] Event queue is full, dropping event")
+
+        def on_state_change(event):
+            # Вызывается из потока рассылки менеджера
+            loop.call_soon_threadsafe(put, event)
+
+        await self._run(self.manager.subscribe, on_state_change)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            self.manager.unsubscribe(on_state_change)
+
+    async def close(self):
+        """Завершает пул потоков (сам менеджер состояния не останавливается)."""
+        self._executor.shutdown(wait=False)
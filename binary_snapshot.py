@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+"""Бинарный снимок состояния для быстрого старта: открывается через mmap,
+пользователи декодируются только при обращении.
+
+Формат файла (все числа big-endian):
+    заголовок   - магия, версия, подпись исходного JSON-файла, число записей,
+                  смещения блока ключей и индекса;
+    записи      - компактный JSON каждого пользователя подряд;
+    ключи       - id пользователей подряд;
+    индекс      - записи фиксированной длины (смещение и длина ключа,
+                  смещение и длина записи), отсортированные по id.
+
+Подпись исходного JSON (inode, mtime, размер) позволяет понять, что снимок
+устарел: если JSON записан без снимка, используется JSON.
+"""
+
+import json
+import mmap
+import os
+import struct
+from collections.abc import Mapping, MutableMapping
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from user_record import UserRecord, to_json
+
+MAGIC = b'SFSB'
+VERSION = 1
+
+_HEADER = struct.Struct('>4sHHQQQQQQ')
+_ENTRY = struct.Struct('>IHQI')
+
+
+class EncodedSnapshot:
+    """Сериализованные записи; заголовок с подписью JSON дописывается при записи."""
+
+    __slots__ = ('count', 'records', 'keys', 'index')
+
+    def __init__(self, count: int, records: bytes, keys: bytes, index: bytes):
+        self.count = count
+        self.records = records
+        self.keys = keys
+        self.index = index
+
+
+def encode_snapshot(data: Mapping) -> EncodedSnapshot:
+    """Сериализует пользователей. Записи, еще не декодированные из прошлого снимка, копируются как есть."""
+    raw_of = data.raw if isinstance(data, LazyUsers) else None
+    items: List[Tuple[bytes, bytes]] = []
+    for key in data.keys():
+        raw = raw_of(key) if raw_of else None
+        if raw is None:
+            raw = json.dumps(data[key], ensure_ascii=False, separators=(',', ':'), default=to_json).encode('utf-8')
+        items.append((key.encode('utf-8'), raw))
+    items.sort(key=lambda item: item[0])
+
+    records, keys, index = bytearray(), bytearray(), bytearray()
+    for key, raw in items:
+        index += _ENTRY.pack(len(keys), len(key), _HEADER.size + len(records), len(raw))
+        keys += key
+        records += raw
+    return EncodedSnapshot(len(items), bytes(records), bytes(keys), bytes(index))
+
+
+def write_snapshot(path: Path, encoded: EncodedSnapshot, source_signature: Tuple[int, int, int]):
+    """Атомарно записывает снимок для исходного JSON-файла с подписью source_signature."""
+    keys_offset = _HEADER.size + len(encoded.records)
+    index_offset = keys_offset + len(encoded.keys)
+    header = _HEADER.pack(MAGIC, VERSION, 0, *source_signature, encoded.count, keys_offset, index_offset)
+    temp_path = path.with_suffix('.bin.tmp')
+    with open(temp_path, 'wb') as f:
+        f.write(header)
+        f.write(encoded.records)
+        f.write(encoded.keys)
+        f.write(encoded.index)
+    temp_path.replace(path)
+
+
+def source_signature(path: Path) -> Tuple[int, int, int]:
+    st = os.stat(path)
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+def open_snapshot(path: Path, source_path: Path) -> Optional['SnapshotReader']:
+    """Открывает снимок, если он соответствует текущему исходному JSON-файлу."""
+    try:
+        reader = SnapshotReader(path)
+    except (OSError, ValueError):
+        return None
+    try:
+        current = source_signature(source_path)
+    except FileNotFoundError:
+        current = None
+    if reader.source_signature != current:
+        reader.close()
+        return None
+    return reader
+
+
+class SnapshotReader(Mapping):
+    """Словарь пользователей поверх mmap снимка; поиск - двоичный по индексу."""
+
+    def __init__(self, path: Path):
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._mmap) < _HEADER.size:
+            self._mmap.close()
+            raise ValueError(f'{path} is too short for a state snapshot')
+        magic, version, _, ino, mtime_ns, size, count, keys_offset, index_offset = _HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version != VERSION:
+            self._mmap.close()
+            raise ValueError(f'{path} is not a state snapshot v{VERSION}')
+        self.source_signature = (ino, mtime_ns, size)
+        self._count = count
+        self._keys_offset = keys_offset
+        self._index_offset = index_offset
+
+    def _entry(self, position: int) -> Tuple[bytes, int, int]:
+        key_offset, key_len, record_offset, record_len = _ENTRY.unpack_from(
+            self._mmap, self._index_offset + position * _ENTRY.size)
+        start = self._keys_offset + key_offset
+        return self._mmap[start:start + key_len], record_offset, record_len
+
+    def raw(self, key: str) -> Optional[bytes]:
+        """JSON-байты записи без декодирования или None."""
+        target = key.encode('utf-8')
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            middle_key, record_offset, record_len = self._entry(middle)
+            if middle_key < target:
+                low = middle + 1
+            elif middle_key > target:
+                high = middle
+            else:
+                return self._mmap[record_offset:record_offset + record_len]
+        return None
+
+    def entries(self) -> Iterator[Tuple[str, bytes]]:
+        """Все пары (id, JSON-байты) подряд, без поиска по индексу."""
+        for position in range(self._count):
+            key, record_offset, record_len = self._entry(position)
+            yield key.decode('utf-8'), self._mmap[record_offset:record_offset + record_len]
+
+    @staticmethod
+    def decode(key: str, raw: bytes) -> Any:
+        value = json.loads(raw)
+        return value if key == 'meta' else UserRecord.from_dict(value)
+
+    def __getitem__(self, key: str) -> Any:
+        raw = self.raw(key)
+        if raw is None:
+            raise KeyError(key)
+        return self.decode(key, raw)
+
+    def __contains__(self, key: object) -> bool:
+        return isinstance(key, str) and self.raw(key) is not None
+
+    def __iter__(self) -> Iterator[str]:
+        for position in range(self._count):
+            yield self._entry(position)[0].decode('utf-8')
+
+    def __len__(self) -> int:
+        return self._count
+
+    def close(self):
+        self._mmap.close()
+
+
+class _EmptySnapshot(Mapping):
+    """Пустой снимок (после clear())."""
+
+    def raw(self, key: str) -> Optional[bytes]:
+        return None
+
+    def __getitem__(self, key: str) -> Any:
+        raise KeyError(key)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(())
+
+    def __len__(self) -> int:
+        return 0
+
+
+class LazyUsers(MutableMapping):
+    """Изменяемый словарь поверх снимка: прочитанные и измененные записи
+    хранятся в памяти, остальные декодируются из снимка при первом обращении."""
+
+    def __init__(self, base: SnapshotReader):
+        self.base = base
+        self._overlay: Dict[str, Any] = {}
+        self._deleted: set = set()
+        # Сколько ключей снимка перекрыто памятью или удалено
+        self._shadowed = 0
+
+    def _shadow(self, key: str):
+        if key not in self._overlay and key not in self._deleted and key in self.base:
+            self._shadowed += 1
+
+    def raw(self, key: str) -> Optional[bytes]:
+        """JSON-байты записи, если она еще не декодирована и не изменена."""
+        if key in self._overlay or key in self._deleted:
+            return None
+        return self.base.raw(key)
+
+    def promote(self, key: str, value: Any):
+        """Кладет заранее декодированную запись снимка, если ключ еще не перекрыт."""
+        if key not in self._overlay and key not in self._deleted:
+            self._shadowed += 1
+            self._overlay[key] = value
+
+    def is_loaded(self) -> bool:
+        """Все записи снимка уже в памяти."""
+        return self._shadowed == len(self.base)
+
+    def overlay(self) -> Dict[str, Any]:
+        return self._overlay
+
+    def __getitem__(self, key: str) -> Any:
+        if key in self._overlay:
+            return self._overlay[key]
+        if key in self._deleted:
+            raise KeyError(key)
+        value = self.base[key]
+        self.promote(key, value)
+        return value
+
+    def __setitem__(self, key: str, value: Any):
+        self._shadow(key)
+        self._deleted.discard(key)
+        self._overlay[key] = value
+
+    def __delitem__(self, key: str):
+        if key not in self:
+            raise KeyError(key)
+        self._shadow(key)
+        self._overlay.pop(key, None)
+        if key in self.base:
+            self._deleted.add(key)
+
+    def __contains__(self, key: object) -> bool:
+        if key in self._overlay:
+            return True
+        return key not in self._deleted and key in self.base
+
+    def __iter__(self) -> Iterator[str]:
+        yield from list(self._overlay)
+        for key in self.base:
+            if key not in self._overlay and key not in self._deleted:
+                yield key
+
+    def __len__(self) -> int:
+        return len(self.base) - self._shadowed + len(self._overlay)
+
+    def clear(self):
+        self.base = _EmptySnapshot()
+        self._overlay.clear()
+        self._deleted.clear()
+        self._shadowed = 0
@@ -9,14 +9,20 @@ import requests
 import time
 import random
 import re
+import secrets
+import threading
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
 
 # Загружаем переменные окружения
 load_dotenv()
 
 # Импортируем единый менеджер состояния
 from realtime_state import get_state_manager
-from config import BOT_TOKEN, VK_LINK_PATTERN, load_stands
+from outbound import OutboundScheduler
+from update_dispatcher import UpdateDispatcher
+from webhook import WEBHOOK_PATH, WebhookServer
+from config import BOT_TOKEN, VK_LINK_PATTERN, get_stand_catalog
 
 # Настройка логирования
 logging.basicConfig(
@@ -27,27 +33,135 @@ logging.basicConfig(
 
 logger = logging.getLogger('telegram_bot')
 
+# Пауза между неудачными getUpdates: экспоненциальный рост с разбросом
+POLL_BACKOFF_BASE = 1.0
+POLL_BACKOFF_MAX = 30.0
+# Сколько ждать обработки выданных обновлений перед следующим getUpdates:
+# пока offset не подтвержден, Telegram сразу возвращает те же обновления
+POLL_STALL_WAIT = 0.5
+# Бот обрабатывает только сообщения, остальные типы обновлений не запрашиваем
+ALLOWED_UPDATES = ['message']
+# Сигнатура клавиатуры "убрать клавиатуру" (ожидаем ввод от пользователя)
+KEYBOARD_REMOVED = 'remove'
+# Сколько закодированных клавиатур держать в памяти
+KEYBOARD_CACHE_SIZE = 1024
+# Сколько пользователей помнить с последней отправленной клавиатурой
+KEYBOARD_STATES_SIZE = 100000
+
 class TelegramBot:
-    def __init__(self, token):
+    def __init__(self, token, pool_size=None, connect_timeout=None, read_timeout=None, workers=None,
+                 state_manager=None):
         self.token = token
         self.api_url = f"https://api.telegram.org/bot{token}"
-        self.state_manager = get_state_manager()
+        # По умолчанию - общий менеджер состояния процесса (data/state.json)
+        self.state_manager = state_manager or get_state_manager()
         self.offset = 0
+        # Число потоков обработки обновлений (обновления одного пользователя - по порядку)
+        self.workers = workers or int(os.getenv('BOT_WORKERS', '8'))
+        self.dispatcher = None
+
+        # Источник обновлений: polling (getUpdates) или webhook (HTTP-сервер за nginx)
+        self.mode = os.getenv('BOT_MODE', 'polling')
+        self.webhook_url = os.getenv('TELEGRAM_WEBHOOK_URL', '')
+        self.webhook_secret = os.getenv('TELEGRAM_WEBHOOK_SECRET', '')
+        self.webhook_host = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+        self.webhook_port = int(os.getenv('WEBHOOK_PORT', '8081'))
+        self.webhook_server = None
+
+        # Закодированная разметка клавиатур по сигнатуре прогресса
+        self._keyboard_markups = {}
+        # Сигнатура последней отправленной пользователю клавиатуры. Хранится только
+        # в памяти: после перезапуска клавиатура один раз отправится заново
+        self._keyboard_states = {}
+        self._keyboard_states_lock = threading.Lock()
+
+        # Одна сессия с пулом keep-alive соединений к api.telegram.org:
+        # TCP и TLS устанавливаются один раз, а не на каждое сообщение
+        self.pool_size = pool_size or int(os.getenv('TELEGRAM_POOL_SIZE', '10'))
+        self.connect_timeout = connect_timeout or float(os.getenv('TELEGRAM_CONNECT_TIMEOUT', '5'))
+        self.read_timeout = read_timeout or float(os.getenv('TELEGRAM_READ_TIMEOUT', '10'))
+        # Long polling: сервер держит запрос до poll_timeout секунд, если обновлений нет
+        self.poll_timeout = int(os.getenv('TELEGRAM_POLL_TIMEOUT', '50'))
+        self.poll_limit = int(os.getenv('TELEGRAM_POLL_LIMIT', '100'))
+        self.session = requests.Session()
+        self._adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, pool_block=False)
+        self.session.mount('https://', self._adapter)
+        self.session.mount('http://', self._adapter)
+
+        # Исходящие сообщения отправляются фоновыми потоками в пределах лимитов
+        # Telegram: около 30 сообщений в секунду всего и 1 в секунду в один чат
+        self.outbox = OutboundScheduler(
+            self.call_api,
+            global_rate=float(os.getenv('TELEGRAM_GLOBAL_RATE', '30')),
+            chat_rate=float(os.getenv('TELEGRAM_CHAT_RATE', '1')),
+            chat_burst=float(os.getenv('TELEGRAM_CHAT_BURST', '3')),
+            workers=int(os.getenv('TELEGRAM_SENDERS', '4')),
+        )
+
+    def pool_stats(self):
+        """Статистика пула соединений: запросы, открытые соединения и повторные использования."""
+        pools = self._adapter.poolmanager.pools
+        requests_count = connections = 0
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                requests_count += pool.num_requests
+                connections += pool.num_connections
+        return {
+            'pool_size': self.pool_size,
+            'requests': requests_count,
+            'connections_opened': connections,
+            'connections_reused': max(0, requests_count - connections),
+        }
+
+    def close(self):
+        """Досылает очередь исходящих сообщений и закрывает соединения с Telegram API."""
+        self.outbox.stop()
+        logger.info(f"HTTP pool stats: {self.pool_stats()}")
+        self.session.close()
+
+    def read_user(self, user_id):
+        """Прочитать пользователя без записи; создать только если его еще нет."""
+        user = self.state_manager.peek_user(user_id)
+        if user is None:
+            user = self.state_manager.get_user(user_id)
+        return user
+
+    def keyboard_signature(self, user, catalog):
+        """Компактная сигнатура всего, от чего зависит клавиатура пользователя:
+        флаги ожидания ввода, маска пройденных стендов, статус ВК и каталог."""
+        if user is None or user['awaiting_name'] or user['awaiting_vk_link'] or user.get('pending_question'):
+            return KEYBOARD_REMOVED
+        done = user.done_mask & catalog.mask
+        return f"{catalog.digest}:{done:x}:{int(bool(user.get('vk_verified', False)))}"
+
+    def keyboard_markup(self, user):
+        """Сигнатура клавиатуры и ее разметка в JSON (кэшируется по сигнатуре)."""
+        catalog = get_stand_catalog()
+        signature = self.keyboard_signature(user, catalog)
+        markup = self._keyboard_markups.get(signature)
+        if markup is None:
+            if len(self._keyboard_markups) >= KEYBOARD_CACHE_SIZE:
+                self._keyboard_markups.clear()
+            markup = json.dumps(self._build_keyboard(user, catalog))
+            self._keyboard_markups[signature] = markup
+        return signature, markup
 
     def create_keyboard(self, user_id):
         """Создать клавиатуру в зависимости от состояния пользователя."""
-        user = self.state_manager.get_user(user_id)
+        return self._build_keyboard(self.state_manager.peek_user(user_id), get_stand_catalog())
 
+    def _build_keyboard(self, user, catalog):
         # Если ожидаем ввод - убираем клавиатуру
-        if user['awaiting_name'] or user['awaiting_vk_link'] or user.get('pending_question'):
+        if self.keyboard_signature(user, catalog) == KEYBOARD_REMOVED:
             return {'remove_keyboard': True}
 
         # Основная клавиатура
         keyboard = []
 
         # Проверяем прогресс пользователя
-        completed_stands = sum(1 for s in user['stand_status'].values() if s['done'])
-        total_stands = len(user['stand_status'])
+        completed_stands = user.completed_count(catalog.mask)
+        total_stands = len(catalog)
         has_vk = user.get('vk_verified', False)
 
         # Если пользователь завершил все стенды и добавил ВК - показываем кнопку розыгрыша
@@ -75,14 +189,10 @@ class TelegramBot:
         keyboard.append(row1)
 
         # Второй ряд - стенды для прохождения
-        incomplete_stands = [
-            stand_id for stand_id, status in user['stand_status'].items()
-            if not status['done']
-        ]
+        incomplete_stands = [stand_id for stand_id in catalog.ids if not user.is_done(stand_id)]
 
         if incomplete_stands:
-            stands = load_stands()
-            stands_dict = {stand['id']: stand for stand in stands}
+            stands_dict = catalog.by_id
             # Показываем первый доступный стенд
             first_incomplete = incomplete_stands[0]
             if first_incomplete in stands_dict:
@@ -95,42 +205,83 @@ class TelegramBot:
             'one_time_keyboard': False
         }
 
+    def call_api(self, method, data):
+        """Вызвать метод Bot API (из потоков очереди исходящих сообщений)."""
+        try:
+            response = self.session.post(f"{self.api_url}/{method}", data=data,
+                                         timeout=(self.connect_timeout, self.read_timeout))
+            result = response.json()
+        except Exception as e:
+            logger.error(f"Failed to call {method}: {e}")
+            return None
+
+        if result.get('ok'):
+            if method == 'sendMessage':
+                logger.info(f"Message sent to {data['chat_id']}: {data['text'][:50]}...")
+        elif result.get('error_code') != 429:
+            # 429 очередь обрабатывает сама и повторяет вызов
+            logger.error(f"Failed to call {method}: {result}")
+        return result
+
     def send_message(self, chat_id, text, user_id=None, use_keyboard=True):
-        """Отправить сообщение в Telegram."""
-        url = f"{self.api_url}/sendMessage"
+        """Поставить сообщение в очередь отправки.
+
+        Возвращает Future с ответом Telegram (None, если отправить не удалось).
+        """
         data = {
             'chat_id': chat_id,
             'text': text,
             'parse_mode': 'HTML'
         }
 
-        # Добавляем клавиатуру если нужно
+        # Добавляем клавиатуру, если у пользователя сейчас показана другая
+        keyboard_signature = None
         if use_keyboard and user_id:
-            keyboard = self.create_keyboard(user_id)
-            data['reply_markup'] = json.dumps(keyboard)
+            user = self.state_manager.peek_user(user_id)
+            signature, markup = self.keyboard_markup(user)
+            with self._keyboard_states_lock:
+                if user is None or self._keyboard_states.get(user_id) != signature:
+                    data['reply_markup'] = markup
+                    if user is not None:
+                        keyboard_signature = signature
+                        if len(self._keyboard_states) >= KEYBOARD_STATES_SIZE:
+                            self._keyboard_states.clear()
+                        self._keyboard_states[user_id] = signature
+
+        future = self.outbox.submit(chat_id, 'sendMessage', data)
+        if keyboard_signature:
+            future.add_done_callback(
+                lambda sent: self._check_keyboard_delivered(user_id, keyboard_signature, sent.result())
+            )
+        return future
 
-        try:
-            response = requests.post(url, data=data, timeout=10)
-            result = response.json()
-            if result.get('ok'):
-                logger.info(f"Message sent to {chat_id}: {text[:50]}...")
-            else:
-                logger.error(f"Failed to send message: {result}")
-            return result
-        except Exception as e:
-            logger.error(f"Failed to send message: {e}")
-            return None
+    def _check_keyboard_delivered(self, user_id, signature, result):
+        """Если сообщение с клавиатурой не дошло, следующее отправит ее снова."""
+        if result and result.get('ok'):
+            return
+        with self._keyboard_states_lock:
+            if self._keyboard_states.get(user_id) == signature:
+                del self._keyboard_states[user_id]
+
+    def forget_keyboard(self, user_id):
+        """Следующее сообщение пользователю отправит клавиатуру заново."""
+        with self._keyboard_states_lock:
+            self._keyboard_states.pop(user_id, None)
 
     def get_updates(self):
         """Получить обновления из Telegram."""
         url = f"{self.api_url}/getUpdates"
         params = {
             'offset': self.offset,
-            'timeout': 10
+            'timeout': self.poll_timeout,
+            'limit': self.poll_limit,
+            'allowed_updates': json.dumps(ALLOWED_UPDATES),
         }
 
         try:
-            response = requests.get(url, params=params, timeout=15)
+            # Сервер держит запрос до timeout секунд, поэтому ждем ответа дольше
+            response = self.session.get(url, params=params,
+                                        timeout=(self.connect_timeout, params['timeout'] + self.read_timeout))
             return response.json()
         except Exception as e:
             logger.error(f"Failed to get updates: {e}")
@@ -140,15 +291,15 @@ class TelegramBot:
         """Обработать команду /start."""
         logger.info(f"User {user_id} started bot")
 
-        # Создаем или получаем пользователя
-        user = self.state_manager.get_user(user_id)
-
-        # Если пользователь новый, инициализируем
-        if user['full_name'] is None:
-            self.state_manager.update_user(user_id, {
-                'awaiting_name': True
-            })
+        # Создаем или получаем пользователя и, если он новый, инициализируем
+        with self.state_manager.transaction(user_id) as user:
+            is_new = user['full_name'] is None
+            if is_new:
+                user['awaiting_name'] = True
+        # Клиент мог потерять клавиатуру (например, после очистки чата) - отправим заново
+        self.forget_keyboard(user_id)
 
+        if is_new:
             self.send_message(
                 chat_id,
                 "🎉 <b>Добро пожаловать на Sfedunet 12!</b>\n\n"
@@ -216,24 +367,17 @@ class TelegramBot:
     def start_stand_questions(self, chat_id, user_id, stand_description):
         """Начать прохождение стенда с вопросами."""
         # Находим стенд по описанию
-        stands = load_stands()
-        stands_dict = {stand['id']: stand for stand in stands}
-        found_stand = None
+        stand_info = get_stand_catalog().by_description.get(stand_description)
 
-        for stand_id, stand_info in stands_dict.items():
-            if stand_info['description'] == stand_description:
-                found_stand = (stand_id, stand_info)
-                break
-
-        if not found_stand:
+        if not stand_info:
             self.send_message(chat_id, "❌ Стенд не найден!", user_id=user_id)
             return
 
-        stand_id, stand_info = found_stand
-        user = self.state_manager.get_user(user_id)
+        stand_id = stand_info['id']
+        user = self.read_user(user_id)
 
         # Проверяем, не пройден ли уже стенд
-        if user['stand_status'][stand_id]['done']:
+        if user.is_done(stand_id):
             self.send_message(chat_id, f"✅ Стенд уже пройден!", user_id=user_id)
             return
 
@@ -263,7 +407,7 @@ class TelegramBot:
 
     def handle_question_answer(self, chat_id, user_id, text):
         """Обработать ответ на вопрос."""
-        user = self.state_manager.get_user(user_id)
+        user = self.read_user(user_id)
         pending_question = user.get('pending_question')
 
         if not pending_question:
@@ -277,9 +421,7 @@ class TelegramBot:
         if user_answer in correct_answers:
             # Правильный ответ
             stand_id = pending_question['stand_id']
-            stands = load_stands()
-            stands_dict = {stand['id']: stand for stand in stands}
-            stand_info = stands_dict[stand_id]
+            stand_info = get_stand_catalog().by_id[stand_id]
 
             # Завершаем стенд
             self.complete_stand(chat_id, user_id, stand_id, stand_info)
@@ -295,16 +437,13 @@ class TelegramBot:
 
     def complete_stand(self, chat_id, user_id, stand_id, stand_info):
         """Завершить стенд."""
-        # Обновляем статус стенда и убираем активный вопрос
-        user = self.state_manager.get_user(user_id)
-        updates = {
-            'stand_status': {
-                **user['stand_status'],
-                stand_id: {'done': True}
-            },
-            'pending_question': None
-        }
-        self.state_manager.update_user(user_id, updates)
+        # Отмечаем стенд и убираем активный вопрос одной транзакцией
+        catalog = get_stand_catalog()
+        with self.state_manager.transaction(user_id) as user:
+            user.set_done(stand_id)
+            user['pending_question'] = None
+            completed_stands = user.completed_count(catalog.mask)
+        total_stands = len(catalog)
 
         logger.info(f"User {user_id} completed stand: {stand_id}")
 
@@ -312,10 +451,6 @@ class TelegramBot:
         text += f"Вы успешно прошли стенд:\n{stand_info['emoji']} <b>{stand_info['description']}</b>\n\n"
 
         # Проверяем общий прогресс
-        user = self.state_manager.get_user(user_id)  # Перезагружаем данные
-        completed_stands = sum(1 for s in user['stand_status'].values() if s['done'])
-        total_stands = len(user['stand_status'])
-
         if completed_stands == total_stands:
             text += f"🏆 <b>Отлично! Вы прошли все стенды!</b>\n"
             text += f"Теперь добавьте ссылку на ваш ВК профиль для участия в розыгрыше!"
@@ -326,23 +461,23 @@ class TelegramBot:
 
     def show_main_menu(self, chat_id, user_id):
         """Показать главное меню."""
-        user = self.state_manager.get_user(user_id)
+        user = self.read_user(user_id)
 
         text = f"🏆 <b>Привет, {user['full_name']}!</b>\n\n"
         text += "📊 <b>Ваш прогресс по стендам:</b>\n\n"
 
-        # Загружаем актуальные стенды
-        stands = load_stands()
-        stands_dict = {stand['id']: stand for stand in stands}
+        # Берем актуальные стенды из каталога в памяти
+        catalog = get_stand_catalog()
+        stands_dict = catalog.by_id
 
         for stand_id, stand_info in stands_dict.items():
-            status = "✅" if user['stand_status'][stand_id]['done'] else "❌"
+            status = "✅" if user.is_done(stand_id) else "❌"
             title = f"{stand_info['emoji']} {stand_info['description']}"
             text += f"{status} {title}\n"
 
         # Проверяем прогресс
-        completed_stands = sum(1 for s in user['stand_status'].values() if s['done'])
-        total_stands = len(user['stand_status'])
+        completed_stands = user.completed_count(catalog.mask)
+        total_stands = len(catalog)
 
         text += f"\n📈 <b>Прогресс:</b> {completed_stands}/{total_stands} стендов"
 
@@ -385,22 +520,21 @@ class TelegramBot:
 
     def show_stands_menu(self, chat_id, user_id):
         """Показать меню стендов."""
-        user = self.state_manager.get_user(user_id)
+        user = self.read_user(user_id)
 
         text = f"🎮 <b>Выберите стенд для прохождения:</b>\n\n"
 
-        # Загружаем актуальные стенды
-        stands = load_stands()
-        stands_dict = {stand['id']: stand for stand in stands}
+        # Берем актуальные стенды из каталога в памяти
+        stands_dict = get_stand_catalog().by_id
 
         # Показываем все стенды с их статусом
         available_stands = []
         for stand_id, stand_info in stands_dict.items():
-            status = "✅" if user['stand_status'][stand_id]['done'] else "🔘"
+            status = "✅" if user.is_done(stand_id) else "🔘"
             title = f"{status} {stand_info['emoji']} {stand_info['description']}"
             text += f"{title}\n"
 
-            if not user['stand_status'][stand_id]['done']:
+            if not user.is_done(stand_id):
                 available_stands.append(stand_info['description'])
 
         if available_stands:
@@ -463,35 +597,120 @@ class TelegramBot:
         else:
             logger.warning(f"Unknown update type: {list(update.keys())}")
 
+    def set_webhook(self, url, secret_token):
+        """Зарегистрировать webhook в Telegram."""
+        data = {
+            'url': url,
+            'secret_token': secret_token,
+            'allowed_updates': json.dumps(ALLOWED_UPDATES),
+        }
+        try:
+            response = self.session.post(f"{self.api_url}/setWebhook", data=data,
+                                         timeout=(self.connect_timeout, self.read_timeout))
+            return response.json()
+        except Exception as e:
+            logger.error(f"Failed to set webhook: {e}")
+            return None
+
+    def delete_webhook(self):
+        """Снять webhook: пока он установлен, getUpdates не работает."""
+        try:
+            response = self.session.post(f"{self.api_url}/deleteWebhook",
+                                         timeout=(self.connect_timeout, self.read_timeout))
+            return response.json()
+        except Exception as e:
+            logger.error(f"Failed to delete webhook: {e}")
+            return None
+
+    def start_webhook(self):
+        """Запустить прием обновлений через webhook.
+
+        Если задан TELEGRAM_WEBHOOK_URL, webhook регистрируется в Telegram
+        (без TELEGRAM_WEBHOOK_SECRET - со случайным секретом). Без URL сервер
+        только слушает порт: webhook зарегистрирован отдельно или обновления
+        шлет fake_telegram.py.
+        """
+        secret_token = self.webhook_secret
+        if self.webhook_url:
+            secret_token = secret_token or secrets.token_urlsafe(32)
+            result = self.set_webhook(self.webhook_url, secret_token)
+            if not result or not result.get('ok'):
+                raise RuntimeError(f"setWebhook failed: {result}")
+            logger.info(f"Webhook registered: {self.webhook_url}")
+        elif not secret_token:
+            raise RuntimeError("TELEGRAM_WEBHOOK_SECRET is required when TELEGRAM_WEBHOOK_URL is not set")
+
+        self.webhook_server = WebhookServer((self.webhook_host, self.webhook_port),
+                                            self.dispatcher.push, secret_token, WEBHOOK_PATH)
+        return self.webhook_server.start()
+
+    def poll_updates(self):
+        """Один запрос long polling; новые обновления передаются диспетчеру.
+
+        Возвращает ответ Telegram (None при сетевой ошибке).
+        """
+        self.dispatcher.wait_idle(POLL_STALL_WAIT)
+        self.offset = max(self.offset, self.dispatcher.offset())
+        updates_response = self.get_updates()
+
+        if updates_response and updates_response.get('ok'):
+            for update in updates_response.get('result', []):
+                self.dispatcher.submit(update)
+
+        return updates_response
+
+    def poll_backoff(self, errors, updates_response=None):
+        """Пауза после errors неудачных getUpdates подряд.
+
+        Если Telegram указал retry_after (429), ждем не меньше него.
+        """
+        parameters = (updates_response or {}).get('parameters') or {}
+        if parameters.get('retry_after'):
+            return parameters['retry_after'] + random.uniform(0, POLL_BACKOFF_BASE)
+        delay = min(POLL_BACKOFF_MAX, POLL_BACKOFF_BASE * 2 ** (errors - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
     def run(self):
         """Запустить бота."""
         logger.info('Starting Telegram Bot with realtime state...')
 
         # Подписываемся на изменения состояния
-        def on_state_change(data):
-            logger.info(f'State changed! Total users: {len(data)}')
+        def on_state_change(event):
+            logger.info(f'State changed! Users: {len(event.user_ids)}, version: {event.version}')
 
         self.state_manager.subscribe(on_state_change)
         logger.info('Bot initialized successfully with realtime state.')
 
+        # Обновления разных пользователей обрабатываются параллельно,
+        # offset подтверждается только после обработки всех предыдущих обновлений
+        self.dispatcher = UpdateDispatcher(self.process_update, workers=self.workers,
+                                           max_in_flight=max(1, self.poll_limit - 1))
+
         try:
-            logger.info('Starting bot polling loop...')
+            if self.mode == 'webhook':
+                logger.info(f'Starting bot in webhook mode with {self.workers} workers...')
+                server_thread = self.start_webhook()
+                while server_thread.is_alive():
+                    server_thread.join(1)
+                return
 
+            logger.info(f'Starting bot polling loop with {self.workers} workers...')
+            self.delete_webhook()
+
+            errors = 0
             while True:
-                updates_response = self.get_updates()
+                updates_response = self.poll_updates()
 
                 if updates_response and updates_response.get('ok'):
-                    updates = updates_response.get('result', [])
-
-                    for update in updates:
-                        try:
-                            self.process_update(update)
-                            self.offset = update['update_id'] + 1
-                        except Exception as e:
-                            logger.error(f"Error processing update: {e}")
-                            continue
+                    # Сразу следующий запрос: без обновлений сервер сам подержит его
+                    errors = 0
+                    continue
 
-                time.sleep(1)
+                errors += 1
+                delay = self.poll_backoff(errors, updates_response)
+                description = (updates_response or {}).get('description', 'no response')
+                logger.warning(f"getUpdates failed ({errors} in a row): {description}; retrying in {delay:.1f}s")
+                time.sleep(delay)
 
         except KeyboardInterrupt:
             logger.info('Bot interrupted by user.')
@@ -499,6 +718,10 @@ class TelegramBot:
             logger.error('Bot error: %s', str(exc), exc_info=True)
             raise
         finally:
+            if self.webhook_server:
+                self.webhook_server.stop()
+            self.dispatcher.stop()
+            self.close()
             self.state_manager.stop()
             logger.info('Bot stopped.')
 
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""Единый детектор изменений файлов состояния и каталога стендов."""
+
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from watchdog.events import FileSystemEventHandler
+from watchdog.observers import Observer
+
+# Подпись файла: (inode, mtime в наносекундах, размер); None - файла нет
+Signature = Optional[Tuple[int, int, int]]
+
+
+def file_signature(path: Path) -> Signature:
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+class _WatchdogHandler(FileSystemEventHandler):
+    """Передает детектору события по отслеживаемым именам файлов."""
+
+    def __init__(self, detector: 'ChangeDetector'):
+        self.detector = detector
+
+    def on_any_event(self, event):
+        if event.is_directory:
+            return
+        # Атомарная замена файла приходит как перемещение временного файла
+        names = {Path(event.src_path).name, Path(getattr(event, 'dest_path', '') or '').name}
+        if names & self.detector.names:
+            self.detector.poke()
+
+
+class ChangeDetector:
+    """Следит за файлами через watchdog с резервным опросом stat().
+
+    События не отбрасываются, а объединяются: проверка выполняется, когда
+    события затихли на debounce секунд, но не позже max_delay после первого.
+    Проверка сравнивает подписи файлов с последними известными; собственные
+    записи процесса регистрируются через acknowledge() и не считаются
+    изменениями, поэтому callback вызывается только для чужих записей.
+    """
+
+    def __init__(self, paths: Iterable[Path], callback: Callable[[List[Path]], None],
+                 debounce: float = 0.1, max_delay: float = 1.0, poll_interval: float = 2.0):
+        self.paths = [Path(path) for path in paths]
+        self.names = {path.name for path in self.paths}
+        self.callback = callback
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.poll_interval = poll_interval
+        self._cond = threading.Condition()
+        self._known: Dict[Path, Signature] = self.signatures()
+        self._first_poke: Optional[float] = None
+        self._last_poke: Optional[float] = None
+        self._stopped = False
+        self._observer = None
+        self._thread: Optional[threading.Thread] = None
+
+    def signatures(self, paths: Optional[Iterable[Path]] = None) -> Dict[Path, Signature]:
+        """Текущие подписи файлов (по умолчанию всех отслеживаемых)."""
+        return {path: file_signature(path) for path in (self.paths if paths is None else paths)}
+
+    def acknowledge(self, before: Dict[Path, Signature]):
+        """Отмечает собственную запись: before - подписи файлов, снятые перед ней.
+
+        Файл принимается как свой, только если до записи его подпись совпадала
+        с известной; иначе до нас его изменил кто-то еще, и проверка это увидит.
+        """
+        after = self.signatures(before)
+        with self._cond:
+            for path, signature in before.items():
+                if self._known.get(path) == signature:
+                    self._known[path] = after[path]
+
+    def poke(self):
+        """Сообщает о возможном изменении; проверка будет выполнена после затишья."""
+        with self._cond:
+            now = time.monotonic()
+            if self._first_poke is None:
+                self._first_poke = now
+            self._last_poke = now
+            self._cond.notify()
+
+    def check(self) -> List[Path]:
+        """Сравнивает подписи с известными и возвращает измененные чужими записями файлы."""
+        current = self.signatures()
+        with self._cond:
+            changed = [path for path, signature in current.items() if self._known.get(path) != signature]
+            self._known.update(current)
+        return changed
+
+    def start(self):
+        try:
+            self._observer = Observer()
+            handler = _WatchdogHandler(self)
+            for directory in {path.parent for path in self.paths}:
+                directory.mkdir(parents=True, exist_ok=True)
+                self._observer.schedule(handler, str(directory), recursive=False)
+            self._observer.start()
+        except Exception as e:
+            print(f"[ChangeDetector] Failed to start file monitoring, polling only: {e}")
+            self._observer = None
+        self._thread = threading.Thread(target=self._run, name='state-change-detector', daemon=True)
+        self._thread.start()
+        print(f"[ChangeDetector] Watching {', '.join(sorted(self.names))} "
+              f"(debounce {self.debounce}s, poll every {self.poll_interval}s)")
+
+    def _wait_for_check(self) -> bool:
+        """Ждет следующей проверки: затишья после событий или интервала опроса. False - остановлен."""
+        with self._cond:
+            deadline = time.monotonic() + self.poll_interval
+            while self._first_poke is None and not self._stopped:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            while self._first_poke is not None and not self._stopped:
+                now = time.monotonic()
+                remaining = min(self._last_poke + self.debounce, self._first_poke + self.max_delay) - now
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            self._first_poke = self._last_poke = None
+            return not self._stopped
+
+    def _run(self):
+        while self._wait_for_check():
+            try:
+                changed = self.check()
+                if changed:
+                    self.callback(changed)
+            except Exception as e:
+                print(f"[ChangeDetector] Error handling file change: {e}")
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._observer:
+            self._observer.stop()
+            self._observer.join()
+        if self._thread:
+            self._thread.join(timeout=5)
+        print("[ChangeDetector] Stopped")
@@ -1,10 +1,15 @@
 """Конфигурационный файл с константами и текстами бота."""
 
+import hashlib
 import json
 import os
 import re
+import threading
+import time
 from pathlib import Path
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional, Tuple
+
+from user_record import stand_bits
 
 # Пути и настройки
 DATA_PATH = Path(os.getenv('BOT_STATE_PATH', 'data/state.json'))
@@ -28,11 +33,14 @@ SCHEDULE_TEXT = (
     '✨ Не забудьте посетить все стенды для участия в розыгрыше!'
 )
 
+# Файл с конфигурацией стендов
+STANDS_FILE_PATH = Path('data/stands.json')
+
 # Функция для загрузки стендов из JSON
 def load_stands():
     """Загрузить стенды из JSON файла."""
     try:
-        stands_file = Path('data/stands.json')
+        stands_file = STANDS_FILE_PATH
         if stands_file.exists():
             with open(stands_file, 'r', encoding='utf-8') as f:
                 return json.load(f)
@@ -46,17 +54,102 @@ def load_stands():
 def save_stands(stands):
     """Сохранить стенды в JSON файл."""
     try:
-        stands_file = Path('data/stands.json')
+        stands_file = STANDS_FILE_PATH
         stands_file.parent.mkdir(parents=True, exist_ok=True)
 
         with open(stands_file, 'w', encoding='utf-8') as f:
             json.dump(stands, f, ensure_ascii=False, indent=2)
         print(f"[Config] Стенды сохранены в {stands_file}")
+        refresh_stand_catalog(force=True)
         return True
     except Exception as e:
         print(f"[Config] Ошибка сохранения стендов: {e}")
         return False
 
+
+class StandCatalog:
+    """Неизменяемый снимок конфигурации стендов с готовыми индексами."""
+
+    def __init__(self, stands: List[Dict[str, Any]], version: int):
+        self.stands: Tuple[Dict[str, Any], ...] = tuple(stands)
+        self.version = version
+        # Отпечаток содержимого: в отличие от version, одинаков во всех процессах и после перезапуска
+        self.digest = hashlib.sha1(
+            json.dumps(self.stands, sort_keys=True, ensure_ascii=False).encode('utf-8')
+        ).hexdigest()[:12]
+        self.ids: Tuple[str, ...] = tuple(stand['id'] for stand in self.stands)
+        self.id_set = frozenset(self.ids)
+        # Маска стендов каталога для UserRecord.known_mask/done_mask
+        self.mask = stand_bits.mask(self.ids)
+        self.by_id: Dict[str, Dict[str, Any]] = {stand['id']: stand for stand in self.stands}
+        self.by_description: Dict[str, Dict[str, Any]] = {}
+        for stand in self.stands:
+            # При одинаковых описаниях побеждает первый стенд, как при поиске перебором
+            self.by_description.setdefault(stand.get('description'), stand)
+
+    def __len__(self) -> int:
+        return len(self.stands)
+
+    def __iter__(self):
+        return iter(self.stands)
+
+
+class StandCatalogLoader:
+    """Процессный кэш каталога стендов.
+
+    Файл перечитывается только если изменились его inode, mtime или размер,
+    а сам stat() выполняется не чаще одного раза в check_interval секунд,
+    поэтому обработчики бота не обращаются к диску.
+    """
+
+    def __init__(self, path: Path, check_interval: float = 1.0):
+        self.path = Path(path)
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._catalog = StandCatalog([], 0)
+        self._file_id: Optional[tuple] = None
+        self._checked_at = 0.0
+
+    def _stat_id(self) -> Optional[tuple]:
+        try:
+            st = self.path.stat()
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    def get(self) -> StandCatalog:
+        """Текущий каталог; файл проверяется не чаще check_interval."""
+        if time.monotonic() - self._checked_at >= self.check_interval:
+            return self.refresh()
+        return self._catalog
+
+    def refresh(self, force: bool = False) -> StandCatalog:
+        """Проверяет файл и перечитывает его, если он изменился."""
+        with self._lock:
+            self._checked_at = time.monotonic()
+            file_id = self._stat_id()
+            if not force and file_id == self._file_id and self._catalog.version:
+                return self._catalog
+
+            stands = load_stands()
+            self._file_id = file_id
+            self._catalog = StandCatalog(stands, self._catalog.version + 1)
+            print(f"[Config] Каталог стендов v{self._catalog.version}: {len(stands)} стендов")
+            return self._catalog
+
+
+_stand_catalog_loader = StandCatalogLoader(STANDS_FILE_PATH)
+
+
+def get_stand_catalog() -> StandCatalog:
+    """Получить актуальный каталог стендов без лишнего чтения файла."""
+    return _stand_catalog_loader.get()
+
+
+def refresh_stand_catalog(force: bool = False) -> StandCatalog:
+    """Проверить файл стендов немедленно (например, по событию файлового монитора)."""
+    return _stand_catalog_loader.refresh(force)
+
 # Загружаем стенды из JSON
 STANDS = load_stands()
 
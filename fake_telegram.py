@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""Локальный отправитель обновлений в webhook бота вместо Telegram (для проверки и нагрузки).
+
+    BOT_MODE=webhook TELEGRAM_WEBHOOK_SECRET=test python bot.py
+    python fake_telegram.py --secret test --users 50 --messages 20
+"""
+
+import argparse
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, Optional
+
+import requests
+
+from webhook import SECRET_HEADER, WEBHOOK_PATH
+
+_update_ids = itertools.count(1)
+
+
+def make_update(user_id: int, text: str, update_id: Optional[int] = None) -> Dict[str, Any]:
+    """Обновление с текстовым сообщением в формате Bot API."""
+    update_id = next(_update_ids) if update_id is None else update_id
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'User {user_id}', 'username': f'user{user_id}'},
+            'chat': {'id': user_id, 'type': 'private'},
+            'date': int(time.time()),
+            'text': text,
+        },
+    }
+
+
+def send_update(session: requests.Session, url: str, secret: str, update: Dict[str, Any]) -> int:
+    """Отправляет обновление так же, как Telegram; возвращает HTTP-статус ответа."""
+    response = session.post(url, json=update, headers={SECRET_HEADER: secret}, timeout=10)
+    return response.status_code
+
+
+def send_updates(url: str, secret: str, updates: Iterable[Dict[str, Any]], connections: int = 4) -> Dict[str, Any]:
+    """Отправляет обновления в несколько соединений; сообщения одного пользователя - по порядку."""
+    by_user: Dict[int, list] = {}
+    for update in updates:
+        by_user.setdefault(update['message']['from']['id'], []).append(update)
+    # Пользователи распределяются по соединениям, у каждого соединения свой поток
+    groups = [list(by_user.values())[index::connections] for index in range(connections)]
+    lock = threading.Lock()
+    statuses: Dict[int, int] = {}
+    latencies = []
+
+    def send_group(user_groups):
+        with requests.Session() as session:
+            for user_updates in user_groups:
+                for update in user_updates:
+                    started = time.perf_counter()
+                    status = send_update(session, url, secret, update)
+                    with lock:
+                        latencies.append(time.perf_counter() - started)
+                        statuses[status] = statuses.get(status, 0) + 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=connections) as executor:
+        list(executor.map(send_group, groups))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'sent': len(latencies),
+        'statuses': statuses,
+        'seconds': round(elapsed, 3),
+        'median_ms': round(latencies[len(latencies) // 2] * 1000, 2) if latencies else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default=f'http://127.0.0.1:8081{WEBHOOK_PATH}')
+    parser.add_argument('--secret', required=True, help='TELEGRAM_WEBHOOK_SECRET бота')
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--messages', type=int, default=5, help='сообщений на пользователя')
+    parser.add_argument('--connections', type=int, default=4)
+    parser.add_argument('--text', default='📊 Мой прогресс')
+    parser.add_argument('--first-user-id', type=int, default=900000000)
+    args = parser.parse_args()
+
+    updates = [
+        make_update(args.first_user_id + user, args.text)
+        for _ in range(args.messages)
+        for user in range(args.users)
+    ]
+    print(f"[FakeTelegram] Sending {len(updates)} updates to {args.url}")
+    print(f"[FakeTelegram] {send_updates(args.url, args.secret, updates, args.connections)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -334,29 +334,32 @@ def giveaway_page():
 def get_giveaway_stats():
     """Получить статистику для розыгрыша."""
     try:
-        users = state_manager.get_all_users()
+        # Квалифицированные берутся из индекса менеджера, без обхода всех пользователей
+        qualified_users = state_manager.query_users('qualified')
 
-        # Импортируем актуальную конфигурацию стендов
+        # Берем актуальную конфигурацию стендов из каталога в памяти
         try:
-            from config import load_stands
-            stands = load_stands()
-            total_stands = len(stands)
+            from config import get_stand_catalog
+            catalog = get_stand_catalog()
+            stand_mask, total_stands = catalog.mask, len(catalog)
         except Exception as e:
             print(f"[Giveaway] Warning: Could not load stands config: {e}")
-            total_stands = 5
+            stand_mask, total_stands = 0, 0
 
-        total_participants = len(users)
+        total_participants = state_manager.get_stats()['total_users']
         qualified_participants = []
 
-        for user_id, user_data in users.items():
+        # Квалифицированные участники - те кто прошел все стенды И добавил ВК
+        for user_id, user_data in qualified_users:
             if not user_data.get('full_name'):
                 continue
 
-            completed = sum(1 for status in user_data.get('stand_status', {}).values() if status.get('done', False))
-            total_user_stands = len(user_data.get('stand_status', {}))
+            # Маска текущего каталога отсекает стенды, которые еще не синхронизированы лениво
+            completed = user_data.completed_count(stand_mask)
+            total_user_stands = total_stands
 
-            # Квалифицированные участники - те кто прошел все стенды И добавил ВК
-            if completed >= total_stands and user_data.get('vk_verified', False):
+            # Индекс может на мгновение отставать от смены каталога стендов
+            if completed >= total_stands:
                 qualified_participants.append({
                     'user_id': user_id,
                     'full_name': user_data.get('full_name'),
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""Очередь исходящих вызовов Bot API с ограничением скорости по лимитам Telegram."""
+
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional
+
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity про запас."""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Через сколько секунд будет доступен токен."""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class _Chat:
+    """Очередь вызовов одного чата и его ведро токенов."""
+
+    __slots__ = ('queue', 'bucket', 'busy', 'scheduled')
+
+    def __init__(self, bucket: TokenBucket):
+        # Элементы: [method, data, future, attempts]
+        self.queue: deque = deque()
+        self.bucket = bucket
+        # Вызов чата выполняется одним из потоков - следующий ждет его результата
+        self.busy = False
+        # Чат стоит в куче готовности
+        self.scheduled = False
+
+
+class OutboundScheduler:
+    """Отправляет вызовы Bot API фоновыми потоками, не превышая лимиты Telegram.
+
+    Общее ведро ограничивает скорость всех вызовов (около 30 в секунду), ведро
+    чата - скорость в один чат (около 1 в секунду с небольшим запасом). Вызовы
+    одного чата отправляются строго по очереди. Ответ 429 приостанавливает
+    все отправки на retry_after секунд, после чего тот же вызов повторяется;
+    сетевые ошибки и ошибки 5xx повторяются до max_attempts раз. submit()
+    не блокируется и возвращает Future с ответом Telegram (None, если вызов
+    так и не удался).
+    """
+
+    def __init__(self, send: Callable[[str, Dict[str, Any]], Optional[Dict[str, Any]]],
+                 global_rate: float = 30.0, chat_rate: float = 1.0, chat_burst: float = 3.0,
+                 workers: int = 4, max_attempts: int = 3, name: str = 'outbound'):
+        self.send = send
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_attempts = max_attempts
+        self._cond = threading.Condition()
+        self._chats: Dict[Any, _Chat] = {}
+        # Куча (время готовности, порядковый номер, id чата) для чатов с ожидающими вызовами
+        self._ready: List[tuple] = []
+        self._seq = itertools.count()
+        # До этого момента (после 429) ничего не отправляется
+        self._paused_until = 0.0
+        # Вызовы в очередях, включая выполняющиеся
+        self._queued = 0
+        self._last_prune = time.monotonic()
+        self._stopping = False
+        self._closed = False
+        self.stats = {'sent': 0, 'failed': 0, 'retried': 0, 'rate_limited': 0}
+        self._threads = [
+            threading.Thread(target=self._work, name=f'{name}-{index}', daemon=True)
+            for index in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, chat_id: Any, method: str, data: Dict[str, Any]) -> Future:
+        """Ставит вызов в очередь чата и сразу возвращает Future с ответом."""
+        future: Future = Future()
+        with self._cond:
+            if self._closed:
+                future.set_result(None)
+                return future
+            chat = self._chats.get(chat_id)
+            if chat is None:
+                chat = self._chats[chat_id] = _Chat(TokenBucket(self.chat_rate, self.chat_burst))
+            chat.queue.append([method, data, future, 0])
+            self._queued += 1
+            if not chat.busy and not chat.scheduled:
+                self._schedule(chat_id, chat, time.monotonic())
+            self._cond.notify()
+        return future
+
+    def pending(self) -> int:
+        with self._cond:
+            return self._queued
+
+    def _schedule(self, chat_id: Any, chat: _Chat, now: float, delay: float = 0.0):
+        chat.scheduled = True
+        ready_at = now + max(delay, chat.bucket.delay(now))
+        heapq.heappush(self._ready, (ready_at, next(self._seq), chat_id))
+
+    def _next(self):
+        """Ждет вызов, который можно отправить; None - пора завершаться."""
+        with self._cond:
+            while True:
+                if self._closed or (self._stopping and not self._queued):
+                    return None
+                if not self._ready:
+                    self._cond.wait()
+                    continue
+                now = time.monotonic()
+                ready_at = max(self._ready[0][0], self._paused_until, now + self.global_bucket.delay(now))
+                if ready_at > now:
+                    self._cond.wait(ready_at - now)
+                    continue
+                _, _, chat_id = heapq.heappop(self._ready)
+                chat = self._chats[chat_id]
+                chat.scheduled = False
+                chat.busy = True
+                chat.bucket.take(now)
+                self.global_bucket.take(now)
+                return chat_id, chat, chat.queue[0]
+
+    def _work(self):
+        while True:
+            job = self._next()
+            if job is None:
+                return
+            chat_id, chat, item = job
+            try:
+                result = self.send(item[0], item[1])
+            except Exception as e:
+                print(f"[Outbound] Error calling {item[0]}: {e}")
+                result = None
+            future = self._finish(chat_id, chat, item, result)
+            if future is not None:
+                future.set_result(result)
+
+    def _finish(self, chat_id: Any, chat: _Chat, item: list, result: Optional[Dict[str, Any]]) -> Optional[Future]:
+        """Учитывает результат вызова; возвращает Future, если вызов завершен."""
+        with self._cond:
+            if self._closed:
+                # Future уже завершен в stop()
+                return None
+            chat.busy = False
+            now = time.monotonic()
+            error_code = result.get('error_code') if result else None
+            done = None
+            delay = 0.0
+            if error_code == 429:
+                retry_after = (result.get('parameters') or {}).get('retry_after', 1)
+                self._paused_until = max(self._paused_until, now + retry_after)
+                self.stats['rate_limited'] += 1
+                print(f"[Outbound] Rate limited by Telegram, pausing sends for {retry_after}s")
+            elif (result is None or (error_code or 0) >= 500) and item[3] + 1 < self.max_attempts:
+                item[3] += 1
+                delay = float(2 ** (item[3] - 1))
+                self.stats['retried'] += 1
+            else:
+                chat.queue.popleft()
+                self._queued -= 1
+                self.stats['sent' if result and result.get('ok') else 'failed'] += 1
+                done = item[2]
+
+            if chat.queue:
+                self._schedule(chat_id, chat, now, delay)
+            if now - self._last_prune > 60:
+                self._prune(now)
+            self._cond.notify_all()
+            return done
+
+    def _prune(self, now: float):
+        """Забывает чаты без вызовов, чьи ведра уже полностью восстановились."""
+        self._last_prune = now
+        for chat_id in [chat_id for chat_id, chat in self._chats.items()
+                        if not chat.queue and not chat.busy and chat.bucket.full(now)]:
+            del self._chats[chat_id]
+
+    def stop(self, timeout: float = 10.0):
+        """Досылает очередь (не дольше timeout) и останавливает потоки."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+        with self._cond:
+            self._closed = True
+            dropped = [item[2] for chat in self._chats.values() for item in chat.queue]
+            self._chats.clear()
+            self._ready.clear()
+            self._queued = 0
+            self._cond.notify_all()
+        for future in dropped:
+            future.set_result(None)
+        if dropped:
+            print(f"[Outbound] Dropped {len(dropped)} unsent calls on stop")
+        print(f"[Outbound] Stopped: {self.stats}")
@@ -1,208 +1,1127 @@
 #!/usr/bin/env python3
 """Единый источник данных с автоматической синхронизацией в реальном времени."""
 
+import atexit
 import json
+import sqlite3
 import threading
 import time
 import os
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from collections.abc import Mapping
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Any, Dict, Optional, Callable
+from types import MappingProxyType
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Callable, Tuple
 from datetime import datetime
-from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
+from itertools import islice
+from math import isqrt
 from dotenv import load_dotenv
 
+from binary_snapshot import LazyUsers
+from change_detector import ChangeDetector, file_signature
+from state_storage import ColdStore, StateStorage, create_storage
+from user_record import UserRecord, now, stand_bits, to_json
+
 # Загружаем переменные окружения
 load_dotenv()
 
-class StateChangeHandler(FileSystemEventHandler):
-    """Обработчик изменений файла состояния."""
-
-    def __init__(self, callback: Callable):
-        self.callback = callback
-        self.last_modified = 0
-
-    def on_modified(self, event):
-        if event.is_directory:
+# Пауза перед повторной записью после ошибки: растет вдвое до FLUSH_RETRY_MAX
+FLUSH_RETRY_BASE = 0.5
+FLUSH_RETRY_MAX = 30.0
+# Сколько stop() ждет записи накопленных изменений
+STOP_FLUSH_TIMEOUT = 10.0
+
+class StateChangeEvent:
+    """Небольшое описание изменения состояния для подписчиков.
+
+    user_ids - измененные пользователи, fields - измененные поля по каждому
+    пользователю (пустое множество - пользователь удален), stands_changed -
+    сменился каталог стендов, cleared - все данные очищены, version - номер
+    последнего изменения, вошедшего в событие.
+    """
+
+    __slots__ = ('version', 'user_ids', 'fields', 'stands_changed', 'cleared')
+
+    def __init__(self, version: int, fields: Optional[Dict[str, frozenset]] = None,
+                 stands_changed: bool = False, cleared: bool = False):
+        self.version = version
+        self.fields: Dict[str, frozenset] = fields or {}
+        self.user_ids = frozenset(self.fields)
+        self.stands_changed = stands_changed
+        self.cleared = cleared
+
+    def merge(self, other: 'StateChangeEvent') -> 'StateChangeEvent':
+        """Объединяет два события в одно (для пачки изменений)."""
+        if other.cleared:
+            fields = dict(other.fields)
+        else:
+            fields = dict(self.fields)
+            for user_id, changed in other.fields.items():
+                fields[user_id] = fields.get(user_id, frozenset()) | changed
+        return StateChangeEvent(
+            max(self.version, other.version),
+            fields,
+            stands_changed=self.stands_changed or other.stands_changed,
+            cleared=self.cleared or other.cleared,
+        )
+
+    def __repr__(self):
+        return (f"StateChangeEvent(version={self.version}, users={len(self.user_ids)}, "
+                f"stands_changed={self.stands_changed}, cleared={self.cleared})")
+
+# Пользователь удален в слое изменений SnapshotUsers
+_DELETED = object()
+
+
+class SnapshotUsers(Mapping):
+    """Неизменяемый словарь пользователей снимка: общая база и слой изменений поверх нее.
+
+    Следующий снимок копирует только слой изменений и добавляет в него
+    измененных пользователей, а не копирует ссылки на всех. Когда слой
+    вырастает больше корня из размера базы, он сливается с базой вне
+    блокировки состояния (folded), так что на измененного пользователя
+    приходится O(sqrt(N)) копирований.
+    """
+
+    __slots__ = ('base', 'changes', '_len')
+
+    def __init__(self, base: Dict[str, UserRecord], changes: Optional[Dict[str, Any]] = None,
+                 length: Optional[int] = None):
+        self.base = base
+        self.changes = changes or {}
+        self._len = len(base) if length is None else length
+
+    def __getitem__(self, key: str) -> UserRecord:
+        value = self.changes.get(key)
+        if value is None:
+            return self.base[key]
+        if value is _DELETED:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key: Any) -> bool:
+        value = self.changes.get(key)
+        if value is None:
+            return key in self.base
+        return value is not _DELETED
+
+    def __iter__(self) -> Iterator[str]:
+        changes = self.changes
+        for key in self.base:
+            if key not in changes:
+                yield key
+        for key, value in changes.items():
+            if value is not _DELETED:
+                yield key
+
+    def __len__(self) -> int:
+        return self._len
+
+    def with_changes(self, updates: Dict[str, Optional[UserRecord]]) -> 'SnapshotUsers':
+        """Новый словарь с замененными записями (None - пользователь удален)."""
+        changes = dict(self.changes)
+        length = self._len
+        for key, value in updates.items():
+            length -= key in self
+            if value is not None:
+                changes[key] = value
+                length += 1
+            elif key in self.base:
+                changes[key] = _DELETED
+            else:
+                changes.pop(key, None)
+        return SnapshotUsers(self.base, changes, length)
+
+    def needs_fold(self) -> bool:
+        return len(self.changes) > max(64, isqrt(len(self.base)))
+
+    def folded(self) -> 'SnapshotUsers':
+        """Тот же словарь одной базой без слоя изменений."""
+        base = dict(self.base)
+        for key, value in self.changes.items():
+            if value is _DELETED:
+                base.pop(key, None)
+            else:
+                base[key] = value
+        return SnapshotUsers(base)
+
+
+class StateSnapshot:
+    """Неизменяемый снимок состояния для чтения без блокировки.
+
+    Записи пользователей в снимке общие с менеджером: менеджер никогда не
+    изменяет сохраненную запись, а заменяет ее копией (copy-on-write), поэтому
+    снимок остается согласованным, пока его читают.
+    """
+
+    __slots__ = ('version', 'users', 'stats')
+
+    def __init__(self, version: int, users: Mapping, stats: Mapping):
+        self.version = version
+        self.users = users if isinstance(users, SnapshotUsers) else MappingProxyType(users)
+        self.stats = MappingProxyType(stats)
+
+    def __len__(self) -> int:
+        return len(self.users)
+
+    def __repr__(self):
+        return f"StateSnapshot(version={self.version}, users={len(self.users)})"
+
+class StatsAggregator:
+    """Поддерживаемые счетчики статистики, чтобы get_stats не обходил всех пользователей.
+
+    Для каждого пользователя хранится его текущий вклад в счетчики; при изменении
+    пользователя старый вклад вычитается и добавляется новый.
+    """
+
+    def __init__(self, stand_ids: tuple = ()):
+        self.reset(stand_ids)
+
+    def reset(self, stand_ids: tuple):
+        # Прогресс считается по текущему каталогу, даже если stand_status пользователя
+        # еще не приведен к нему (приведение выполняется лениво в get_user)
+        self.stand_ids = tuple(stand_ids)
+        self.stand_mask = stand_bits.mask(self.stand_ids)
+        self.total_stands = len(self.stand_ids)
+        self.total_users = 0
+        self.completed_users = 0
+        self.qualified_users = 0
+        self.vk_verified_users = 0
+        self.users_with_pending_questions = 0
+        self.progress_sum = 0.0
+        self._contributions: Dict[str, tuple] = {}
+
+    def _contribution(self, user_data: UserRecord) -> tuple:
+        """Вклад пользователя: (завершил, квалифицирован, ВК, ждет ответа, прогресс %)."""
+        completed = user_data.completed_count(self.stand_mask)
+        progress = (completed / self.total_stands * 100) if self.total_stands else 0
+        is_completed = completed >= self.total_stands
+        vk_verified = bool(user_data.get('vk_verified', False))
+        return (
+            int(is_completed),
+            int(vk_verified and is_completed),
+            int(vk_verified),
+            int(bool(user_data.get('pending_question'))),
+            progress,
+        )
+
+    def _apply(self, contribution: tuple, sign: int):
+        completed, qualified, vk_verified, pending, progress = contribution
+        self.total_users += sign
+        self.completed_users += sign * completed
+        self.qualified_users += sign * qualified
+        self.vk_verified_users += sign * vk_verified
+        self.users_with_pending_questions += sign * pending
+        self.progress_sum += sign * progress
+
+    def update(self, key: str, user_data: Optional[UserRecord]):
+        """Пересчитывает вклад одного пользователя. user_data=None - пользователь удален."""
+        if key == 'meta':
             return
-
-        if event.src_path.endswith('state.json') or event.src_path.endswith('stands.json'):
-            current_time = time.time()
-            # Защита от множественных событий
-            if current_time - self.last_modified > 0.5:
-                self.last_modified = current_time
-                self.callback()
+        old = self._contributions.pop(key, None)
+        if old is not None:
+            self._apply(old, -1)
+        if user_data is not None:
+            new = self._contribution(user_data)
+            self._contributions[key] = new
+            self._apply(new, 1)
+        if self.total_users == 0:
+            # Сбрасываем накопленную погрешность сложения float
+            self.progress_sum = 0.0
+
+    def rebuild(self, users: Iterable[Tuple[str, Any]], stand_ids: tuple):
+        """Полностью пересчитывает счетчики по парам (id, данные)."""
+        self.reset(stand_ids)
+        for key, user_data in users:
+            self.update(key, user_data)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            'timestamp': datetime.now().isoformat(),
+            'total_users': self.total_users,
+            'total_stands': self.total_stands,
+            'completed_users': self.completed_users,
+            'qualified_users': self.qualified_users,
+            'vk_verified_users': self.vk_verified_users,
+            'users_with_pending_questions': self.users_with_pending_questions,
+            'average_progress': round(self.progress_sum / self.total_users, 1) if self.total_users else 0.0
+        }
+
+class UserIndex:
+    """Вторичные индексы пользователей, чтобы запросы не обходили всех.
+
+    qualified - прошли все стенды текущего каталога и подтвердили ВК,
+    pending_question - есть активный вопрос, awaiting_* - бот ждет ввода.
+    by_updated - отсортированный список (updated_at, id) для выдачи недавно
+    измененных. Как и счетчики статистики, обновляется по одному пользователю.
+    """
+
+    SETS = ('qualified', 'pending_question', 'awaiting_name', 'awaiting_vk_link')
+
+    def __init__(self, stand_ids: tuple = ()):
+        self.reset(stand_ids)
+
+    def reset(self, stand_ids: tuple):
+        self.stand_mask = stand_bits.mask(stand_ids)
+        self.total_stands = len(tuple(stand_ids))
+        self.sets: Dict[str, set] = {name: set() for name in self.SETS}
+        self.by_updated: List[Tuple[float, str]] = []
+        self._updated: Dict[str, float] = {}
+
+    def _memberships(self, user_data: UserRecord) -> Tuple[bool, ...]:
+        vk_verified = bool(user_data.get('vk_verified', False))
+        return (
+            vk_verified and user_data.completed_count(self.stand_mask) >= self.total_stands,
+            bool(user_data.get('pending_question')),
+            bool(user_data.get('awaiting_name', False)),
+            bool(user_data.get('awaiting_vk_link', False)),
+        )
+
+    @staticmethod
+    def _updated_key(user_data: UserRecord) -> float:
+        # Время без epoch (отсутствует или не разобрано) считается самым старым
+        updated_at = user_data.updated_at
+        return updated_at if isinstance(updated_at, float) else 0.0
+
+    def update(self, key: str, user_data: Optional[UserRecord]):
+        """Переносит одного пользователя в индексах. user_data=None - пользователь удален."""
+        if key == 'meta':
+            return
+        old = self._updated.pop(key, None)
+        if old is not None:
+            del self.by_updated[bisect_left(self.by_updated, (old, key))]
+        if user_data is None:
+            for members in self.sets.values():
+                members.discard(key)
+            return
+        for name, member in zip(self.SETS, self._memberships(user_data)):
+            if member:
+                self.sets[name].add(key)
+            else:
+                self.sets[name].discard(key)
+        updated = self._updated[key] = self._updated_key(user_data)
+        insort(self.by_updated, (updated, key))
+
+    def rebuild(self, users: Iterable[Tuple[str, Any]], stand_ids: tuple):
+        """Полностью перестраивает индексы по парам (id, данные)."""
+        self.reset(stand_ids)
+        for key, user_data in users:
+            if key == 'meta':
+                continue
+            for name, member in zip(self.SETS, self._memberships(user_data)):
+                if member:
+                    self.sets[name].add(key)
+            self._updated[key] = self._updated_key(user_data)
+        self.by_updated = sorted((updated, key) for key, updated in self._updated.items())
+
+    def query(self, index: str, limit: Optional[int] = None) -> List[str]:
+        """Id пользователей из индекса: 'recent' - от последних измененных, остальные - по id."""
+        if index == 'recent':
+            newest = reversed(self.by_updated)
+            if limit is not None:
+                newest = islice(newest, limit)
+            return [key for _, key in newest]
+        if index not in self.sets:
+            raise ValueError(f'unknown user index: {index}')
+        keys = sorted(self.sets[index])
+        return keys if limit is None else keys[:limit]
+
+def _changed_fields(old: Optional[UserRecord], new: Optional[UserRecord]) -> frozenset:
+    """Поля, отличающиеся в двух версиях записи пользователя."""
+    if new is None:
+        return frozenset()
+    if old is None:
+        return frozenset(new.keys())
+    return old.diff(new)
+
+def _decode_users(raw: Dict[str, Any]) -> Dict[str, Any]:
+    """JSON-словарь состояния -> пользователи в виде UserRecord (служебный 'meta' как есть).
+
+    Ленивый словарь из бинарного снимка декодирует записи сам; здесь
+    преобразуются только наложенные поверх него записи журнала.
+    """
+    if isinstance(raw, LazyUsers):
+        overlay = raw.overlay()
+        for key, value in overlay.items():
+            if key != 'meta' and not isinstance(value, UserRecord):
+                overlay[key] = UserRecord.from_dict(value)
+        return raw
+    return {
+        key: value if key == 'meta' else UserRecord.from_dict(value)
+        for key, value in raw.items()
+    }
 
 class RealtimeStateManager:
     """Менеджер состояния с автоматической синхронизацией в реальном времени."""
 
-    def __init__(self, state_file_path: str = 'data/state.json'):
+    def __init__(self, state_file_path: str = 'data/state.json', storage_mode: str = 'json',
+                 compact_interval: float = 30.0, flush_interval: float = 0.05,
+                 storage_options: Optional[Dict[str, Any]] = None,
+                 hot_capacity: Optional[int] = None, cold_ttl: Optional[float] = None,
+                 cold_check_interval: float = 30.0):
         self.state_file_path = Path(state_file_path)
         self.data: Dict[str, Any] = {}
         self.subscribers: list[Callable] = []
         self.lock = threading.RLock()
-        self._observer = None
-        self._periodic_timer = None
-        self._last_file_mtime = 0
+        self._change_detector: Optional[ChangeDetector] = None
+        self._stop_event = threading.Event()
+        self.storage: StateStorage = create_storage(storage_mode, self.state_file_path, **(storage_options or {}))
+        self.compact_interval = compact_interval
+        self.flush_interval = flush_interval
+
+        # Состояние отложенной записи: изменения копятся и пишутся одним пакетом
+        self._flush_cond = threading.Condition(self.lock)
+        # Ключ -> измененные поля (None - вся запись); нужны для слияния с чужими записями
+        self._dirty: Dict[str, Optional[set]] = {}
+        self._dirty_full = False
+        self._compact_requested = False
+        # Подписи файлов хранилища на момент последнего чтения или своей записи
+        self._applied_signatures: Optional[dict] = None
+        self._dirty_generation = 0
+        self._flushed_generation = 0
+        self._flush_requested = False
+        self._flusher_thread = None
+        # Ошибки записи подряд и момент, раньше которого запись не повторяется
+        self._write_failures = 0
+        self._retry_at = 0.0
+
+        # Многоуровневое хранение: в памяти и основном хранилище - только горячие
+        # пользователи (не больше hot_capacity, активные за cold_ttl секунд,
+        # еще не квалифицированные), остальные - в холодном хранилище state.cold.db
+        self.hot_capacity = hot_capacity
+        self.cold_ttl = cold_ttl
+        self.cold_check_interval = cold_check_interval
+        self.cold: Optional[ColdStore] = None
+        if hot_capacity is not None or cold_ttl is not None:
+            self.cold = ColdStore(self.state_file_path.with_suffix('.cold.db'))
+        # Пользователи, которые сейчас только в холодном хранилище, и последнее
+        # учтенное изменение холодного хранилища
+        self._cold_keys: set = set()
+        self._cold_seq = 0
+        # Горячие пользователи от давно не использованных к недавним: id -> время обращения
+        self._lru: 'OrderedDict[str, float]' = OrderedDict()
+        self._evict_requested = False
+
+        # Уведомления подписчиков: события копятся и рассылаются отдельным потоком
+        self.version = 0
+        self._notify_cond = threading.Condition(threading.Lock())
+        self._pending_event: Optional[StateChangeEvent] = None
+        self._notifier_thread = threading.Thread(target=self._notify_loop, name='state-notifier', daemon=True)
+        self._notifier_thread.start()
+
+        # Счетчики для get_stats и индексы для query_users
+        self._stats = StatsAggregator()
+        self._index = UserIndex()
+        self._stats_catalog_version = 0
+
+        # Версия каталога стендов, с которой последний раз сверялся каждый пользователь
+        self._reconciled_versions: Dict[str, int] = {}
+
+        # Снимок для читателей без блокировки; публикуется фоновым потоком записи
+        self._snapshot = StateSnapshot(0, SnapshotUsers({}), self._stats.as_dict())
+        self._snapshot_stale = False
+        # Пользователи, измененные после публикации снимка (None - нужен снимок заново)
+        self._snapshot_changed: Optional[set] = set()
+        # Сброшено, пока данные декодируются из бинарного снимка: статистика,
+        # индексы и снимок для читателей построены только после этого
+        self._warm_event = threading.Event()
+        self._warm_event.set()
 
         # Создаем директорию если не существует
         self.state_file_path.parent.mkdir(parents=True, exist_ok=True)
 
-        # Загружаем данные
-        self._load()
+        # Запускаем фоновую запись
+        self._start_flusher()
 
-        # Запускаем мониторинг файла
-        self._start_file_monitoring()
+        # Загружаем данные
+        with self.storage.lock, self.lock:
+            self._load()
+            self._publish_snapshot()
 
-        # Запускаем периодическую проверку
-        self._start_periodic_check()
+        # Запускаем отслеживание изменений другими процессами
+        self._start_change_detection()
 
     def _load(self):
         """Загружает данные из файла."""
         with self.lock:
-            if self.state_file_path.exists():
+            self._mark_snapshot_stale()
+            self._applied_signatures = self._storage_signatures()
+            if self.storage.exists():
                 try:
-                    # Обновляем время модификации файла
-                    self._last_file_mtime = self.state_file_path.stat().st_mtime
-
-                    with open(self.state_file_path, 'r', encoding='utf-8') as f:
-                        self.data = json.load(f)
-                    print(f"[RealtimeState] Loaded state from {self.state_file_path}")
-                except (json.JSONDecodeError, OSError) as e:
+                    self.data = _decode_users(self.storage.load())
+                    self._reconciled_versions.clear()
+                    self._load_cold_keys()
+                    if self._warming:
+                        print(f"[RealtimeState] Opened binary snapshot of {self.storage.files()[0]} "
+                              f"({len(self.data)} records, decoding in background)")
+                        self._warm_event.clear()
+                        self._start_warm_up(self.data)
+                        return
+                    print(f"[RealtimeState] Loaded state from {self.storage.files()[0]} ({self.storage.mode})")
+                except (json.JSONDecodeError, OSError, sqlite3.Error) as e:
                     print(f"[RealtimeState] Error loading state: {e}")
                     self.data = {}
             else:
                 print(f"[RealtimeState] Creating new state file at {self.state_file_path}")
                 self.data = {}
+                self._reconciled_versions.clear()
+                self._load_cold_keys()
                 self._save()
 
-    def _save(self):
-        """Сохраняет данные в файл."""
-        try:
-            # Создаем временный файл для атомарной записи
-            temp_path = self.state_file_path.with_suffix('.tmp')
-            with open(temp_path, 'w', encoding='utf-8') as f:
-                json.dump(self.data, f, ensure_ascii=False, indent=2)
-
-            # Атомарно заменяем файл
-            temp_path.replace(self.state_file_path)
-
-            # Добавляем небольшую задержку чтобы файловая система успела обработать событие
-            import time
-            time.sleep(0.1)
+            self._rebuild_stats()
+            self._reset_lru()
+            self._warm_event.set()
 
-            print(f"[RealtimeState] Saved state to {self.state_file_path} (users: {len([k for k in self.data.keys() if k != 'meta'])})")
-
-        except Exception as e:
-            print(f"[RealtimeState] Error saving state: {e}")
-            # Если не можем сохранить в основной файл, попробуем в temp
+    def _load_cold_keys(self):
+        """Запоминает пользователей, которые есть только в холодном хранилище."""
+        if self.cold is None:
+            return
+        self._cold_seq = self.cold.last_seq()
+        # Если пользователь есть в обоих хранилищах, действует горячая запись
+        self._cold_keys = {key for key in self.cold.keys() if key not in self.data}
+
+    def _apply_cold_changes(self):
+        """Учитывает пользователей, перенесенных в холодное хранилище другими процессами,
+        включая тех, кого этот процесс не успел увидеть в основном хранилище."""
+        if self.cold is None:
+            return
+        changes, self._cold_seq = self.cold.changes(self._cold_seq)
+        fields = {}
+        for key, value in changes.items():
+            if key in self.data:
+                continue
+            user_data = UserRecord.from_dict(value)
+            # Вклад пользователя пересчитывается: запись могла измениться до переноса
+            self._stats.update(key, user_data)
+            self._index.update(key, user_data)
+            if key not in self._cold_keys:
+                self._cold_keys.add(key)
+                fields[key] = frozenset(user_data.keys())
+        if fields:
+            # Холодных пользователей в снимке нет - меняется только статистика
+            self._mark_snapshot_stale(())
+            self._emit(StateChangeEvent(0, fields))
+
+    def _reset_lru(self):
+        """Упорядочивает горячих пользователей по последнему обращению после загрузки;
+        для еще не использованных в этом процессе временем обращения считается updated_at."""
+        if self.cold is None:
+            return
+        accessed = sorted(
+            (max(updated, self._lru.get(key, 0.0)), key)
+            for updated, key in self._index.by_updated if key in self.data
+        )
+        self._lru = OrderedDict((key, at) for at, key in accessed)
+
+    @property
+    def _warming(self) -> bool:
+        """Данные еще читаются из бинарного снимка по мере обращения."""
+        return isinstance(self.data, LazyUsers)
+
+    def _start_warm_up(self, data: LazyUsers):
+        threading.Thread(target=self._warm_up, args=(data,), name='state-warm-up', daemon=True).start()
+
+    def _warm_up(self, data: LazyUsers, chunk_size: int = 1000):
+        """Декодирует оставшиеся записи снимка в фоне и переходит на обычный словарь.
+
+        Декодирование идет без блокировки (снимок неизменяем), под блокировкой
+        записи только подкладываются, если их еще не прочитали или не изменили.
+        До окончания статистика, индексы и снимок для читателей не строятся,
+        а читающие их вызовы ждут (см. _wait_warm).
+        """
+        started = time.time()
+        base, overlay = data.base, data.overlay()
+        entries = base.entries()
+        while True:
+            chunk = list(islice(entries, chunk_size))
+            if not chunk:
+                break
+            decoded = [(key, base.decode(key, raw)) for key, raw in chunk if key not in overlay]
+            with self.lock:
+                if self.data is not data:
+                    return
+                for key, value in decoded:
+                    data.promote(key, value)
+        with self.lock:
+            if self.data is not data:
+                return
+            self.data = dict(data.overlay())
+            self._rebuild_stats()
+            self._reset_lru()
+            self._publish_snapshot()
+            self._warm_event.set()
+        print(f"[RealtimeState] Decoded {len(base)} records from binary snapshot in {time.time() - started:.2f}s")
+
+    def _wait_warm(self):
+        """Дожидается окончания декодирования бинарного снимка.
+
+        Нужна перед чтением статистики, индексов и снимка: до окончания они
+        пусты. Нельзя вызывать под блокировкой состояния - она нужна декодированию.
+        """
+        if not self._warm_event.is_set():
+            self._warm_event.wait()
+
+    def _storage_signatures(self) -> dict:
+        return {path: file_signature(path) for path in self.storage.files()}
+
+    def _rebuild_stats(self):
+        """Полностью пересчитывает счетчики статистики и индексы пользователей."""
+        with self.lock:
             try:
-                backup_path = Path(f'/tmp/state_backup_{int(time.time())}.json')
-                with open(backup_path, 'w', encoding='utf-8') as f:
-                    json.dump(self.data, f, ensure_ascii=False, indent=2)
-                print(f"[RealtimeState] Saved backup to {backup_path}")
+                from config import get_stand_catalog
+                catalog = get_stand_catalog()
+                stand_ids, version = catalog.ids, catalog.version
             except:
-                print("[RealtimeState] Failed to save backup!")
+                stand_ids, version = (), 0
+            self._stats.rebuild(self._iter_records(), stand_ids)
+            self._index.rebuild(self._iter_records(), stand_ids)
+            self._stats_catalog_version = version
+            self._mark_snapshot_stale(())
+
+    def _iter_records(self) -> Iterator[Tuple[str, Any]]:
+        """Все записи: горячие из памяти и холодные из холодного хранилища."""
+        yield from self.data.items()
+        if self.cold is not None:
+            for key, value in self.cold.items():
+                if key in self._cold_keys:
+                    yield key, UserRecord.from_dict(value)
+
+    def _touch(self, key: str):
+        """Отмечает обращение к горячему пользователю для вытеснения по давности."""
+        if self.cold is None:
+            return
+        self._lru[key] = time.time()
+        self._lru.move_to_end(key)
+        if self.hot_capacity is not None and len(self._lru) > self.hot_capacity:
+            self._request_eviction()
+
+    def _request_eviction(self):
+        with self._flush_cond:
+            self._evict_requested = True
+            self._flush_cond.notify_all()
+
+    def _ensure_hot(self, key: str) -> bool:
+        """Есть ли пользователь в памяти; холодный пользователь поднимается из холодного хранилища."""
+        if key in self.data:
+            return True
+        if key not in self._cold_keys:
+            return False
+        self._cold_keys.discard(key)
+        user_data = self.cold.get(key)
+        if user_data is None:
+            print(f"[RealtimeState] Warning: user {key} is missing from cold storage")
+            return False
+        self.data[key] = UserRecord.from_dict(user_data)
+        self._touch(key)
+        self._mark_snapshot_stale((key,))
+        # Пользователь возвращается в основное хранилище; пустой набор полей - если
+        # другой процесс уже поднял его и изменил, при слиянии победит его запись
+        self._save({key}, ())
+        print(f"[RealtimeState] Loaded user {key} from cold storage")
+        return True
+
+    def _evict_cold(self):
+        """Переносит в холодное хранилище квалифицированных, неактивных дольше cold_ttl
+        и лишних сверх hot_capacity пользователей.
+
+        Вызывается при записи под межпроцессной блокировкой хранилища: сначала
+        записи фиксируются в холодном хранилище, затем их удаление попадает в
+        ту же запись основного хранилища. Пользователи с незаписанными
+        изменениями остаются до следующей проверки.
+        """
+        self._evict_requested = False
+        if self.cold is None or self._warming:
+            return
+        evicted = [key for key in self._index.sets['qualified'] if key in self.data and key not in self._dirty]
+        chosen = set(evicted)
+        remaining = len(self.data) - ('meta' in self.data) - len(evicted)
+        now_ts = time.time()
+        for key, accessed in list(self._lru.items()):
+            if key not in self.data:
+                del self._lru[key]
+                continue
+            over_capacity = self.hot_capacity is not None and remaining > self.hot_capacity
+            idle = self.cold_ttl is not None and now_ts - accessed >= self.cold_ttl
+            if not (over_capacity or idle):
+                break
+            if key in chosen or key in self._dirty:
+                continue
+            evicted.append(key)
+            chosen.add(key)
+            remaining -= 1
+        if not evicted:
+            return
+
+        self.cold.put_many({key: self.data[key] for key in evicted})
+        for key in evicted:
+            del self.data[key]
+            self._lru.pop(key, None)
+            self._reconciled_versions.pop(key, None)
+            self._cold_keys.add(key)
+            # Пользователь не изменился: статистика и индексы остаются прежними
+            self._dirty[key] = None
+        self._dirty_generation += 1
+        self._mark_snapshot_stale(evicted)
+        print(f"[RealtimeState] Moved {len(evicted)} users to cold storage ({remaining} hot)")
+
+    def _user_changed(self, key: str, fields=None):
+        """Обновляет производные структуры после изменения одного пользователя.
+
+        fields - измененные поля; None означает, что изменилась вся запись.
+        """
+        user_data = self.data.get(key)
+        self._stats.update(key, user_data)
+        self._index.update(key, user_data)
+        self._mark_snapshot_stale((key,))
+        if key == 'meta':
+            return
+        if fields is None:
+            fields = user_data.keys() if user_data is not None else ()
+        self._emit(StateChangeEvent(0, {key: frozenset(fields)}))
+
+    def _mark_snapshot_stale(self, keys: Optional[Iterable[str]] = None):
+        """Просит фоновый поток опубликовать новый снимок (вызывается под блокировкой).
+
+        keys - измененные пользователи (пусто - только статистика), None - все данные.
+        """
+        if keys is None:
+            self._snapshot_changed = None
+        elif self._snapshot_changed is not None:
+            self._snapshot_changed.update(keys)
+        self._snapshot_stale = True
+        self._flush_cond.notify_all()
+
+    def _publish_snapshot(self):
+        """Собирает и атомарно подменяет снимок для читателей (вызывается под блокировкой).
+
+        Записи общие с менеджером; в новый снимок попадают только пользователи,
+        измененные после прошлого (см. SnapshotUsers). Пока данные читаются
+        из бинарного снимка, публикация откладывается.
+        """
+        if self._warming:
+            return
+        changed = self._snapshot_changed
+        if changed is None:
+            users = SnapshotUsers({k: v for k, v in self.data.items() if k != 'meta'})
+        else:
+            users = self._snapshot.users.with_changes(
+                {key: self.data.get(key) for key in changed if key != 'meta'}
+            )
+        self._snapshot = StateSnapshot(self.version, users, self._stats.as_dict())
+        self._snapshot_changed = set()
+        self._snapshot_stale = False
+
+    def _fold_snapshot(self):
+        """Сливает слой изменений опубликованного снимка с базой вне блокировки:
+        снимок неизменяем, под блокировкой он только подменяется равным."""
+        snapshot = self._snapshot
+        if not snapshot.users.needs_fold():
+            return
+        folded = StateSnapshot(snapshot.version, snapshot.users.folded(), snapshot.stats)
+        with self.lock:
+            if self._snapshot is snapshot:
+                self._snapshot = folded
+
+    def _emit(self, event: StateChangeEvent):
+        """Ставит событие в очередь рассылки, объединяя его с еще не разосланными."""
+        with self._notify_cond:
+            self.version += 1
+            event.version = self.version
+            self._pending_event = event if self._pending_event is None else self._pending_event.merge(event)
+            self._notify_cond.notify()
+
+    def _notify_loop(self):
+        """Рассылает накопленные события подписчикам вне блокировки состояния."""
+        while True:
+            with self._notify_cond:
+                while self._pending_event is None and not self._stop_event.is_set():
+                    self._notify_cond.wait()
+                event = self._pending_event
+                self._pending_event = None
+            if event is None:
+                return
+            self._notify_subscribers(event)
+
+    def _save(self, changed: Optional[set] = None, fields=None):
+        """Помечает данные для записи. changed - ключи измененных пользователей, None - все;
+        fields - измененные поля этих пользователей, None - вся запись.
+
+        Запись выполняет фоновый поток, объединяя все изменения за flush_interval.
+        """
+        with self._flush_cond:
+            if changed is None:
+                self._dirty_full = True
+            else:
+                for key in changed:
+                    if fields is None:
+                        self._dirty[key] = None
+                    elif key not in self._dirty:
+                        self._dirty[key] = set(fields)
+                    elif self._dirty[key] is not None:
+                        self._dirty[key].update(fields)
+            self._dirty_generation += 1
+            self._flush_cond.notify_all()
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Дожидается записи на диск всех изменений, сделанных до вызова."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._flush_cond:
+            target = self._dirty_generation
+            self._flush_requested = True
+            self._flush_cond.notify_all()
+        while True:
+            with self._flush_cond:
+                if self._flushed_generation >= target:
+                    return True
+                if self._flusher_thread is not None and self._flusher_thread.is_alive():
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    self._flush_cond.wait(remaining)
+                    continue
+            # Фоновый поток остановлен - пишем сами (вне блокировки состояния,
+            # так как межпроцессная блокировка всегда берется раньше нее)
+            self._flush_pending()
+            with self._flush_cond:
+                if self._flushed_generation >= target:
+                    return True
+                if self._write_failures:
+                    # Запись не удалась - повторяем с паузой, пока не выйдет время
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is None or remaining <= 0:
+                        return False
+                    self._flush_cond.wait(min(remaining, max(0.0, self._retry_at - time.monotonic())))
+
+    def _start_flusher(self):
+        """Запускает поток отложенной записи и уплотнения хранилища."""
+        self._flusher_thread = threading.Thread(target=self._flush_loop, name='state-flusher', daemon=True)
+        self._flusher_thread.start()
+        print(f"[RealtimeState] Started {self.storage.mode} flusher (window {self.flush_interval}s)")
+
+    def _flush_loop(self):
+        """Основной цикл фоновой записи."""
+        last_compact_check = last_cold_check = time.monotonic()
+        while True:
+            with self._flush_cond:
+                while not self._has_pending() and not self._stop_event.is_set():
+                    waits = []
+                    if self.storage.compactable:
+                        waits.append(self.compact_interval - (time.monotonic() - last_compact_check))
+                    if self.cold is not None:
+                        waits.append(self.cold_check_interval - (time.monotonic() - last_cold_check))
+                    wait_for = max(0.0, min(waits)) if waits else None
+                    if wait_for == 0:
+                        break
+                    self._flush_cond.wait(wait_for)
+
+                if self._stop_event.is_set() and (not self._has_pending() or self._write_failures):
+                    # При остановке запись после ошибки не повторяем: stop() уже ждал ее
+                    return
+
+                # Окно группировки: собираем все изменения, пришедшие следом
+                if self._has_pending():
+                    deadline = time.monotonic() + self.flush_interval
+                    while not self._flush_requested and not self._stop_event.is_set():
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._flush_cond.wait(remaining)
+
+                if self.storage.compactable and time.monotonic() - last_compact_check >= self.compact_interval:
+                    last_compact_check = time.monotonic()
+                    if self.storage.should_compact():
+                        self._compact_requested = True
+                        self._dirty_generation += 1
+
+                if self.cold is not None and time.monotonic() - last_cold_check >= self.cold_check_interval:
+                    last_cold_check = time.monotonic()
+                    self._evict_requested = True
+
+                # После ошибки записи ждем паузу перед повтором (ошибка могла
+                # случиться и в другом потоке, пока шло окно группировки)
+                while self._write_failures and not self._stop_event.is_set():
+                    remaining = self._retry_at - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._flush_cond.wait(remaining)
+
+            self._flush_pending()
+            self._fold_snapshot()
+
+    def _has_writes(self) -> bool:
+        return self._dirty_full or self._compact_requested or self._evict_requested or bool(self._dirty)
+
+    def _has_pending(self) -> bool:
+        return self._has_writes() or (self._snapshot_stale and not self._warming)
+
+    def _flush_pending(self):
+        """Фиксирует накопленные изменения.
+
+        Протокол: межпроцессная блокировка хранилища -> дочитывание чужих
+        изменений с наложением своих измененных полей -> сериализация под
+        блокировкой состояния -> запись без нее -> снятие блокировки.
+        """
+        with self._flush_cond:
+            if self._snapshot_stale:
+                self._publish_snapshot()
+            if not self._has_writes():
+                self._flushed_generation = self._dirty_generation
+                self._flush_requested = False
+                self._flush_cond.notify_all()
+                return
+
+        with self.storage.lock:
+            self._commit_pending()
+
+    def _commit_pending(self):
+        """Записывает изменения; вызывается под межпроцессной блокировкой хранилища."""
+        with self._flush_cond:
+            # Другие процессы могли записать свои изменения - не затираем их
+            self._apply_foreign_changes()
+            if self._evict_requested:
+                self._evict_cold()
+            if not self._has_writes():
+                # Проверка вытеснения ничего не изменила
+                self._flushed_generation = self._dirty_generation
+                self._flush_requested = False
+                self._flush_cond.notify_all()
+                return
+            changed = None if self._dirty_full or self._compact_requested else self._dirty
+            generation = self._dirty_generation
+            users_count = len(self.data) - ('meta' in self.data)
+            try:
+                payload = self.storage.encode(self.data, changed)
+            except Exception as e:
+                print(f"[RealtimeState] Error encoding state: {e}")
+                payload = None
+            self._dirty = {}
+            self._dirty_full = False
+            self._compact_requested = False
+            self._flush_requested = False
 
-    def _start_file_monitoring(self):
-        """Запускает мониторинг изменений файла."""
         try:
-            self._observer = Observer()
-            handler = StateChangeHandler(self._on_file_changed)
-            self._observer.schedule(handler, str(self.state_file_path.parent), recursive=False)
-            self._observer.start()
-            print(f"[RealtimeState] Started file monitoring for {self.state_file_path.parent}")
+            if payload is None:
+                raise ValueError('state could not be encoded')
+            detector = self._change_detector
+            before = detector.signatures(self.storage.files()) if detector else None
+            self.storage.write(payload)
+            if detector:
+                # Своя запись не должна вызывать перезагрузку
+                detector.acknowledge(before)
+            self._applied_signatures = self._storage_signatures()
+            print(f"[RealtimeState] Saved state to {self.state_file_path} "
+                  f"(users: {users_count}, changed: {'all' if changed is None else len(changed)})")
         except Exception as e:
-            print(f"[RealtimeState] Failed to start file monitoring: {e}")
+            print(f"[RealtimeState] Error saving state: {e}")
+            self._write_failed(changed)
+            return
+
+        with self._flush_cond:
+            self._write_failures = 0
+            self._flushed_generation = max(self._flushed_generation, generation)
+            self._flush_cond.notify_all()
+
+    def _write_failed(self, changed: Optional[Dict[str, Optional[set]]]):
+        """Возвращает незаписанные изменения в очередь и откладывает повтор.
 
-    def _start_periodic_check(self):
-        """Запускает периодическую проверку изменений файла."""
-        def check_file_changes():
+        Номер записанного поколения не растет: flush() не вернет True, пока
+        данные действительно не окажутся на диске.
+        """
+        with self._flush_cond:
+            if changed is None:
+                self._dirty_full = True
+            else:
+                for key, fields in changed.items():
+                    if key not in self._dirty:
+                        self._dirty[key] = fields
+                    elif fields is None or self._dirty[key] is None:
+                        self._dirty[key] = None
+                    else:
+                        self._dirty[key].update(fields)
+            self._write_failures += 1
+            delay = min(FLUSH_RETRY_MAX, FLUSH_RETRY_BASE * 2 ** (self._write_failures - 1))
+            self._retry_at = time.monotonic() + delay
+            first_failure = self._write_failures == 1
+            self._flush_cond.notify_all()
+        print(f"[RealtimeState] Retrying write in {delay}s")
+
+        if not first_failure:
+            return
+        # Если не можем сохранить в основной файл, попробуем в temp
+        try:
+            with self.lock:
+                backup = json.dumps(self.data, ensure_ascii=False, indent=2, default=to_json)
+            backup_path = Path(f'/tmp/state_backup_{int(time.time())}.json')
+            with open(backup_path, 'w', encoding='utf-8') as f:
+                f.write(backup)
+            print(f"[RealtimeState] Saved backup to {backup_path}")
+        except:
+            print("[RealtimeState] Failed to save backup!")
+
+    def _start_change_detection(self):
+        """Запускает отслеживание файлов хранилища и каталога стендов."""
+        paths = list(self.storage.files())
+        try:
+            from config import STANDS_FILE_PATH
+            paths.append(Path(STANDS_FILE_PATH))
+        except Exception:
+            pass
+        self._change_detector = ChangeDetector(paths, self._on_files_changed)
+        self._change_detector.start()
+
+    def _on_files_changed(self, paths: list):
+        """Обрабатывает изменения файлов другими процессами (свои записи сюда не попадают)."""
+        if set(paths) & set(self.storage.files()):
+            with self.storage.lock:
+                self._apply_foreign_changes()
+
+        # Если изменились стенды, обновляем каталог (пользователи синхронизируются лениво)
+        self._refresh_stands()
+
+    def _apply_foreign_changes(self):
+        """Дочитывает чужие изменения, если файлы хранилища сменились с последнего
+        чтения или своей записи. Вызывается под межпроцессной блокировкой хранилища."""
+        with self.lock:
+            current = self._storage_signatures()
+            if current == self._applied_signatures:
+                return
+            print("[RealtimeState] State changed by another process, reloading...")
+            self._reload_changes()
+            self._applied_signatures = current
+
+    def _merge_pending(self, key: str, local: Optional[UserRecord],
+                       foreign: Optional[UserRecord]) -> Optional[UserRecord]:
+        """Накладывает еще не записанные свои поля пользователя на версию другого процесса."""
+        fields = self._dirty.get(key)
+        if fields is None or foreign is None or local is None:
+            # Запись целиком изменена локально или удалена другим процессом - оставляем свою
+            return local
+        merged = foreign.copy()
+        merged.take_fields(local, fields)
+        return merged
+
+    def _reload_all(self):
+        """Перечитывает все хранилище, накладывая еще не записанные свои поля."""
+        with self.lock:
+            old_data = self.data
+            self._load()
+            for key in self._dirty:
+                merged = self._merge_pending(key, old_data.get(key), self.data.get(key))
+                if merged is None:
+                    self.data.pop(key, None)
+                else:
+                    self.data[key] = merged
+            self._rebuild_stats()
+            # Полная перезагрузка: ищем отличающихся пользователей один раз
+            fields = {}
+            for key in old_data.keys() | self.data.keys():
+                if key not in self.data and key in self._cold_keys:
+                    # Другой процесс перенес пользователя в холодное хранилище
+                    continue
+                if key != 'meta' and old_data.get(key) != self.data.get(key):
+                    fields[key] = _changed_fields(old_data.get(key), self.data.get(key))
+            if fields:
+                self._emit(StateChangeEvent(0, fields))
+
+    def _reload_changes(self):
+        """Дочитывает изменения из хранилища, при необходимости перезагружая все."""
+        with self.lock:
             try:
-                if self.state_file_path.exists():
-                    current_mtime = self.state_file_path.stat().st_mtime
-                    if current_mtime > self._last_file_mtime:
-                        print("[RealtimeState] Periodic check detected file change")
-                        self._on_file_changed()
+                changes = self.storage.load_changes()
             except Exception as e:
-                print(f"[RealtimeState] Error in periodic check: {e}")
-
-            # Планируем следующую проверку
-            if hasattr(self, '_periodic_timer'):
-                self._periodic_timer = threading.Timer(2.0, check_file_changes)
-                self._periodic_timer.daemon = True
-                self._periodic_timer.start()
-
-        # Запускаем первую проверку
-        self._periodic_timer = threading.Timer(2.0, check_file_changes)
-        self._periodic_timer.daemon = True
-        self._periodic_timer.start()
-        print("[RealtimeState] Started periodic file check every 2 seconds")
-
-    def _on_file_changed(self):
-        """Обрабатывает изменение файла."""
-        print("[RealtimeState] File changed, reloading...")
-        old_data = self.data.copy()
-        self._load()
-
-        # Если изменились стенды, синхронизируем всех пользователей
-        self._sync_all_users_stands()
-
-        # Уведомляем подписчиков об изменениях
-        if old_data != self.data:
-            self._notify_subscribers()
-
-    def _sync_all_users_stands(self):
-        """Синхронизирует стенды для всех пользователей."""
+                print(f"[RealtimeState] Error reading incremental changes: {e}")
+                changes = None
+
+            # Еще не записанные локальные изменения не должны потеряться при перезагрузке:
+            # полная перезапись их сохранит, а измененные поля накладываются на чужую версию
+            if self._dirty_full:
+                return
+
+            if changes is None:
+                self._reload_all()
+                return
+
+            for key, user_data in changes.items():
+                if key == 'meta':
+                    if user_data is not None:
+                        self.data[key] = user_data
+                    continue
+                old_user = self.data.get(key)
+                if user_data is not None:
+                    user_data = UserRecord.from_dict(user_data)
+                if key in self._dirty:
+                    user_data = self._merge_pending(key, old_user, user_data)
+                cold_data = self.cold.get(key) if user_data is None and self.cold is not None else None
+                if cold_data is not None:
+                    # Другой процесс перенес пользователя в холодное хранилище - он не удален
+                    cold_user = UserRecord.from_dict(cold_data)
+                    self.data.pop(key, None)
+                    self._lru.pop(key, None)
+                    self._reconciled_versions.pop(key, None)
+                    self._cold_keys.add(key)
+                    self._mark_snapshot_stale((key,))
+                    if old_user != cold_user:
+                        self._stats.update(key, cold_user)
+                        self._index.update(key, cold_user)
+                        self._emit(StateChangeEvent(0, {key: _changed_fields(old_user, cold_user)}))
+                    continue
+                self._cold_keys.discard(key)
+                if user_data is old_user or (user_data is not None and old_user == user_data):
+                    # Перечитанный шард или строка могут содержать и неизмененных пользователей
+                    continue
+                self._reconciled_versions.pop(key, None)
+                if user_data is None:
+                    self.data.pop(key, None)
+                else:
+                    self.data[key] = user_data
+                self._user_changed(key, _changed_fields(old_user, user_data))
+            self._apply_cold_changes()
+            if changes:
+                print(f"[RealtimeState] Applied {len(changes)} changed users from {self.storage.mode} storage")
+
+    def _refresh_stands(self):
+        """Проверяет каталог стендов; при его смене пересчитывает статистику.
+
+        stand_status пользователей не переписывается здесь: каждый пользователь
+        приводится к новому каталогу лениво при следующем get_user.
+        """
         with self.lock:
             try:
-                from config import load_stands
-                stands = load_stands()
-                current_stand_ids = {stand['id'] for stand in stands}
-                updated_users = 0
-
-                for user_id, user_data in self.data.items():
-                    if user_id == 'meta' or 'stand_status' not in user_data:
-                        continue
-
-                    user_stand_ids = set(user_data['stand_status'].keys())
-                    needs_update = False
-
-                    # Добавляем новые стенды
-                    for stand in stands:
-                        if stand['id'] not in user_data['stand_status']:
-                            user_data['stand_status'][stand['id']] = {'done': False}
-                            needs_update = True
-                            print(f"[RealtimeState] Added stand {stand['id']} to user {user_id}")
-
-                    # Удаляем устаревшие стенды
-                    for stand_id in list(user_data['stand_status'].keys()):
-                        if stand_id not in current_stand_ids:
-                            del user_data['stand_status'][stand_id]
-                            needs_update = True
-                            print(f"[RealtimeState] Removed obsolete stand {stand_id} from user {user_id}")
-
-                    if needs_update:
-                        user_data['updated_at'] = datetime.now().isoformat()
-                        updated_users += 1
-
-                if updated_users > 0:
-                    print(f"[RealtimeState] Synced stands for {updated_users} users")
-                    self._save()
-
+                from config import refresh_stand_catalog
+                catalog = refresh_stand_catalog()
+                if catalog.version != self._stats_catalog_version:
+                    print(f"[RealtimeState] Stand catalog changed (v{catalog.version}), rebuilding stats")
+                    self._rebuild_stats()
+                    self._emit(StateChangeEvent(0, stands_changed=True))
             except Exception as e:
-                print(f"[RealtimeState] Error syncing stands: {e}")
-
-    def _notify_subscribers(self):
+                print(f"[RealtimeState] Error refreshing stands: {e}")
+
+    def _reconcile_user(self, key: str, catalog) -> bool:
+        """Приводит стенды пользователя к каталогу. Возвращает True, если что-то изменилось."""
+        self._reconciled_versions[key] = catalog.version
+        record = self.data[key].copy()
+        changed = record.reconcile(catalog.mask)
+        if changed:
+            self.data[key] = record
+            print(f"[RealtimeState] Synced stands of user {key} with catalog v{catalog.version}")
+        return changed
+
+    def _notify_subscribers(self, event: StateChangeEvent):
         """Уведомляет всех подписчиков об изменениях."""
-        for callback in self.subscribers:
+        for callback in list(self.subscribers):
             try:
-                callback(self.data)
+                callback(event)
             except Exception as e:
                 print(f"[RealtimeState] Error notifying subscriber: {e}")
 
     def subscribe(self, callback: Callable):
-        """Подписывается на изменения состояния."""
+        """Подписывается на изменения состояния.
+
+        callback вызывается из отдельного потока с StateChangeEvent; события,
+        накопившиеся пока подписчики заняты, объединяются в одно.
+        """
         self.subscribers.append(callback)
         print(f"[RealtimeState] Added subscriber: {callback.__name__}")
 
@@ -212,158 +1131,303 @@ class RealtimeStateManager:
             self.subscribers.remove(callback)
             print(f"[RealtimeState] Removed subscriber: {callback.__name__}")
 
-    def get_user(self, user_id: int) -> Dict[str, Any]:
-        """Получает данные пользователя."""
+    def get_user(self, user_id: int) -> UserRecord:
+        """Получает данные пользователя, создавая его при первом обращении.
+
+        stand_status сверяется с каталогом стендов только если каталог сменился
+        с момента последней сверки; обычное чтение ничего не записывает.
+        """
         with self.lock:
             key = str(user_id)
 
-            # Импортируем актуальную конфигурацию
+            # Берем актуальный каталог стендов из памяти
             try:
-                from config import load_stands
-                stands = load_stands()
+                from config import get_stand_catalog
+                catalog = get_stand_catalog()
             except:
-                stands = []
+                from config import StandCatalog
+                catalog = StandCatalog([], 0)
 
-            if key not in self.data:
+            if not self._ensure_hot(key):
                 print(f"[RealtimeState] Creating new user: {user_id}")
-                self.data[key] = {
-                    'full_name': None,
-                    'awaiting_name': True,
-                    'awaiting_vk_link': False,
-                    'vk_profile': None,
-                    'vk_verified': False,
-                    'stand_status': {stand['id']: {'done': False} for stand in stands},
-                    'pending_question': None,
-                    'menu_message_id': None,
-                    'giveaway_message_id': None,
-                    'last_keyboard_state': '',
-                    'created_at': datetime.now().isoformat(),
-                    'updated_at': datetime.now().isoformat()
-                }
-                self._save()
-                self._notify_subscribers()
-            else:
-                # Синхронизируем стенды пользователя с актуальной конфигурацией
-                user_data = self.data[key]
-                if 'stand_status' not in user_data:
-                    user_data['stand_status'] = {}
+                self.data[key] = UserRecord.new(catalog.mask)
+                self._reconciled_versions[key] = catalog.version
+                self._user_changed(key)
+                # Пустой набор полей: если другой процесс уже создал этого пользователя,
+                # при слиянии победит его запись
+                self._save({key}, ())
+            elif self._reconciled_versions.get(key) != catalog.version:
+                # Каталог сменился с последней сверки - синхронизируем стенды пользователя
+                if self._reconcile_user(key, catalog):
+                    self._user_changed(key, ('stand_status',))
+                    self._save({key}, ('stand_status',))
+
+            self._touch(key)
+            return self.data[key]
 
-                current_stand_ids = {stand['id'] for stand in stands}
-                user_stand_ids = set(user_data['stand_status'].keys())
+    def peek_user(self, user_id: int) -> Optional[UserRecord]:
+        """Читает пользователя без побочных эффектов: не создает, не пишет и не уведомляет.
 
-                # Добавляем новые стенды
-                for stand in stands:
-                    if stand['id'] not in user_data['stand_status']:
-                        user_data['stand_status'][stand['id']] = {'done': False}
-                        print(f"[RealtimeState] Added stand {stand['id']} to user {user_id}")
+        Если каталог стендов сменился с последней сверки, возвращается копия
+        с приведенными стендами, а сохраненная запись не меняется.
+        Возвращаемую запись нельзя изменять напрямую - используйте update_user.
+        """
+        with self.lock:
+            key = str(user_id)
+            user_data = self.data.get(key)
+            if user_data is None and key in self._cold_keys:
+                # Чтение не поднимает пользователя из холодного хранилища
+                cold_data = self.cold.get(key)
+                user_data = None if cold_data is None else UserRecord.from_dict(cold_data)
+            if user_data is None or key == 'meta':
+                return None
 
-                # Удаляем устаревшие стенды
-                for stand_id in list(user_data['stand_status'].keys()):
-                    if stand_id not in current_stand_ids:
-                        del user_data['stand_status'][stand_id]
-                        print(f"[RealtimeState] Removed obsolete stand {stand_id} from user {user_id}")
+            try:
+                from config import get_stand_catalog
+                catalog = get_stand_catalog()
+            except:
+                return user_data
 
-                # Обновляем timestamp
-                user_data['updated_at'] = datetime.now().isoformat()
+            if self._reconciled_versions.get(key) == catalog.version:
+                return user_data
 
-                if user_stand_ids != current_stand_ids:
-                    self._save()
-                    self._notify_subscribers()
+            view = user_data.copy()
+            view.reconcile(catalog.mask)
+            return view
 
-            return self.data[key]
+    def has_user(self, user_id: int) -> bool:
+        """Проверяет, есть ли пользователь, не создавая его."""
+        key = str(user_id)
+        with self.lock:
+            return key != 'meta' and (key in self.data or key in self._cold_keys)
+
+    def snapshot(self) -> StateSnapshot:
+        """Последний опубликованный снимок состояния, без блокировки.
+
+        Снимок отстает от последних изменений не больше чем на flush_interval.
+        При многоуровневом хранении в нем только горячие пользователи;
+        статистика учитывает всех. Сразу после старта с бинарного снимка
+        ждет окончания его декодирования.
+        """
+        self._wait_warm()
+        return self._snapshot
+
+    def iter_users(self) -> Iterator[Tuple[str, UserRecord]]:
+        """Перебирает пользователей (id, данные) из снимка без блокировки,
+        затем холодных пользователей из холодного хранилища.
+
+        Данные нельзя изменять напрямую.
+        """
+        users = self.snapshot().users
+        yield from users.items()
+        if self.cold is not None:
+            for key, value in self.cold.items():
+                if key not in users:
+                    yield key, UserRecord.from_dict(value)
+
+    def _commit_record(self, key: str, record: UserRecord, fields):
+        """Заменяет запись пользователя и помечает измененные поля (под блокировкой).
+
+        Сохраненную запись не меняем на месте: ее могут читать по снимку.
+        """
+        record.updated_at = now()
+        fields = [*fields, 'updated_at']
+        self.data[key] = record
+        self._touch(key)
+        self._user_changed(key, fields)
+        self._save({key}, fields)
 
     def update_user(self, user_id: int, updates: Dict[str, Any]):
         """Обновляет данные пользователя."""
         with self.lock:
             key = str(user_id)
-            if key in self.data:
-                self.data[key].update(updates)
-                self.data[key]['updated_at'] = datetime.now().isoformat()
-                self._save()
-                self._notify_subscribers()
+            if self._ensure_hot(key):
+                record = self.data[key].copy()
+                record.update(updates)
+                self._commit_record(key, record, updates.keys())
                 print(f"[RealtimeState] Updated user {user_id}: {list(updates.keys())}")
             else:
                 print(f"[RealtimeState] Warning: Tried to update non-existent user {user_id}")
 
+    def update_users(self, updates: Dict[Any, Dict[str, Any]]) -> int:
+        """Обновляет нескольких пользователей за одну операцию: {user_id: изменения}.
+
+        Все изменения попадают в одну запись хранилища и одно событие
+        подписчикам. Возвращает число обновленных пользователей.
+        """
+        updated = 0
+        with self.lock:
+            for user_id, user_updates in updates.items():
+                key = str(user_id)
+                if key == 'meta' or not self._ensure_hot(key):
+                    print(f"[RealtimeState] Warning: Tried to update non-existent user {user_id}")
+                    continue
+                record = self.data[key].copy()
+                record.update(user_updates)
+                self._commit_record(key, record, user_updates.keys())
+                updated += 1
+        print(f"[RealtimeState] Updated {updated} users in one batch")
+        return updated
+
+    @contextmanager
+    def transaction(self, user_id: int) -> Iterator[UserRecord]:
+        """Изменяет пользователя как одну операцию.
+
+        Возвращает изменяемую копию записи (пользователь создается при
+        необходимости); при выходе из блока без исключения отличающиеся поля
+        фиксируются один раз, при исключении изменения отбрасываются.
+        Блокировка состояния удерживается весь блок, поэтому в нем не стоит
+        выполнять сетевые запросы.
+        """
+        with self.lock:
+            key = str(user_id)
+            original = self.get_user(user_id)
+            record = original.copy()
+            yield record
+            fields = original.diff(record)
+            if fields:
+                self._commit_record(key, record, fields)
+                print(f"[RealtimeState] Committed transaction for user {user_id}: {sorted(fields)}")
+
     def get_all_users(self) -> Dict[str, Any]:
-        """Получает всех пользователей."""
+        """Получает всех пользователей в JSON-формате из снимка без блокировки
+        (и холодных из холодного хранилища)."""
+        return {k: v.to_dict() for k, v in self.iter_users()}
+
+    def query_users(self, index: str, limit: Optional[int] = None) -> List[Tuple[str, UserRecord]]:
+        """Пользователи (id, данные) из вторичного индекса.
+
+        index - 'qualified', 'pending_question', 'awaiting_name', 'awaiting_vk_link'
+        или 'recent' (все пользователи от последних измененных). Стоимость
+        зависит от размера ответа, а не от числа пользователей. Данные нельзя
+        изменять напрямую. Сразу после старта с бинарного снимка ждет
+        построения индексов.
+
+        Под блокировкой копируются только id из индекса; записи берутся из
+        снимка (еще не попавшие в него - из памяти, записи неизменяемы)
+        и из холодного хранилища без блокировки.
+        """
+        self._wait_warm()
         with self.lock:
-            return {k: v for k, v in self.data.items() if k != 'meta'}
+            keys = self._index.query(index, limit)
+        users = self.snapshot().users
+        found: Dict[str, UserRecord] = {}
+        cold_keys = []
+        for key in keys:
+            user_data = users.get(key)
+            if user_data is None:
+                user_data = self.data.get(key)
+            if user_data is None:
+                cold_keys.append(key)
+            else:
+                found[key] = user_data
+        if cold_keys and self.cold is not None:
+            # Холодные пользователи читаются без подъема в память
+            for key, value in self.cold.get_many(cold_keys).items():
+                found[key] = UserRecord.from_dict(value)
+        return [(key, found[key]) for key in keys if key in found]
 
     def get_stats(self) -> Dict[str, Any]:
-        """Получает актуальную статистику."""
+        """Получает статистику по поддерживаемым счетчикам (с учетом только что сделанных изменений)."""
+        self._wait_warm()
         with self.lock:
-            users = self.get_all_users()
-
-            # Импортируем актуальную конфигурацию
-            try:
-                from config import load_stands
-                stands = load_stands()
-                total_stands = len(stands)
-            except:
-                total_stands = 5
-
-            stats = {
-                'timestamp': datetime.now().isoformat(),
-                'total_users': len(users),
-                'total_stands': total_stands,
-                'completed_users': 0,
-                'qualified_users': 0,
-                'vk_verified_users': 0,
-                'users_with_pending_questions': 0,
-                'average_progress': 0.0
-            }
-
-            if users:
-                progress_sum = 0
-                for user_data in users.values():
-                    completed = sum(1 for status in user_data.get('stand_status', {}).values() if status.get('done', False))
-                    user_total = len(user_data.get('stand_status', {}))
-                    progress = (completed / user_total * 100) if user_total > 0 else 0
-                    progress_sum += progress
-
-                    if completed >= total_stands:
-                        stats['completed_users'] += 1
-
-                    if user_data.get('vk_verified', False):
-                        stats['vk_verified_users'] += 1
-                        if completed >= total_stands:
-                            stats['qualified_users'] += 1
-
-                    if user_data.get('pending_question'):
-                        stats['users_with_pending_questions'] += 1
-
-                stats['average_progress'] = round(progress_sum / len(users), 1)
-
-            return stats
+            return self._stats.as_dict()
+
+    def reload(self):
+        """Принудительно перечитывает состояние из хранилища.
+
+        Изменения, еще ждущие записи в окне группировки, сначала записываются;
+        если запись не удалась, их поля накладываются на перечитанные данные.
+        """
+        with self.storage.lock:
+            if self._has_writes():
+                self._commit_pending()
+            with self.lock:
+                if self._dirty_full:
+                    # Полная перезапись еще впереди - свои данные новее хранилища
+                    print("[RealtimeState] Reload skipped: full write is still pending")
+                else:
+                    self._reload_all()
+                self._publish_snapshot()
 
     def clear_all(self):
         """Очищает все данные."""
         with self.lock:
             self.data = {}
+            # Прерывает декодирование бинарного снимка, если оно еще идет
+            self._warm_event.set()
+            self._stats.reset(self._stats.stand_ids)
+            self._index.reset(self._stats.stand_ids)
+            if self.cold is not None:
+                self.cold.clear()
+            self._cold_keys.clear()
+            self._lru.clear()
+            self._reconciled_versions.clear()
+            self._mark_snapshot_stale()
             self._save()
-            self._notify_subscribers()
+            self._emit(StateChangeEvent(0, cleared=True))
             print("[RealtimeState] Cleared all data")
 
     def stop(self):
         """Останавливает мониторинг."""
-        if self._observer:
-            self._observer.stop()
-            self._observer.join()
-            print("[RealtimeState] Stopped file monitoring")
-
-        if self._periodic_timer:
-            self._periodic_timer.cancel()
-            print("[RealtimeState] Stopped periodic check")
+        if not self.flush(STOP_FLUSH_TIMEOUT):
+            print("[RealtimeState] Stopped with unsaved changes")
+        with self._flush_cond:
+            self._stop_event.set()
+            self._flush_cond.notify_all()
+        if self._flusher_thread:
+            self._flusher_thread.join(timeout=5)
+            print("[RealtimeState] Stopped flusher")
+
+        with self._notify_cond:
+            self._notify_cond.notify_all()
+        self._notifier_thread.join(timeout=5)
+
+        if self._change_detector:
+            self._change_detector.stop()
+
+        self.storage.close()
+        if self.cold is not None:
+            self.cold.close()
 
 # Глобальный экземпляр
 _state_manager = None
 
-def get_state_manager() -> RealtimeStateManager:
-    """Получает глобальный экземпляр менеджера состояния."""
+def create_state_manager() -> RealtimeStateManager:
+    """Создает локальный менеджер состояния по настройкам окружения."""
+    storage_mode = os.getenv('STATE_STORAGE', 'json')
+    storage_options = {}
+    if storage_mode == 'sharded':
+        storage_options['shard_count'] = int(os.getenv('STATE_SHARDS', '16'))
+    if storage_mode in ('json', 'journal') and os.getenv('STATE_BINARY_SNAPSHOT', '0') == '1':
+        storage_options['binary_snapshot'] = True
+    hot_capacity = os.getenv('STATE_HOT_CAPACITY')
+    cold_ttl = os.getenv('STATE_COLD_TTL')
+    manager = RealtimeStateManager(
+        storage_mode=storage_mode,
+        flush_interval=float(os.getenv('STATE_FLUSH_INTERVAL', '0.05')),
+        storage_options=storage_options,
+        hot_capacity=int(hot_capacity) if hot_capacity else None,
+        cold_ttl=float(cold_ttl) if cold_ttl else None,
+    )
+    # Дописываем отложенные изменения при выходе процесса
+    atexit.register(manager.flush, 5)
+    return manager
+
+def get_state_manager():
+    """Получает глобальный экземпляр менеджера состояния.
+
+    Если задан STATE_SOCKET, данными владеет сервер состояния (state_server.py),
+    а здесь возвращается клиент к нему с тем же интерфейсом.
+    """
     global _state_manager
     if _state_manager is None:
-        _state_manager = RealtimeStateManager()
+        socket_path = os.getenv('STATE_SOCKET')
+        if socket_path:
+            from state_server import RemoteStateManager
+            _state_manager = RemoteStateManager(socket_path)
+        else:
+            _state_manager = create_state_manager()
     return _state_manager
 
 def stop_state_manager():
@@ -377,8 +1441,8 @@ def stop_state_manager():
 if __name__ == '__main__':
     manager = get_state_manager()
 
-    def on_change(data):
-        print(f"[Test] State changed! Users: {len(data)}")
+    def on_change(event):
+        print(f"[Test] State changed! {event}")
 
     manager.subscribe(on_change)
 
@@ -0,0 +1,462 @@
+#!/usr/bin/env python3
+"""Сервер состояния: один процесс держит данные в памяти, а бот, админка и
+розыгрыш работают с ними через локальный Unix-сокет.
+
+Протокол - кадры вида <длина: 4 байта big-endian><JSON в UTF-8>.
+Запрос: {"op": "...", "args": {...}}, ответ: {"ok": true, "result": ...}
+или {"ok": false, "error": "..."}. После запроса "subscribe" соединение
+только получает события изменений: {"event": {...}}.
+
+Запуск: python state_server.py (путь к сокету - STATE_SOCKET, по умолчанию
+data/state.sock). Клиенты включаются той же переменной STATE_SOCKET.
+"""
+
+import json
+import os
+import signal
+import socket
+import socketserver
+import struct
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from realtime_state import RealtimeStateManager, StateChangeEvent, StateSnapshot, create_state_manager
+from user_record import UserRecord, to_json
+
+DEFAULT_SOCKET_PATH = 'data/state.sock'
+
+_HEADER = struct.Struct('>I')
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+
+class StateServerError(Exception):
+    """Ошибка, которую сервер состояния вернул в ответ на запрос."""
+
+
+def send_frame(sock: socket.socket, message: Dict[str, Any]):
+    """Отправляет одно сообщение."""
+    body = json.dumps(message, ensure_ascii=False, separators=(',', ':'), default=to_json).encode('utf-8')
+    sock.sendall(_HEADER.pack(len(body)) + body)
+
+
+def _recv_exact(sock: socket.socket, size: int) -> Optional[bytes]:
+    buffer = bytearray()
+    while len(buffer) < size:
+        chunk = sock.recv(size - len(buffer))
+        if not chunk:
+            return None
+        buffer += chunk
+    return bytes(buffer)
+
+
+def recv_frame(sock: socket.socket) -> Optional[Dict[str, Any]]:
+    """Читает одно сообщение. None - соединение закрыто между сообщениями."""
+    header = _recv_exact(sock, _HEADER.size)
+    if header is None:
+        return None
+    (size,) = _HEADER.unpack(header)
+    if size > MAX_FRAME_SIZE:
+        raise ConnectionError(f'frame too large: {size} bytes')
+    body = _recv_exact(sock, size)
+    if body is None:
+        raise ConnectionError('connection closed in the middle of a frame')
+    return json.loads(body.decode('utf-8'))
+
+
+def _encode_event(event: StateChangeEvent) -> Dict[str, Any]:
+    return {
+        'version': event.version,
+        'fields': {user_id: sorted(fields) for user_id, fields in event.fields.items()},
+        'stands_changed': event.stands_changed,
+        'cleared': event.cleared,
+    }
+
+
+def _decode_event(data: Dict[str, Any]) -> StateChangeEvent:
+    return StateChangeEvent(
+        data['version'],
+        {user_id: frozenset(fields) for user_id, fields in data['fields'].items()},
+        stands_changed=data['stands_changed'],
+        cleared=data['cleared'],
+    )
+
+
+class _RequestHandler(socketserver.BaseRequestHandler):
+    """Обслуживает одно клиентское соединение."""
+
+    def handle(self):
+        state_server: 'StateServer' = self.server.state_server
+        while True:
+            try:
+                request = recv_frame(self.request)
+            except (OSError, ValueError) as e:
+                print(f"[StateServer] Dropping connection: {e}")
+                return
+            if request is None:
+                return
+
+            op = request.get('op')
+            if op == 'subscribe':
+                state_server._serve_subscriber(self.request)
+                return
+
+            try:
+                reply = {'ok': True, 'result': state_server.handle_request(op, request.get('args') or {})}
+            except Exception as e:
+                reply = {'ok': False, 'error': f'{type(e).__name__}: {e}'}
+            try:
+                send_frame(self.request, reply)
+            except OSError:
+                return
+
+
+class _UnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class StateServer:
+    """Раздает менеджер состояния клиентам через Unix-сокет."""
+
+    def __init__(self, manager: RealtimeStateManager, socket_path: str = DEFAULT_SOCKET_PATH):
+        self.manager = manager
+        self.socket_path = Path(socket_path)
+        self._server: Optional[_UnixServer] = None
+        self._thread: Optional[threading.Thread] = None
+        self._subscribers: Dict[socket.socket, threading.Lock] = {}
+        self._subscribers_lock = threading.Lock()
+        self._handlers: Dict[str, Callable[..., Any]] = {
+            'ping': lambda: 'pong',
+            'get_user': lambda user_id: self.manager.get_user(user_id).to_dict(),
+            'peek_user': self._peek_user,
+            'has_user': lambda user_id: self.manager.has_user(user_id),
+            'update_user': lambda user_id, updates: self.manager.update_user(user_id, updates),
+            'update_users': lambda updates: self.manager.update_users(updates),
+            'get_all_users': lambda: self.manager.get_all_users(),
+            'query_users': self._query_users,
+            'get_stats': lambda: self.manager.get_stats(),
+            'snapshot': self._snapshot,
+            'clear_all': lambda: self.manager.clear_all(),
+            'reload': lambda: self.manager.reload(),
+            'flush': lambda timeout=None: self.manager.flush(timeout),
+        }
+
+    def handle_request(self, op: str, args: Dict[str, Any]) -> Any:
+        handler = self._handlers.get(op)
+        if handler is None:
+            raise ValueError(f'unknown operation: {op}')
+        return handler(**args)
+
+    def _peek_user(self, user_id: int) -> Optional[Dict[str, Any]]:
+        user_data = self.manager.peek_user(user_id)
+        return None if user_data is None else user_data.to_dict()
+
+    def _query_users(self, index: str, limit: Optional[int] = None) -> List[list]:
+        return [[key, record.to_dict()] for key, record in self.manager.query_users(index, limit)]
+
+    def _snapshot(self, version: int = -1) -> Dict[str, Any]:
+        """Снимок для клиента; пользователи передаются, только если версия сменилась."""
+        snapshot = self.manager.snapshot()
+        users = None
+        if snapshot.version != version:
+            users = {key: record.to_dict() for key, record in snapshot.users.items()}
+        return {'version': snapshot.version, 'users': users, 'stats': dict(snapshot.stats)}
+
+    def _serve_subscriber(self, sock: socket.socket):
+        """Превращает соединение в поток событий и держит его до отключения клиента."""
+        with self._subscribers_lock:
+            self._subscribers[sock] = threading.Lock()
+        try:
+            send_frame(sock, {'ok': True, 'result': 'subscribed'})
+            # Клиент ничего не присылает; ждем закрытия соединения
+            while sock.recv(1024):
+                pass
+        except OSError:
+            pass
+        finally:
+            with self._subscribers_lock:
+                self._subscribers.pop(sock, None)
+
+    def _broadcast(self, event: StateChangeEvent):
+        """Рассылает событие всем подписанным клиентам."""
+        with self._subscribers_lock:
+            subscribers = list(self._subscribers.items())
+        if not subscribers:
+            return
+        message = {'event': _encode_event(event)}
+        for sock, lock in subscribers:
+            try:
+                with lock:
+                    send_frame(sock, message)
+            except OSError as e:
+                print(f"[StateServer] Dropping subscriber: {e}")
+                with self._subscribers_lock:
+                    self._subscribers.pop(sock, None)
+
+    def _remove_stale_socket(self):
+        """Удаляет сокет, оставшийся от упавшего сервера; не дает запустить второй сервер."""
+        if not self.socket_path.exists():
+            return
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(str(self.socket_path))
+        except OSError:
+            self.socket_path.unlink()
+            return
+        finally:
+            probe.close()
+        raise RuntimeError(f'state server is already running on {self.socket_path}')
+
+    def start(self):
+        """Открывает сокет и обслуживает клиентов в фоновом потоке."""
+        self.socket_path.parent.mkdir(parents=True, exist_ok=True)
+        self._remove_stale_socket()
+        self._server = _UnixServer(str(self.socket_path), _RequestHandler)
+        self._server.state_server = self
+        os.chmod(self.socket_path, 0o660)
+        self.manager.subscribe(self._broadcast)
+        self._thread = threading.Thread(target=self._server.serve_forever, name='state-server', daemon=True)
+        self._thread.start()
+        print(f"[StateServer] Listening on {self.socket_path}")
+
+    def stop(self):
+        """Закрывает сокет и отключает подписчиков."""
+        self.manager.unsubscribe(self._broadcast)
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        with self._subscribers_lock:
+            for sock in self._subscribers:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            self._subscribers.clear()
+        try:
+            self.socket_path.unlink()
+        except FileNotFoundError:
+            pass
+        print("[StateServer] Stopped")
+
+
+class RemoteStateManager:
+    """Клиент сервера состояния с тем же интерфейсом, что у RealtimeStateManager.
+
+    Каждый поток использует свое соединение, поэтому запросы из разных
+    потоков (например, воркеров gunicorn) не ждут друг друга.
+    """
+
+    def __init__(self, socket_path: str = DEFAULT_SOCKET_PATH, timeout: float = 10.0):
+        self.socket_path = str(socket_path)
+        self.timeout = timeout
+        self.subscribers: list[Callable] = []
+        self._local = threading.local()
+        self._connections: list[socket.socket] = []
+        self._connections_lock = threading.Lock()
+        self._snapshot = StateSnapshot(-1, {}, {})
+        self._snapshot_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._event_socket: Optional[socket.socket] = None
+        self._event_thread: Optional[threading.Thread] = None
+        self._subscribed = threading.Event()
+        print(f"[RemoteState] Using state server at {self.socket_path}")
+
+    def _connect(self, timeout: Optional[float]) -> socket.socket:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def _close_local(self):
+        sock = getattr(self._local, 'sock', None)
+        self._local.sock = None
+        if sock is not None:
+            with self._connections_lock:
+                if sock in self._connections:
+                    self._connections.remove(sock)
+            sock.close()
+
+    def _call(self, op: str, **args) -> Any:
+        """Выполняет запрос; при обрыве соединения переподключается и повторяет один раз.
+
+        Все операции идемпотентны (update_user задает значения полей), поэтому
+        повтор после потерянного ответа безопасен.
+        """
+        for attempt in range(2):
+            sock = getattr(self._local, 'sock', None)
+            try:
+                if sock is None:
+                    sock = self._connect(self.timeout)
+                    self._local.sock = sock
+                    with self._connections_lock:
+                        self._connections.append(sock)
+                send_frame(sock, {'op': op, 'args': args})
+                reply = recv_frame(sock)
+                if reply is None:
+                    raise ConnectionError('state server closed the connection')
+            except (OSError, ValueError) as e:
+                self._close_local()
+                if attempt:
+                    raise ConnectionError(f'state server at {self.socket_path} is unavailable: {e}') from e
+                continue
+            if not reply.get('ok'):
+                raise StateServerError(reply.get('error'))
+            return reply.get('result')
+
+    def get_user(self, user_id: int) -> UserRecord:
+        """Получает данные пользователя, создавая его при первом обращении."""
+        return UserRecord.from_dict(self._call('get_user', user_id=user_id))
+
+    def peek_user(self, user_id: int) -> Optional[UserRecord]:
+        """Читает пользователя без побочных эффектов."""
+        user_data = self._call('peek_user', user_id=user_id)
+        return None if user_data is None else UserRecord.from_dict(user_data)
+
+    def has_user(self, user_id: int) -> bool:
+        return self._call('has_user', user_id=user_id)
+
+    def update_user(self, user_id: int, updates: Dict[str, Any]):
+        self._call('update_user', user_id=user_id, updates=updates)
+
+    def update_users(self, updates: Dict[Any, Dict[str, Any]]) -> int:
+        return self._call('update_users', updates={str(user_id): value for user_id, value in updates.items()})
+
+    @contextmanager
+    def transaction(self, user_id: int) -> Iterator[UserRecord]:
+        """Изменяет копию записи и отправляет отличающиеся поля одним запросом.
+
+        В отличие от локального менеджера, блок не изолирован от изменений
+        других клиентов между чтением и записью.
+        """
+        original = self.get_user(user_id)
+        record = original.copy()
+        yield record
+        fields = original.diff(record)
+        if fields:
+            self.update_user(user_id, {field: record[field] for field in fields if field in record})
+
+    def snapshot(self) -> StateSnapshot:
+        """Снимок состояния; пользователи передаются заново, только если он сменился на сервере."""
+        with self._snapshot_lock:
+            reply = self._call('snapshot', version=self._snapshot.version)
+            if reply['users'] is not None:
+                users = {key: UserRecord.from_dict(value) for key, value in reply['users'].items()}
+            else:
+                users = dict(self._snapshot.users)
+            self._snapshot = StateSnapshot(reply['version'], users, reply['stats'])
+            return self._snapshot
+
+    def iter_users(self) -> Iterator[Tuple[str, UserRecord]]:
+        return ((key, UserRecord.from_dict(value)) for key, value in self.get_all_users().items())
+
+    def get_all_users(self) -> Dict[str, Any]:
+        # Не из снимка: при многоуровневом хранении на сервере в снимке только горячие пользователи
+        return self._call('get_all_users')
+
+    def query_users(self, index: str, limit: Optional[int] = None) -> List[Tuple[str, UserRecord]]:
+        """Пользователи из вторичного индекса сервера (см. RealtimeStateManager.query_users)."""
+        return [(key, UserRecord.from_dict(value))
+                for key, value in self._call('query_users', index=index, limit=limit)]
+
+    def get_stats(self) -> Dict[str, Any]:
+        return self._call('get_stats')
+
+    def clear_all(self):
+        self._call('clear_all')
+
+    def reload(self):
+        self._call('reload')
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        return self._call('flush', timeout=timeout)
+
+    def subscribe(self, callback: Callable):
+        """Подписывается на изменения; события приходят от сервера через отдельное соединение.
+
+        При первой подписке ждет (до timeout), пока сервер подтвердит подписку.
+        """
+        self.subscribers.append(callback)
+        print(f"[RemoteState] Added subscriber: {callback.__name__}")
+        if self._event_thread is None:
+            self._event_thread = threading.Thread(target=self._event_loop, name='state-events', daemon=True)
+            self._event_thread.start()
+            self._subscribed.wait(self.timeout)
+
+    def unsubscribe(self, callback: Callable):
+        if callback in self.subscribers:
+            self.subscribers.remove(callback)
+            print(f"[RemoteState] Removed subscriber: {callback.__name__}")
+
+    def _event_loop(self):
+        """Читает события сервера и вызывает подписчиков; переподключается при обрыве."""
+        while not self._stop_event.is_set():
+            try:
+                sock = self._event_socket = self._connect(self.timeout)
+                send_frame(sock, {'op': 'subscribe'})
+                reply = recv_frame(sock)
+                if not reply or not reply.get('ok'):
+                    raise ConnectionError('subscription rejected')
+                sock.settimeout(None)
+                self._subscribed.set()
+                print("[RemoteState] Subscribed to state server events")
+                while not self._stop_event.is_set():
+                    message = recv_frame(sock)
+                    if message is None:
+                        raise ConnectionError('state server closed the connection')
+                    event = _decode_event(message['event'])
+                    for callback in list(self.subscribers):
+                        try:
+                            callback(event)
+                        except Exception as e:
+                            print(f"[RemoteState] Error notifying subscriber: {e}")
+            except (OSError, ValueError) as e:
+                if self._stop_event.is_set():
+                    break
+                print(f"[RemoteState] Event stream interrupted: {e}; reconnecting")
+                self._stop_event.wait(1.0)
+            finally:
+                if self._event_socket is not None:
+                    self._event_socket.close()
+                    self._event_socket = None
+
+    def stop(self):
+        """Закрывает соединения с сервером (сам сервер продолжает работать)."""
+        self._stop_event.set()
+        if self._event_socket is not None:
+            try:
+                self._event_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        if self._event_thread:
+            self._event_thread.join(timeout=5)
+        with self._connections_lock:
+            for sock in self._connections:
+                sock.close()
+            self._connections.clear()
+
+
+def main():
+    """Запускает сервер состояния до SIGINT/SIGTERM."""
+    manager = create_state_manager()
+    server = StateServer(manager, os.getenv('STATE_SOCKET', DEFAULT_SOCKET_PATH))
+    stopped = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+    server.start()
+    try:
+        while not stopped.wait(1.0):
+            pass
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+        manager.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,696 @@
+#!/usr/bin/env python3
+"""Хранилища для RealtimeStateManager: полный JSON-файл, журнал изменений и SQLite."""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from binary_snapshot import LazyUsers, encode_snapshot, open_snapshot, source_signature, write_snapshot
+from user_record import to_json
+
+try:
+    import fcntl
+except ImportError:  # Windows: блокировка только между потоками процесса
+    fcntl = None
+
+
+class FileLock:
+    """Межпроцессная блокировка через fcntl.flock на отдельном .lock файле.
+
+    Внутри процесса дополнительно берется обычная блокировка, поэтому
+    с ней безопасно работать из нескольких потоков.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._thread_lock = threading.Lock()
+        self._fd: Optional[int] = None
+
+    def __enter__(self) -> 'FileLock':
+        self._thread_lock.acquire()
+        if fcntl is not None:
+            try:
+                if self._fd is None:
+                    self.path.parent.mkdir(parents=True, exist_ok=True)
+                    self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            except Exception:
+                self._thread_lock.release()
+                raise
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if fcntl is not None and self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._thread_lock.release()
+
+    def close(self):
+        with self._thread_lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+
+class StateStorage:
+    """Базовый интерфейс хранилища состояния."""
+
+    mode = 'base'
+    compactable = False
+
+    def __init__(self, state_file_path: Path):
+        self.state_file_path = Path(state_file_path)
+        # Блокировка фиксации изменений, общая для всех процессов с этим хранилищем
+        self.lock = FileLock(self.state_file_path.with_suffix('.lock'))
+
+    def files(self) -> List[Path]:
+        """Файлы, изменения которых нужно отслеживать."""
+        return [self.state_file_path]
+
+    def exists(self) -> bool:
+        """Есть ли сохраненное состояние."""
+        return self.state_file_path.exists()
+
+    def last_modified(self) -> float:
+        """Максимальное время модификации файлов хранилища."""
+        mtimes = [path.stat().st_mtime for path in self.files() if path.exists()]
+        return max(mtimes) if mtimes else 0
+
+    def load(self) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    def load_changes(self) -> Optional[Dict[str, Any]]:
+        """Возвращает пользователей, измененных другими процессами с прошлого чтения.
+
+        None означает, что нужна полная перезагрузка через load().
+        Значение None у ключа означает, что пользователь удален.
+        """
+        return None
+
+    def encode(self, data: Dict[str, Any], changed: Optional[Iterable[str]] = None) -> Any:
+        """Сериализует изменения. Вызывается под блокировкой менеджера, без дискового ввода-вывода.
+
+        changed=None означает полную перезапись.
+        """
+        raise NotImplementedError
+
+    def write(self, payload: Any):
+        """Записывает результат encode() на диск. Вызывается без блокировки менеджера."""
+        raise NotImplementedError
+
+    def save(self, data: Dict[str, Any], changed: Optional[Iterable[str]] = None):
+        """Сохраняет состояние синхронно. changed=None означает полную перезапись."""
+        self.write(self.encode(data, changed))
+
+    def should_compact(self) -> bool:
+        """Нужно ли фоновое уплотнение хранилища."""
+        return False
+
+    def close(self):
+        """Освобождает ресурсы хранилища."""
+        self.lock.close()
+
+
+def _write_text_atomic(path: Path, text: str):
+    """Атомарно записывает текст через временный файл."""
+    temp_path = path.with_suffix('.tmp')
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    temp_path.replace(path)
+
+
+def _dump_snapshot(data: Dict[str, Any]) -> str:
+    return json.dumps(data, ensure_ascii=False, indent=2, default=to_json)
+
+
+class _BinarySnapshotMixin:
+    """Бинарный снимок state.bin рядом с JSON-снимком для быстрого старта.
+
+    JSON остается основным форматом; бинарный снимок используется при
+    загрузке, только если записан для текущей версии JSON-файла.
+    """
+
+    state_file_path: Path
+    binary_path: Optional[Path] = None
+
+    def _init_binary(self, binary_snapshot: bool):
+        self.binary_path = self.state_file_path.with_suffix('.bin') if binary_snapshot else None
+
+    def _open_binary(self) -> Optional[LazyUsers]:
+        if self.binary_path is None:
+            return None
+        reader = open_snapshot(self.binary_path, self.state_file_path)
+        return None if reader is None else LazyUsers(reader)
+
+    def _encode_binary(self, data: Dict[str, Any]) -> Any:
+        return encode_snapshot(data) if self.binary_path is not None else None
+
+    def _write_snapshot_files(self, text: str, encoded: Any):
+        _write_text_atomic(self.state_file_path, text)
+        if encoded is not None:
+            write_snapshot(self.binary_path, encoded, source_signature(self.state_file_path))
+
+
+class JsonStateStorage(_BinarySnapshotMixin, StateStorage):
+    """Все состояние в одном JSON-файле, каждая запись переписывает файл целиком."""
+
+    mode = 'json'
+
+    def __init__(self, state_file_path: Path, binary_snapshot: bool = False):
+        super().__init__(state_file_path)
+        self._init_binary(binary_snapshot)
+
+    def load(self) -> Dict[str, Any]:
+        data = self._open_binary()
+        if data is not None:
+            return data
+        with open(self.state_file_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def encode(self, data: Dict[str, Any], changed: Optional[Iterable[str]] = None) -> tuple:
+        return _dump_snapshot(data), self._encode_binary(data)
+
+    def write(self, payload: tuple):
+        self._write_snapshot_files(*payload)
+
+
+class JournalStateStorage(_BinarySnapshotMixin, StateStorage):
+    """Снимок в state.json плюс журнал state.journal с записями по одному пользователю.
+
+    Каждое изменение дописывает в журнал только измененных пользователей,
+    поэтому стоимость записи не зависит от общего числа пользователей.
+    При загрузке снимок восстанавливается и поверх него проигрывается журнал.
+    Уплотнение переносит журнал в новый снимок и обнуляет его.
+    """
+
+    mode = 'journal'
+    compactable = True
+
+    def __init__(self, state_file_path: Path, compact_entries: int = 1000,
+                 compact_bytes: int = 4 * 1024 * 1024, binary_snapshot: bool = False):
+        super().__init__(state_file_path)
+        self._init_binary(binary_snapshot)
+        self.journal_path = self.state_file_path.with_suffix('.journal')
+        self.compact_entries = compact_entries
+        self.compact_bytes = compact_bytes
+        self._journal_entries = 0
+
+    def files(self) -> List[Path]:
+        return [self.state_file_path, self.journal_path]
+
+    def exists(self) -> bool:
+        return self.state_file_path.exists() or self.journal_path.exists()
+
+    def load(self) -> Dict[str, Any]:
+        data = self._open_binary()
+        if data is None:
+            data = {}
+            if self.state_file_path.exists():
+                with open(self.state_file_path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+
+        self._journal_entries = 0
+        if self.journal_path.exists():
+            with open(self.journal_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Оборванная последняя строка после сбоя - пропускаем
+                        print(f"[StateStorage] Skipping corrupted journal line in {self.journal_path}")
+                        continue
+                    self._apply(data, entry)
+                    self._journal_entries += 1
+        return data
+
+    @staticmethod
+    def _apply(data: Dict[str, Any], entry: Dict[str, Any]):
+        """Применяет запись журнала к словарю состояния."""
+        op = entry.get('op')
+        if op == 'put':
+            data[entry['id']] = entry['user']
+        elif op == 'del':
+            data.pop(entry['id'], None)
+        elif op == 'clear':
+            data.clear()
+
+    def encode(self, data: Dict[str, Any], changed: Optional[Iterable[str]] = None) -> tuple:
+        if changed is None:
+            return 'snapshot', _dump_snapshot(data), self._encode_binary(data)
+
+        lines = []
+        for key in changed:
+            if key in data:
+                entry = {'op': 'put', 'id': key, 'user': data[key]}
+            else:
+                entry = {'op': 'del', 'id': key}
+            lines.append(json.dumps(entry, ensure_ascii=False, separators=(',', ':'), default=to_json) + '\n')
+        return 'append', len(lines), ''.join(lines).encode('utf-8')
+
+    def write(self, payload: tuple):
+        if payload[0] == 'snapshot':
+            self._write_snapshot(payload[1], payload[2])
+        else:
+            self._append(payload[1], payload[2])
+
+    def _append(self, count: int, payload: bytes):
+        """Дописывает записи в журнал одним вызовом write."""
+        if not count:
+            return
+        fd = os.open(self.journal_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, payload)
+        finally:
+            os.close(fd)
+        self._journal_entries += count
+
+    def _write_snapshot(self, text: str, encoded: Any = None):
+        """Записывает новый снимок и обнуляет журнал."""
+        started = time.time()
+        self._write_snapshot_files(text, encoded)
+        # Снимок уже содержит все записи журнала, повторное проигрывание безопасно
+        with open(self.journal_path, 'w', encoding='utf-8'):
+            pass
+        compacted = self._journal_entries
+        self._journal_entries = 0
+        if compacted:
+            print(f"[StateStorage] Compacted {compacted} journal entries into "
+                  f"{self.state_file_path} in {time.time() - started:.3f}s")
+
+    def should_compact(self) -> bool:
+        if self._journal_entries >= self.compact_entries:
+            return True
+        try:
+            return self.journal_path.stat().st_size >= self.compact_bytes
+        except FileNotFoundError:
+            return False
+
+
+class SqliteStateStorage(StateStorage):
+    """Каждый пользователь - строка в локальной SQLite базе в режиме WAL.
+
+    Запись обновляет только строки измененных пользователей, а другие процессы
+    дочитывают только строки с номером изменения больше последнего прочитанного.
+    Удаление отдельного пользователя хранится как строка с data = NULL,
+    чтобы его тоже можно было увидеть при дочитывании; полная очистка
+    увеличивает поколение базы и требует полной перезагрузки.
+    """
+
+    mode = 'sqlite'
+
+    def __init__(self, state_file_path: Path, timeout: float = 10.0):
+        super().__init__(state_file_path)
+        self.db_path = self.state_file_path.with_suffix('.db')
+        self._lock = threading.Lock()
+        self._last_seq = 0
+        self._generation = 0
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.db_path), timeout=timeout,
+                                     check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript('''
+            CREATE TABLE IF NOT EXISTS users (
+                id TEXT PRIMARY KEY,
+                data TEXT,
+                seq INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS users_seq ON users(seq);
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            );
+        ''')
+        self._migrate_from_json()
+
+    def files(self) -> List[Path]:
+        return [self.db_path, Path(f'{self.db_path}-wal')]
+
+    def exists(self) -> bool:
+        return True
+
+    def _migrate_from_json(self):
+        """Однократно переносит пользователей из state.json в пустую базу."""
+        if not self.state_file_path.exists():
+            return
+        with self._lock:
+            if self._conn.execute('SELECT 1 FROM users LIMIT 1').fetchone():
+                return
+            try:
+                with open(self.state_file_path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+            except (json.JSONDecodeError, OSError) as e:
+                print(f"[StateStorage] Failed to migrate {self.state_file_path}: {e}")
+                return
+            self._write(self._encode_rows(data, data.keys()))
+        print(f"[StateStorage] Migrated {len(data)} users from {self.state_file_path} to {self.db_path}")
+
+    def _read_generation(self) -> int:
+        row = self._conn.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()
+        return row[0] if row else 0
+
+    def load(self) -> Dict[str, Any]:
+        with self._lock:
+            self._conn.execute('BEGIN')
+            try:
+                self._generation = self._read_generation()
+                rows = self._conn.execute('SELECT id, data, seq FROM users').fetchall()
+            finally:
+                self._conn.execute('COMMIT')
+
+        data: Dict[str, Any] = {}
+        self._last_seq = 0
+        for key, raw, seq in rows:
+            self._last_seq = max(self._last_seq, seq)
+            if raw is not None:
+                data[key] = json.loads(raw)
+        return data
+
+    def load_changes(self) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            self._conn.execute('BEGIN')
+            try:
+                if self._read_generation() != self._generation:
+                    return None
+                rows = self._conn.execute(
+                    'SELECT id, data, seq FROM users WHERE seq > ? ORDER BY seq', (self._last_seq,)
+                ).fetchall()
+            finally:
+                self._conn.execute('COMMIT')
+
+        changes: Dict[str, Any] = {}
+        for key, raw, seq in rows:
+            self._last_seq = max(self._last_seq, seq)
+            changes[key] = json.loads(raw) if raw is not None else None
+        return changes
+
+    def _encode_rows(self, data: Dict[str, Any], keys: Iterable[str]) -> List[tuple]:
+        return [
+            (key, json.dumps(data[key], ensure_ascii=False, separators=(',', ':'), default=to_json)
+             if key in data else None)
+            for key in keys
+        ]
+
+    def _write(self, rows: List[tuple], clear: bool = False):
+        """Записывает строки пользователей одной транзакцией."""
+        self._conn.execute('BEGIN IMMEDIATE')
+        try:
+            if clear:
+                self._conn.execute('DELETE FROM users')
+                self._conn.execute(
+                    "INSERT INTO meta (key, value) VALUES ('generation', 1) "
+                    "ON CONFLICT(key) DO UPDATE SET value = value + 1"
+                )
+            start_seq = self._conn.execute('SELECT COALESCE(MAX(seq), 0) FROM users').fetchone()[0]
+            seq = start_seq
+            numbered = []
+            for key, raw in rows:
+                seq += 1
+                numbered.append((key, raw, seq))
+            self._conn.executemany(
+                'INSERT INTO users (id, data, seq) VALUES (?, ?, ?) '
+                'ON CONFLICT(id) DO UPDATE SET data = excluded.data, seq = excluded.seq',
+                numbered
+            )
+            self._conn.execute('COMMIT')
+        except Exception:
+            self._conn.execute('ROLLBACK')
+            raise
+        if clear:
+            self._generation = self._read_generation()
+        # Собственные записи не нужно дочитывать повторно, если других писателей не было
+        if clear or start_seq == self._last_seq:
+            self._last_seq = seq
+
+    def encode(self, data: Dict[str, Any], changed: Optional[Iterable[str]] = None) -> tuple:
+        if changed is None:
+            return True, self._encode_rows(data, data.keys())
+        return False, self._encode_rows(data, changed)
+
+    def write(self, payload: tuple):
+        clear, rows = payload
+        with self._lock:
+            self._write(rows, clear=clear)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+        super().close()
+
+
+class ShardedStateStorage(StateStorage):
+    """Пользователи разложены по файлам data/state/shard-NN.json по crc32 их id.
+
+    Запись переписывает только шарды с измененными пользователями, а
+    дочитывание перечитывает только шарды, файлы которых сменились.
+    Число шардов фиксируется в shards.json при создании хранилища.
+    При первом запуске существующий state.json раскладывается по шардам.
+    """
+
+    mode = 'sharded'
+
+    def __init__(self, state_file_path: Path, shard_count: int = 16):
+        super().__init__(state_file_path)
+        self.shard_dir = self.state_file_path.with_suffix('')
+        self.layout_path = self.shard_dir / 'shards.json'
+        self.shard_dir.mkdir(parents=True, exist_ok=True)
+        self.shard_count = self._read_layout(shard_count)
+        self.shard_paths = [self.shard_dir / f'shard-{index:02d}.json' for index in range(self.shard_count)]
+        # Подписи файлов и ключи шардов на момент последнего чтения или своей записи
+        self._signatures: Dict[int, Any] = {}
+        self._keys: Dict[int, set] = {index: set() for index in range(self.shard_count)}
+        self._migrate_from_json()
+
+    def _read_layout(self, shard_count: int) -> int:
+        try:
+            with open(self.layout_path, 'r', encoding='utf-8') as f:
+                existing = json.load(f)['count']
+        except FileNotFoundError:
+            _write_text_atomic(self.layout_path, json.dumps({'count': shard_count}))
+            return shard_count
+        if existing != shard_count:
+            print(f"[StateStorage] Keeping existing layout of {existing} shards "
+                  f"in {self.shard_dir} (requested {shard_count})")
+        return existing
+
+    def shard_of(self, key: str) -> int:
+        return zlib.crc32(key.encode('utf-8')) % self.shard_count
+
+    def files(self) -> List[Path]:
+        return list(self.shard_paths)
+
+    def exists(self) -> bool:
+        return any(path.exists() for path in self.shard_paths)
+
+    @staticmethod
+    def _signature(path: Path) -> Any:
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    def _read_shard(self, index: int) -> Dict[str, Any]:
+        path = self.shard_paths[index]
+        self._signatures[index] = self._signature(path)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                shard = json.load(f)
+        except FileNotFoundError:
+            shard = {}
+        self._keys[index] = set(shard)
+        return shard
+
+    def _migrate_from_json(self):
+        """Однократно раскладывает пользователей из state.json по шардам."""
+        if self.exists() or not self.state_file_path.exists():
+            return
+        with self.lock:
+            if self.exists():
+                return
+            try:
+                with open(self.state_file_path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+            except (json.JSONDecodeError, OSError) as e:
+                print(f"[StateStorage] Failed to migrate {self.state_file_path}: {e}")
+                return
+            self.save(data)
+        print(f"[StateStorage] Migrated {len(data)} users from {self.state_file_path} "
+              f"to {self.shard_count} shards in {self.shard_dir}")
+
+    def load(self) -> Dict[str, Any]:
+        data: Dict[str, Any] = {}
+        for index in range(self.shard_count):
+            data.update(self._read_shard(index))
+        return data
+
+    def load_changes(self) -> Optional[Dict[str, Any]]:
+        changes: Dict[str, Any] = {}
+        for index, path in enumerate(self.shard_paths):
+            if self._signature(path) == self._signatures.get(index):
+                continue
+            old_keys = self._keys[index]
+            shard = self._read_shard(index)
+            changes.update(shard)
+            for key in old_keys - shard.keys():
+                changes[key] = None
+        return changes
+
+    def encode(self, data: Dict[str, Any], changed: Optional[Iterable[str]] = None) -> List[tuple]:
+        full = changed is None
+        if full:
+            self._keys = {index: set() for index in range(self.shard_count)}
+            changed = data.keys()
+        dirty = set()
+        for key in changed:
+            index = self.shard_of(key)
+            if key in data:
+                self._keys[index].add(key)
+            else:
+                self._keys[index].discard(key)
+            dirty.add(index)
+        if full:
+            # Полная запись переписывает и шарды, в которых не осталось пользователей
+            dirty = set(range(self.shard_count))
+        return [
+            (index, _dump_snapshot({key: data[key] for key in sorted(self._keys[index])}))
+            for index in sorted(dirty)
+        ]
+
+    def write(self, payload: List[tuple]):
+        for index, text in payload:
+            path = self.shard_paths[index]
+            _write_text_atomic(path, text)
+            self._signatures[index] = self._signature(path)
+
+
+class ColdStore:
+    """Холодное хранилище редко используемых пользователей: строка SQLite на пользователя.
+
+    Менеджер состояния переносит сюда давно неактивных и квалифицированных
+    пользователей, чтобы не держать их в памяти и не переписывать при каждой
+    записи основного хранилища, и поднимает обратно при обращении.
+    Каждая запись получает номер изменения, чтобы другие процессы могли
+    дочитать только перенесенных после последней проверки.
+    """
+
+    def __init__(self, path: Path, timeout: float = 10.0):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.path), timeout=timeout,
+                                     check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript('''
+            CREATE TABLE IF NOT EXISTS users (
+                id TEXT PRIMARY KEY,
+                data TEXT NOT NULL,
+                seq INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS users_seq ON users(seq);
+        ''')
+
+    def put_many(self, users: Dict[str, Any]):
+        """Записывает пользователей одной транзакцией (существующие строки заменяются)."""
+        encoded = [
+            (key, json.dumps(value, ensure_ascii=False, separators=(',', ':'), default=to_json))
+            for key, value in users.items()
+        ]
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                seq = self._conn.execute('SELECT COALESCE(MAX(seq), 0) FROM users').fetchone()[0]
+                rows = [(key, raw, seq + number) for number, (key, raw) in enumerate(encoded, 1)]
+                self._conn.executemany('INSERT OR REPLACE INTO users (id, data, seq) VALUES (?, ?, ?)', rows)
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+
+    def get_many(self, keys: Iterable[str], chunk_size: int = 500) -> Dict[str, Any]:
+        """Пользователи по id; отсутствующих в ответе нет."""
+        keys = list(keys)
+        result: Dict[str, Any] = {}
+        with self._lock:
+            for start in range(0, len(keys), chunk_size):
+                chunk = keys[start:start + chunk_size]
+                rows = self._conn.execute(
+                    f"SELECT id, data FROM users WHERE id IN ({', '.join('?' * len(chunk))})", chunk
+                ).fetchall()
+                result.update((key, json.loads(raw)) for key, raw in rows)
+        return result
+
+    def get(self, key: str) -> Optional[Any]:
+        return self.get_many([key]).get(key)
+
+    def last_seq(self) -> int:
+        with self._lock:
+            return self._conn.execute('SELECT COALESCE(MAX(seq), 0) FROM users').fetchone()[0]
+
+    def changes(self, after_seq: int) -> Tuple[Dict[str, Any], int]:
+        """Пользователи, записанные после изменения after_seq, и номер последнего изменения."""
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT id, data, seq FROM users WHERE seq > ? ORDER BY seq', (after_seq,)
+            ).fetchall()
+        changes: Dict[str, Any] = {}
+        for key, raw, seq in rows:
+            changes[key] = json.loads(raw)
+            after_seq = seq
+        return changes, after_seq
+
+    def contains(self, key: str) -> bool:
+        with self._lock:
+            return self._conn.execute('SELECT 1 FROM users WHERE id = ?', (key,)).fetchone() is not None
+
+    def keys(self) -> List[str]:
+        with self._lock:
+            return [key for key, in self._conn.execute('SELECT id FROM users')]
+
+    def items(self, chunk_size: int = 1000) -> Iterator[Tuple[str, Any]]:
+        """Перебирает всех пользователей порциями, не загружая таблицу целиком."""
+        last_rowid = 0
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    'SELECT rowid, id, data FROM users WHERE rowid > ? ORDER BY rowid LIMIT ?',
+                    (last_rowid, chunk_size)
+                ).fetchall()
+            if not rows:
+                return
+            for last_rowid, key, raw in rows:
+                yield key, json.loads(raw)
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute('DELETE FROM users')
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+STORAGE_MODES = {
+    JsonStateStorage.mode: JsonStateStorage,
+    JournalStateStorage.mode: JournalStateStorage,
+    SqliteStateStorage.mode: SqliteStateStorage,
+    ShardedStateStorage.mode: ShardedStateStorage,
+}
+
+
+def create_storage(mode: str, state_file_path: Path, **options) -> StateStorage:
+    """Создает хранилище по названию режима; options передаются его конструктору."""
+    try:
+        storage_class = STORAGE_MODES[mode]
+    except KeyError:
+        raise ValueError(f"Unknown state storage mode: {mode!r} "
+                         f"(available: {', '.join(sorted(STORAGE_MODES))})")
+    return storage_class(state_file_path, **options)
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""Тест асинхронного интерфейса состояния - вызовы не блокируют цикл событий."""
+
+import asyncio
+import tempfile
+from pathlib import Path
+
+from async_state import AsyncRealtimeStateManager
+from realtime_state import RealtimeStateManager
+
+
+def test_async_manager_transactions_and_events():
+    """Параллельные транзакции одного пользователя не теряют изменений, события приходят в цикл."""
+    with tempfile.TemporaryDirectory() as tmp:
+        manager = RealtimeStateManager(str(Path(tmp) / 'state.json'))
+        state = AsyncRealtimeStateManager(manager)
+
+        async def scenario():
+            user = await state.get_user(7)
+            assert user['awaiting_name'] is True
+
+            received = []
+
+            async def collect():
+                async for event in state.events():
+                    received.append(event)
+                    if '7' in event.fields and 'full_name' in event.fields['7']:
+                        return
+
+            collector = asyncio.create_task(collect())
+            await asyncio.sleep(0.05)
+
+            async def add_click(stand_id):
+                async with state.transaction(7) as record:
+                    await asyncio.sleep(0.01)
+                    record.set_done(stand_id)
+
+            await asyncio.gather(*(add_click(f'stand_{index}') for index in range(5)))
+            await state.update_user(7, {'full_name': 'Async'})
+            await asyncio.wait_for(collector, 5)
+
+            user = await state.peek_user(7)
+            assert all(user.is_done(f'stand_{index}') for index in range(5))
+            assert user['full_name'] == 'Async'
+            assert await state.has_user(7)
+            assert await state.flush(5)
+            assert not state._user_locks
+
+        try:
+            asyncio.run(scenario())
+        finally:
+            asyncio.run(state.close())
+            manager.stop()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""Тест HTTP-сессии бота - keep-alive соединение, long polling и кэш клавиатуры."""
+
+import json
+import tempfile
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+from bot import POLL_BACKOFF_MAX, TelegramBot
+from config import get_stand_catalog
+from realtime_state import RealtimeStateManager
+from update_dispatcher import UpdateDispatcher
+
+
+class _FakeTelegramHandler(BaseHTTPRequestHandler):
+    """Отвечает {"ok": true} на любой метод Bot API, не закрывая соединение."""
+
+    protocol_version = 'HTTP/1.1'
+    # Обновления для getUpdates, параметры полученных запросов getUpdates и вызовов методов
+    updates = []
+    polls = []
+    posts = []
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+        self.posts.append({key: values[0] for key, values in parse_qs(body).items()})
+        self._reply({})
+
+    def do_GET(self):
+        params = {key: values[0] for key, values in parse_qs(urlparse(self.path).query).items()}
+        self.polls.append(params)
+        offset = int(params.get('offset', 0))
+        self._reply([update for update in self.updates if update['update_id'] >= offset])
+
+    def _reply(self, result):
+        body = json.dumps({'ok': True, 'result': result}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@contextmanager
+def _test_bot(server=None, **kwargs):
+    """Бот со своим состоянием во временном каталоге, при наличии сервера - направленный на него."""
+    with tempfile.TemporaryDirectory() as tmp:
+        state = RealtimeStateManager(str(Path(tmp) / 'state.json'))
+        bot = TelegramBot('test-token', state_manager=state, **kwargs)
+        if server is not None:
+            bot.api_url = f'http://127.0.0.1:{server.server_address[1]}/bottest-token'
+        try:
+            yield bot
+        finally:
+            bot.close()
+            state.stop()
+
+
+def test_send_message_reuses_pooled_connection():
+    """Пачка ответов идет через одно соединение из пула."""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _FakeTelegramHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        with _test_bot(server, pool_size=2) as bot:
+            for index in range(5):
+                assert bot.send_message(index, f'message {index}', use_keyboard=False).result(5)['ok']
+            stats = bot.pool_stats()
+        assert stats['requests'] == 5
+        assert stats['connections_opened'] == 1
+        assert stats['connections_reused'] == 4
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_poll_updates_long_polls_and_confirms_processed_offset():
+    """getUpdates - долгий таймаут, только сообщения; следующий запрос подтверждает обработанное."""
+    _FakeTelegramHandler.updates = [
+        {'update_id': 5, 'message': {'from': {'id': 1}, 'chat': {'id': 1}, 'text': 'a'}},
+        {'update_id': 6, 'message': {'from': {'id': 2}, 'chat': {'id': 2}, 'text': 'b'}},
+    ]
+    _FakeTelegramHandler.polls = []
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _FakeTelegramHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    processed = []
+    try:
+        with _test_bot(server) as bot:
+            bot.dispatcher = UpdateDispatcher(lambda update: processed.append(update['update_id']), workers=2)
+            try:
+                assert bot.poll_updates()['ok']
+                first = _FakeTelegramHandler.polls[0]
+                assert first['timeout'] == str(bot.poll_timeout)
+                assert first['limit'] == str(bot.poll_limit)
+                assert json.loads(first['allowed_updates']) == ['message']
+
+                _FakeTelegramHandler.updates = []
+                assert bot.poll_updates()['result'] == []
+                assert sorted(processed) == [5, 6]
+                assert _FakeTelegramHandler.polls[1]['offset'] == '7'
+            finally:
+                bot.dispatcher.stop()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_poll_backoff_grows_with_jitter_and_honours_retry_after():
+    with _test_bot() as bot:
+        delays = [bot.poll_backoff(errors) for errors in range(1, 10)]
+        assert 0.5 <= delays[0] <= 1.0
+        assert 4.0 <= delays[3] <= 8.0
+        assert all(delay <= POLL_BACKOFF_MAX for delay in delays)
+        assert bot.poll_backoff(1, {'ok': False, 'parameters': {'retry_after': 7}}) >= 7
+
+
+def test_reply_markup_sent_only_when_keyboard_changes():
+    """Клавиатура отправляется с первым сообщением и после изменения прогресса."""
+    _FakeTelegramHandler.posts = []
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _FakeTelegramHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    user_id = 424242001
+    catalog = get_stand_catalog()
+    try:
+        with _test_bot(server) as bot:
+            # Лимит скорости одного чата здесь не проверяется
+            bot.outbox.chat_rate = 1000
+            state = bot.state_manager
+            state.get_user(user_id)
+            state.update_user(user_id, {'awaiting_name': False, 'full_name': 'Test User'})
+
+            for index in range(3):
+                assert bot.send_message(user_id, f'message {index}', user_id=user_id).result(5)['ok']
+            with_markup = ['reply_markup' in post for post in _FakeTelegramHandler.posts]
+            assert with_markup == [True, False, False]
+            assert json.loads(_FakeTelegramHandler.posts[0]['reply_markup']) == bot.create_keyboard(user_id)
+
+            # Изменился прогресс - клавиатура другая, отправляется снова
+            with state.transaction(user_id) as user:
+                user.set_done(catalog.ids[0])
+            assert bot.send_message(user_id, 'progress', user_id=user_id).result(5)['ok']
+            assert 'reply_markup' in _FakeTelegramHandler.posts[-1]
+            # Отправка клавиатуры не добавляет записей в состояние
+            updated_at = state.peek_user(user_id)['updated_at']
+            assert bot.send_message(user_id, 'same', user_id=user_id).result(5)['ok']
+            assert 'reply_markup' not in _FakeTelegramHandler.posts[-1]
+            assert state.peek_user(user_id)['updated_at'] == updated_at
+
+            # Ожидаем ввод - клавиатура убирается один раз
+            state.update_user(user_id, {'awaiting_vk_link': True})
+            for index in range(2):
+                assert bot.send_message(user_id, f'vk {index}', user_id=user_id).result(5)['ok']
+            assert json.loads(_FakeTelegramHandler.posts[-2]['reply_markup']) == {'remove_keyboard': True}
+            assert 'reply_markup' not in _FakeTelegramHandler.posts[-1]
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+"""Тест детектора изменений - свои записи игнорируются, чужие объединяются в одну проверку."""
+
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from change_detector import ChangeDetector
+
+
+def test_change_detector_suppresses_own_writes_and_coalesces():
+    """Собственная запись не вызывает callback, пачка чужих записей - один вызов."""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / 'state.json'
+        path.write_text('{}', encoding='utf-8')
+        calls = []
+        called = threading.Event()
+
+        def on_change(paths):
+            calls.append(paths)
+            called.set()
+
+        detector = ChangeDetector([path], on_change, debounce=0.05, max_delay=0.5, poll_interval=0.2)
+        detector.start()
+        try:
+            # Своя запись
+            before = detector.signatures([path])
+            path.write_text('{"1": {}}', encoding='utf-8')
+            detector.acknowledge(before)
+            detector.poke()
+            time.sleep(0.5)
+            assert calls == []
+
+            # Пачка чужих записей
+            for i in range(5):
+                path.write_text('{"%d": {}}' % i, encoding='utf-8')
+                detector.poke()
+            assert called.wait(2)
+            time.sleep(0.3)
+            assert calls == [[path]]
+        finally:
+            detector.stop()
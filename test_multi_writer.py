@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""Тест нескольких писателей - изменения разных менеджеров одного хранилища не теряются."""
+
+import tempfile
+import threading
+from pathlib import Path
+
+import pytest
+
+from realtime_state import RealtimeStateManager
+
+
+@pytest.mark.parametrize('storage_mode', ['json', 'journal', 'sqlite', 'sharded'])
+def test_concurrent_writers_do_not_lose_updates(storage_mode):
+    """Два менеджера пишут одних и тех же пользователей, но разные поля."""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = str(Path(tmp) / 'state.json')
+        first = RealtimeStateManager(path, storage_mode=storage_mode, flush_interval=0.01)
+        second = RealtimeStateManager(path, storage_mode=storage_mode, flush_interval=0.01)
+        try:
+            for user_id in range(5):
+                first.get_user(user_id)
+            first.flush(5)
+
+            def write(manager, field, value):
+                for round_number in range(10):
+                    for user_id in range(5):
+                        manager.peek_user(user_id) or manager.get_user(user_id)
+                        manager.update_user(user_id, {field: f'{value}-{round_number}'})
+                    manager.flush(5)
+
+            threads = [
+                threading.Thread(target=write, args=(first, 'full_name', 'name')),
+                threading.Thread(target=write, args=(second, 'vk_profile', 'vk')),
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            first.flush(5)
+            second.flush(5)
+            check = RealtimeStateManager(path, storage_mode=storage_mode)
+            try:
+                for user_id in range(5):
+                    user = check.peek_user(user_id)
+                    assert user['full_name'] == 'name-9'
+                    assert user['vk_profile'] == 'vk-9'
+            finally:
+                check.stop()
+        finally:
+            first.stop()
+            second.stop()
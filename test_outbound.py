@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""Тест очереди исходящих сообщений - лимиты скорости, порядок в чате и 429."""
+
+import threading
+import time
+
+from outbound import OutboundScheduler
+
+
+class _FakeApi:
+    """Записывает вызовы; первые rate_limited вызовов получают 429."""
+
+    def __init__(self, rate_limited=0, retry_after=0.3):
+        self.calls = []
+        self.lock = threading.Lock()
+        self.rate_limited = rate_limited
+        self.retry_after = retry_after
+
+    def __call__(self, method, data):
+        with self.lock:
+            self.calls.append((time.monotonic(), data['chat_id'], data['text']))
+            if self.rate_limited:
+                self.rate_limited -= 1
+                return {'ok': False, 'error_code': 429, 'parameters': {'retry_after': self.retry_after}}
+        return {'ok': True, 'result': {'chat': {'id': data['chat_id']}}}
+
+
+def test_chat_rate_and_order():
+    """Сообщения одного чата идут по порядку и не чаще лимита чата, разные чаты - параллельно."""
+    api = _FakeApi()
+    outbox = OutboundScheduler(api, global_rate=1000, chat_rate=10, chat_burst=1, workers=4)
+    try:
+        futures = [outbox.submit(chat_id, 'sendMessage', {'chat_id': chat_id, 'text': str(index)})
+                   for index in range(5) for chat_id in (1, 2)]
+        assert all(future.result(5)['ok'] for future in futures)
+        for chat_id in (1, 2):
+            calls = [(at, text) for at, chat, text in api.calls if chat == chat_id]
+            assert [text for _, text in calls] == ['0', '1', '2', '3', '4']
+            gaps = [later[0] - earlier[0] for earlier, later in zip(calls, calls[1:])]
+            assert min(gaps) >= 0.08
+        # Оба чата укладываются в ~0.4 секунды, а не в 0.9
+        assert api.calls[-1][0] - api.calls[0][0] < 0.7
+    finally:
+        outbox.stop()
+
+
+def test_global_rate_limit():
+    api = _FakeApi()
+    outbox = OutboundScheduler(api, global_rate=40, chat_rate=100, chat_burst=1, workers=4)
+    try:
+        started = time.monotonic()
+        futures = [outbox.submit(chat_id, 'sendMessage', {'chat_id': chat_id, 'text': 'hi'}) for chat_id in range(80)]
+        assert all(future.result(5)['ok'] for future in futures)
+        # 40 сообщений сразу (запас ведра), остальные 40 - за секунду
+        assert time.monotonic() - started >= 0.9
+    finally:
+        outbox.stop()
+
+
+def test_retry_after_pauses_and_resends():
+    """После 429 отправки ждут retry_after, сообщение не теряется и порядок сохраняется."""
+    api = _FakeApi(rate_limited=1, retry_after=0.3)
+    outbox = OutboundScheduler(api, global_rate=1000, chat_rate=100, chat_burst=5, workers=2)
+    try:
+        futures = [outbox.submit(7, 'sendMessage', {'chat_id': 7, 'text': str(index)}) for index in range(3)]
+        assert all(future.result(5)['ok'] for future in futures)
+        assert [text for _, _, text in api.calls] == ['0', '0', '1', '2']
+        assert api.calls[1][0] - api.calls[0][0] >= 0.29
+        assert outbox.stats['rate_limited'] == 1
+        assert outbox.stats['sent'] == 3
+    finally:
+        outbox.stop()
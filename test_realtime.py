@@ -1,9 +1,14 @@
 #!/usr/bin/env python3
 """Тест работы в реальном времени - демонстрация единого источника данных."""
 
+import json
 import time
 import random
-from realtime_state import get_state_manager
+import tempfile
+import threading
+from pathlib import Path
+
+from realtime_state import RealtimeStateManager, get_state_manager
 
 def test_realtime_sync():
     """Тестирует синхронизацию в реальном времени."""
@@ -86,5 +91,200 @@ def test_realtime_sync():
 
     return test_user_id
 
+def test_transaction_and_batch_update():
+    """Транзакция фиксирует изменения один раз, пакетное обновление - одной записью."""
+    with tempfile.TemporaryDirectory() as tmp:
+        manager = RealtimeStateManager(str(Path(tmp) / 'state.json'))
+        try:
+            with manager.transaction(1) as user:
+                user['full_name'] = 'Транзакция'
+                user['awaiting_name'] = False
+                user.set_done('stand_tx')
+            assert manager.peek_user(1)['full_name'] == 'Транзакция'
+            assert manager.peek_user(1).is_done('stand_tx')
+
+            # Исключение внутри блока отменяет изменения
+            try:
+                with manager.transaction(1) as user:
+                    user['full_name'] = 'Отменено'
+                    raise RuntimeError('abort')
+            except RuntimeError:
+                pass
+            assert manager.peek_user(1)['full_name'] == 'Транзакция'
+
+            manager.get_user(2)
+            assert manager.update_users({1: {'vk_verified': True}, 2: {'full_name': 'Второй'}, 3: {}}) == 2
+            assert manager.peek_user(1)['vk_verified'] is True
+            assert manager.peek_user(2)['full_name'] == 'Второй'
+            assert not manager.has_user(3)
+            assert manager.flush(5)
+        finally:
+            manager.stop()
+
+def test_user_indexes_follow_mutations():
+    """Индексы квалифицированных, ожидающих и недавно измененных обновляются при каждом изменении."""
+    with tempfile.TemporaryDirectory() as tmp:
+        manager = RealtimeStateManager(str(Path(tmp) / 'state.json'))
+        try:
+            stands = manager._stats.stand_ids
+            for user_id in (1, 2, 3):
+                manager.get_user(user_id)
+            assert sorted(key for key, _ in manager.query_users('awaiting_name')) == ['1', '2', '3']
+
+            with manager.transaction(2) as user:
+                user['awaiting_name'] = False
+                user['vk_verified'] = True
+                for stand_id in stands:
+                    user.set_done(stand_id)
+            manager.update_user(3, {'pending_question': {'stand_id': 'stand_x'}})
+
+            assert [key for key, _ in manager.query_users('qualified')] == ['2']
+            assert [key for key, _ in manager.query_users('pending_question')] == ['3']
+            assert sorted(key for key, _ in manager.query_users('awaiting_name')) == ['1', '3']
+            assert [key for key, _ in manager.query_users('recent', 2)] == ['3', '2']
+
+            manager.update_user(2, {'vk_verified': False})
+            manager.update_user(3, {'pending_question': None})
+            assert manager.query_users('qualified') == []
+            assert manager.query_users('pending_question') == []
+            assert [key for key, _ in manager.query_users('recent')] == ['3', '2', '1']
+
+            manager.clear_all()
+            assert manager.query_users('recent') == []
+        finally:
+            manager.stop()
+
+def test_stats_see_own_writes_and_snapshots_copy_only_changes():
+    """get_stats видит свои изменения сразу, снимки делят базу и копируют только измененных."""
+    with tempfile.TemporaryDirectory() as tmp:
+        manager = RealtimeStateManager(str(Path(tmp) / 'state.json'), flush_interval=0.01)
+
+        def wait_folded():
+            deadline = time.monotonic() + 5
+            while manager.snapshot().users.needs_fold() and time.monotonic() < deadline:
+                time.sleep(0.01)
+
+        try:
+            manager.get_user(1)
+            assert manager.get_stats()['total_users'] == 1
+            for user_id in range(2, 501):
+                manager.get_user(user_id)
+            assert manager.get_stats()['total_users'] == 500
+            assert manager.flush(5)
+            wait_folded()
+
+            before = manager.snapshot()
+            manager.update_user(3, {'full_name': 'Renamed'})
+            assert manager.flush(5)
+            after = manager.snapshot()
+            assert before.users['3']['full_name'] is None
+            assert after.users['3']['full_name'] == 'Renamed'
+            # Новый снимок делит базу с прежним и добавляет в слой изменений одного пользователя
+            assert after.users.base is before.users.base
+            assert after.users.changes.keys() - before.users.changes.keys() <= {'3'}
+            assert len(after.users.changes) <= len(before.users.changes) + 1
+            assert dict(after.users) == {k: v for k, v in manager.data.items() if k != 'meta'}
+
+            # Слой изменений больше корня из числа пользователей сливается с базой
+            manager.update_users({user_id: {'full_name': f'User {user_id}'} for user_id in range(1, 101)})
+            assert manager.flush(5)
+            wait_folded()
+            folded = manager.snapshot()
+            assert not folded.users.needs_fold() and len(folded) == 500
+            assert dict(folded.users) == {k: v for k, v in manager.data.items() if k != 'meta'}
+        finally:
+            manager.stop()
+
+def test_reload_keeps_pending_writes():
+    """Принудительная перезагрузка не теряет изменения, ждущие записи в окне группировки."""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / 'state.json'
+        manager = RealtimeStateManager(str(path), flush_interval=1.0)
+        try:
+            manager.get_user(1)
+            assert manager.flush(5)
+            manager.update_user(1, {'full_name': 'Pending'})
+            manager.reload()
+            assert manager.peek_user(1)['full_name'] == 'Pending'
+            assert json.loads(path.read_text(encoding='utf-8'))['1']['full_name'] == 'Pending'
+
+            # Запись перед перезагрузкой не удалась - поля накладываются на перечитанные данные
+            write = manager.storage.write
+
+            def fail_once(payload):
+                manager.storage.write = write
+                raise OSError('disk full')
+
+            manager.storage.write = fail_once
+            manager.update_user(1, {'full_name': 'Retried'})
+            manager.reload()
+            assert manager.peek_user(1)['full_name'] == 'Retried'
+            assert manager.flush(5)
+            assert json.loads(path.read_text(encoding='utf-8'))['1']['full_name'] == 'Retried'
+        finally:
+            manager.stop()
+
+def test_cold_tier_evicts_and_faults_in_users():
+    """Лишние сверх емкости и квалифицированные пользователи уходят в холодное хранилище и возвращаются при обращении."""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / 'state.json'
+        options = {'hot_capacity': 2, 'cold_ttl': 3600, 'cold_check_interval': 0.1}
+        manager = RealtimeStateManager(str(path), **options)
+        try:
+            stands = manager._stats.stand_ids
+            for user_id in (1, 2, 3, 4):
+                manager.get_user(user_id)
+            with manager.transaction(4) as user:
+                user['vk_verified'] = True
+                for stand_id in stands:
+                    user.set_done(stand_id)
+            assert manager.flush(5)
+
+            deadline = time.monotonic() + 5
+            while '4' in manager.data and time.monotonic() < deadline:
+                time.sleep(0.05)
+            assert manager.flush(5)
+            # В памяти и в основном файле - не больше двух горячих пользователей
+            assert len(manager.data) <= 2 and '4' not in manager.data
+            assert len(json.loads(path.read_text(encoding='utf-8'))) <= 2
+            assert all(manager.has_user(user_id) for user_id in (1, 2, 3, 4))
+            assert manager.peek_user(1)['awaiting_name'] is True
+            assert [key for key, _ in manager.query_users('qualified')] == ['4']
+            assert len(manager.get_all_users()) == 4
+
+            # Холодные записи читаются без блокировки состояния: писатели не ждут
+            get_many = manager.cold.get_many
+            lock_free = []
+
+            def checked_get_many(keys):
+                def try_lock():
+                    if manager.lock.acquire(timeout=1):
+                        lock_free.append(True)
+                        manager.lock.release()
+                thread = threading.Thread(target=try_lock)
+                thread.start()
+                thread.join()
+                return get_many(keys)
+
+            manager.cold.get_many = checked_get_many
+            assert [key for key, _ in manager.query_users('qualified')] == ['4']
+            manager.cold.get_many = get_many
+            assert lock_free == [True]
+
+            # Обращение поднимает пользователя обратно
+            manager.update_user(1, {'full_name': 'Back'})
+            assert '1' in manager.data
+            assert manager.flush(5)
+        finally:
+            manager.stop()
+
+        restarted = RealtimeStateManager(str(path), **options)
+        try:
+            assert restarted.get_stats()['total_users'] == 4
+            assert restarted.get_user(1)['full_name'] == 'Back'
+            assert restarted.peek_user(4)['vk_verified'] is True
+        finally:
+            restarted.stop()
+
 if __name__ == '__main__':
     test_realtime_sync()
\ No newline at end of file
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""Тест сервера состояния - клиенты работают с одним хранилищем через Unix-сокет."""
+
+import tempfile
+import threading
+from pathlib import Path
+
+from realtime_state import RealtimeStateManager
+from state_server import RemoteStateManager, StateServer
+
+
+def test_remote_clients_share_state_and_events():
+    """Изменение одного клиента сразу видно другому и приходит ему событием."""
+    with tempfile.TemporaryDirectory() as tmp:
+        manager = RealtimeStateManager(str(Path(tmp) / 'state.json'))
+        server = StateServer(manager, str(Path(tmp) / 'state.sock'))
+        server.start()
+        writer = RemoteStateManager(server.socket_path)
+        reader = RemoteStateManager(server.socket_path)
+        try:
+            received = threading.Event()
+            events = []
+
+            def on_change(event):
+                events.append(event)
+                if '42' in event.user_ids:
+                    received.set()
+
+            reader.subscribe(on_change)
+            assert reader.peek_user(42) is None
+
+            user = writer.get_user(42)
+            assert user['awaiting_name'] is True
+            writer.update_user(42, {'full_name': 'Remote', 'awaiting_name': False})
+
+            assert reader.has_user(42)
+            assert reader.peek_user(42)['full_name'] == 'Remote'
+            assert received.wait(5)
+            assert any('full_name' in event.fields.get('42', ()) for event in events)
+
+            writer.flush(5)
+            assert reader.get_all_users()['42']['full_name'] == 'Remote'
+            assert reader.get_stats()['total_users'] == 1
+            assert [key for key, _ in reader.query_users('recent')] == ['42']
+            assert reader.query_users('awaiting_name') == []
+        finally:
+            writer.stop()
+            reader.stop()
+            server.stop()
+            manager.stop()
@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+"""Тест хранилищ состояния - журнал и SQLite восстанавливают данные без полной перезаписи."""
+
+import json
+import tempfile
+import time
+from pathlib import Path
+
+from binary_snapshot import LazyUsers
+from config import get_stand_catalog
+from realtime_state import RealtimeStateManager
+from state_storage import JournalStateStorage, JsonStateStorage, ShardedStateStorage, SqliteStateStorage
+from user_record import UserRecord
+
+
+def test_journal_storage_replay_and_compact():
+    """Журнал восстанавливается из снимка и записей, уплотнение сохраняет данные."""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / 'state.json'
+        storage = JournalStateStorage(path)
+        data = {}
+        storage.save(data)
+
+        for user_id in ('1', '2', '3'):
+            data[user_id] = {'full_name': f'User {user_id}'}
+            storage.save(data, {user_id})
+
+        # Запись одного пользователя добавляет в журнал одну строку
+        assert len(storage.journal_path.read_text(encoding='utf-8').splitlines()) == 3
+        assert JournalStateStorage(path).load() == data
+
+        data['2']['full_name'] = 'Renamed'
+        storage.save(data, {'2'})
+        # Полное сохранение уплотняет журнал в снимок
+        storage.save(data)
+
+        assert storage.journal_path.stat().st_size == 0
+        assert JournalStateStorage(path).load() == data
+
+
+def test_journal_mode_round_trip_and_compaction():
+    """Менеджер в режиме журнала дописывает изменения, восстанавливает их после перезапуска
+    и уплотняет журнал в снимок."""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / 'state.json'
+        options = {'storage_mode': 'journal', 'flush_interval': 0.01,
+                   'compact_interval': 0.05, 'storage_options': {'compact_entries': 5}}
+        manager = RealtimeStateManager(str(path), **options)
+        journal_path = manager.storage.journal_path
+        try:
+            manager.get_user(1)
+            assert manager.flush(5)
+            manager.update_user(1, {'full_name': 'One'})
+            assert manager.flush(5)
+            # Изменение одного пользователя - одна строка журнала, снимок не переписывается
+            entries = [json.loads(line) for line in journal_path.read_text(encoding='utf-8').splitlines()]
+            assert entries[-1]['id'] == '1' and entries[-1]['user']['full_name'] == 'One'
+        finally:
+            manager.stop()
+
+        restarted = RealtimeStateManager(str(path), **options)
+        try:
+            assert restarted.peek_user(1)['full_name'] == 'One'
+            for user_id in range(2, 10):
+                restarted.get_user(user_id)
+                restarted.update_user(user_id, {'full_name': f'User {user_id}'})
+                assert restarted.flush(5)
+
+            # Журнал длиннее compact_entries переносится в снимок
+            deadline = time.monotonic() + 5
+            while journal_path.stat().st_size and time.monotonic() < deadline:
+                time.sleep(0.05)
+            assert journal_path.stat().st_size == 0
+            snapshot = json.loads(path.read_text(encoding='utf-8'))
+            assert snapshot['9']['full_name'] == 'User 9'
+        finally:
+            restarted.stop()
+
+        with_snapshot = RealtimeStateManager(str(path), **options)
+        try:
+            assert len(with_snapshot.get_all_users()) == 9
+            assert with_snapshot.peek_user(1)['full_name'] == 'One'
+        finally:
+            with_snapshot.stop()
+
+
+def test_sqlite_storage_incremental_changes():
+    """Второй процесс дочитывает только измененных пользователей."""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / 'state.json'
+        writer = SqliteStateStorage(path)
+        reader = SqliteStateStorage(path)
+        try:
+            data = {'1': {'full_name': 'One'}, '2': {'full_name': 'Two'}}
+            writer.save(data)
+            assert reader.load() == data
+
+            data['2']['full_name'] = 'Changed'
+            writer.save(data, {'2'})
+            assert reader.load_changes() == {'2': {'full_name': 'Changed'}}
+            assert reader.load_changes() == {}
+
+            # Полная очистка требует полной перезагрузки
+            writer.save({})
+            assert reader.load_changes() is None
+            assert reader.load() == {}
+        finally:
+            writer.close()
+            reader.close()
+
+
+def test_sharded_storage_rewrites_only_dirty_shards():
+    """Запись переписывает только шард измененного пользователя, дочитывание - только измененный шард."""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / 'state.json'
+        # Однократная миграция из единого файла
+        path.write_text(json.dumps({str(i): {'full_name': f'User {i}'} for i in range(50)}), encoding='utf-8')
+        storage = ShardedStateStorage(path, shard_count=8)
+        data = storage.load()
+        assert len(data) == 50
+
+        other = ShardedStateStorage(path, shard_count=4)
+        assert other.shard_count == 8
+        assert other.load() == data
+
+        data['7']['full_name'] = 'Renamed'
+        payload = storage.encode(data, {'7'})
+        assert [index for index, _ in payload] == [storage.shard_of('7')]
+        storage.write(payload)
+        assert storage.load_changes() == {}
+
+        changes = other.load_changes()
+        assert changes['7'] == {'full_name': 'Renamed'}
+        assert set(changes) == {key for key in data if storage.shard_of(key) == storage.shard_of('7')}
+
+        del data['7']
+        storage.save(data, {'7'})
+        assert other.load_changes()['7'] is None
+
+
+def test_binary_snapshot_lazy_load():
+    """Бинарный снимок читается лениво и игнорируется, если JSON записан без него."""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / 'state.json'
+        data = {str(user_id): {'full_name': f'User {user_id}', 'stand_status': {}} for user_id in range(50)}
+        JsonStateStorage(path, binary_snapshot=True).save(data)
+        assert path.with_suffix('.bin').exists()
+
+        loaded = JsonStateStorage(path, binary_snapshot=True).load()
+        assert isinstance(loaded, LazyUsers)
+        assert len(loaded) == 50 and '7' in loaded and '50' not in loaded
+        assert loaded['7'].get('full_name') == 'User 7'
+        assert json.loads(json.dumps(loaded, default=dict)) == data
+
+        # Менеджер стартует со снимка и в фоне переходит на обычный словарь
+        manager = RealtimeStateManager(str(path), storage_options={'binary_snapshot': True})
+        try:
+            manager.update_user(3, {'full_name': 'Renamed'})
+            deadline = time.monotonic() + 5
+            while manager._warming and time.monotonic() < deadline:
+                time.sleep(0.01)
+            manager.update_user(4, {'vk_verified': True})
+            assert manager.flush(5)
+            assert isinstance(manager.data, dict) and isinstance(manager.data['10'], UserRecord)
+            assert manager.get_stats()['total_users'] == 50
+            assert manager.snapshot().users['3']['full_name'] == 'Renamed'
+        finally:
+            manager.stop()
+        assert JsonStateStorage(path, binary_snapshot=True).load()['3'].get('full_name') == 'Renamed'
+
+        # JSON переписан без снимка - снимок устарел и не используется
+        data['1']['full_name'] = 'Plain'
+        JsonStateStorage(path).save(data)
+        loaded = JsonStateStorage(path, binary_snapshot=True).load()
+        assert not isinstance(loaded, LazyUsers)
+        assert loaded['1']['full_name'] == 'Plain'
+
+
+def test_binary_snapshot_start_matches_json_start():
+    """Сразу после старта с бинарного снимка статистика, индексы и снимок те же, что после старта с JSON."""
+    stand_ids = get_stand_catalog().ids
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / 'state.json'
+        data = {
+            str(user_id): {
+                'full_name': f'User {user_id}',
+                'awaiting_name': user_id % 7 == 0,
+                'vk_verified': user_id % 2 == 0,
+                'pending_question': 'q' if user_id % 5 == 0 else None,
+                'stand_status': {stand_id: {'done': user_id % 3 != 0} for stand_id in stand_ids},
+            }
+            for user_id in range(20000)
+        }
+        JsonStateStorage(path, binary_snapshot=True).save(data)
+
+        def observe(manager):
+            stats = manager.get_stats()
+            del stats['timestamp']
+            return (
+                stats,
+                [key for key, _ in manager.query_users('qualified')],
+                [key for key, _ in manager.query_users('pending_question', 10)],
+                len(manager.get_all_users()),
+                len(manager.snapshot()),
+            )
+
+        manager = RealtimeStateManager(str(path))
+        try:
+            expected = observe(manager)
+        finally:
+            manager.stop()
+        assert expected[0]['total_users'] == 20000 and expected[1]
+
+        manager = RealtimeStateManager(str(path), storage_options={'binary_snapshot': True})
+        try:
+            assert manager._warming
+            assert observe(manager) == expected
+        finally:
+            manager.stop()
+
+        # Первым запросом после старта может быть выборка из индекса (розыгрыш)
+        manager = RealtimeStateManager(str(path), storage_options={'binary_snapshot': True})
+        try:
+            assert manager._warming
+            assert [key for key, _ in manager.query_users('qualified')] == expected[1]
+        finally:
+            manager.stop()
+
+
+def test_failed_write_is_retried_until_on_disk():
+    """Изменения, которые не удалось записать, остаются в очереди и пишутся повторно."""
+    for mode in ('journal', 'sqlite'):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / 'state.json'
+            manager = RealtimeStateManager(str(path), storage_mode=mode, flush_interval=0.01)
+            try:
+                manager.get_user(1)
+                manager.get_user(2)
+                assert manager.flush(5)
+
+                write = manager.storage.write
+
+                def fail_once(payload):
+                    manager.storage.write = write
+                    raise OSError('disk full')
+
+                manager.storage.write = fail_once
+                manager.update_user(1, {'full_name': 'One'})
+                # Первая запись не удалась - flush не сообщает об успехе
+                assert not manager.flush(0.1)
+                manager.update_user(2, {'full_name': 'Two'})
+                assert manager.flush(5)
+            finally:
+                manager.stop()
+
+            restarted = RealtimeStateManager(str(path), storage_mode=mode)
+            try:
+                assert restarted.peek_user(1)['full_name'] == 'One'
+                assert restarted.peek_user(2)['full_name'] == 'Two'
+            finally:
+                restarted.stop()
+
+
+if __name__ == '__main__':
+    test_journal_storage_replay_and_compact()
+    test_journal_mode_round_trip_and_compaction()
+    test_sqlite_storage_incremental_changes()
+    test_sharded_storage_rewrites_only_dirty_shards()
+    test_binary_snapshot_lazy_load()
+    test_binary_snapshot_start_matches_json_start()
+    test_failed_write_is_retried_until_on_disk()
+    print("✅ Тесты хранилищ пройдены")
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""Тест диспетчера обновлений - порядок внутри пользователя, параллельность между пользователями."""
+
+import threading
+import time
+
+from update_dispatcher import UpdateDispatcher
+
+
+def _update(update_id, user_id):
+    return {'update_id': update_id, 'message': {'from': {'id': user_id}, 'chat': {'id': user_id}, 'text': str(update_id)}}
+
+
+def test_dispatcher_orders_per_user_and_commits_offset_after_processing():
+    """Медленный пользователь не задерживает других, offset не обгоняет необработанные обновления."""
+    processed = []
+    lock = threading.Lock()
+    release = threading.Event()
+
+    def handler(update):
+        user_id = update['message']['from']['id']
+        if update['update_id'] == 10:
+            release.wait(5)
+        with lock:
+            processed.append((user_id, update['update_id']))
+
+    dispatcher = UpdateDispatcher(handler, workers=4)
+    try:
+        updates = [_update(10, 1), _update(11, 2), _update(12, 1), _update(13, 2), _update(14, 3)]
+        assert all(dispatcher.submit(update) for update in updates)
+
+        deadline = time.monotonic() + 5
+        while len(processed) < 3 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        # Пользователи 2 и 3 обработаны, пока первый ждет; его второе обновление - после первого
+        assert sorted(processed) == [(2, 11), (2, 13), (3, 14)]
+        assert dispatcher.offset() == 10
+        # Повторно полученные обновления не обрабатываются дважды
+        assert not dispatcher.submit(_update(11, 2))
+        assert not dispatcher.submit(_update(10, 1))
+
+        release.set()
+        assert dispatcher.wait_idle(5)
+        assert [update_id for user_id, update_id in processed if user_id == 1] == [10, 12]
+        assert dispatcher.offset() == 15
+        assert not dispatcher.submit(_update(14, 3))
+    finally:
+        release.set()
+        dispatcher.stop()
+
+
+def test_dispatcher_accepts_realistic_update_ids():
+    """Настоящие номера обновлений Telegram (~7e8) и пропуски номеров не блокируют submit()."""
+    processed = []
+    dispatcher = UpdateDispatcher(lambda update: processed.append(update['update_id']), workers=2)
+    try:
+        result = []
+        submitter = threading.Thread(target=lambda: result.extend(
+            dispatcher.submit(_update(update_id, update_id % 3))
+            for update_id in (734512345, 734512346, 734600000)
+        ), daemon=True)
+        submitter.start()
+        submitter.join(5)
+        assert not submitter.is_alive()
+        assert result == [True, True, True]
+        assert dispatcher.wait_idle(5)
+        assert sorted(processed) == [734512345, 734512346, 734600000]
+        assert dispatcher.offset() == 734600001
+        assert not dispatcher.submit(_update(734512346, 1))
+    finally:
+        dispatcher.stop()
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+"""Тест компактной записи пользователя - преобразование в JSON без потерь и маски стендов."""
+
+from user_record import UserRecord, stand_bits
+
+
+def test_user_record_roundtrip_and_masks():
+    """from_dict/to_dict сохраняют формат, прогресс считается по маске каталога."""
+    data = {
+        'full_name': 'Иван',
+        'awaiting_name': False,
+        'awaiting_vk_link': False,
+        'vk_profile': None,
+        'vk_verified': True,
+        'stand_status': {'rec_a': {'done': True}, 'rec_b': {'done': False}},
+        'pending_question': None,
+        'created_at': '2025-01-02T03:04:05.123456',
+        'updated_at': 'вчера',
+        'custom': [1, 2],
+    }
+    record = UserRecord.from_dict(data)
+    assert record.to_dict() == data
+    assert list(record.to_dict()) == list(data)
+    assert isinstance(record.created_at, float)
+    assert record['updated_at'] == 'вчера'
+
+    mask = stand_bits.mask(['rec_a', 'rec_b', 'rec_c'])
+    assert record.is_done('rec_a') and not record.is_done('rec_b')
+    assert record.completed_count(mask) == 1
+
+    copy = record.copy()
+    copy.set_done('rec_b')
+    assert copy.diff(record) == {'stand_status'}
+    assert record.reconcile(mask)
+    assert record['stand_status']['rec_c'] == {'done': False}
+    assert not record.reconcile(mask)
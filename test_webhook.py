@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""Тест webhook - проверка секрета, быстрый ответ и обработка через очередь."""
+
+import socket
+import threading
+
+import requests
+
+from fake_telegram import make_update, send_update, send_updates
+from update_dispatcher import UpdateDispatcher
+from webhook import MAX_BODY_SIZE, SECRET_HEADER, WEBHOOK_PATH, WebhookServer
+
+
+def test_webhook_checks_secret_and_queues_updates():
+    """Обновления с верным секретом обрабатываются по порядку для каждого пользователя."""
+    processed = []
+    lock = threading.Lock()
+
+    def handler(update):
+        with lock:
+            processed.append((update['message']['from']['id'], update['update_id']))
+
+    dispatcher = UpdateDispatcher(handler, workers=4)
+    server = WebhookServer(('127.0.0.1', 0), dispatcher.push, 'secret-token')
+    server.start()
+    url = f'http://127.0.0.1:{server.server_address[1]}{WEBHOOK_PATH}'
+    try:
+        with requests.Session() as session:
+            assert send_update(session, url, 'wrong', make_update(1, 'hi')) == 403
+            headers = {SECRET_HEADER: 'secret-token'}
+            assert session.post(url, data=b'not json', headers=headers).status_code == 400
+            assert session.post(url.replace(WEBHOOK_PATH, '/other'), json={}).status_code == 404
+
+        # Секрет проверяется до тела: на неверный ответ приходит сразу, тело не читается
+        with socket.create_connection(server.server_address[:2], timeout=5) as raw:
+            raw.sendall(f'POST {WEBHOOK_PATH} HTTP/1.1\r\nHost: test\r\n{SECRET_HEADER}: wrong\r\n'
+                        f'Content-Length: {MAX_BODY_SIZE + 1}\r\n\r\n'.encode('ascii'))
+            assert raw.recv(64).startswith(b'HTTP/1.1 403')
+
+        # Некорректная длина тела - ответ 400, а не оборванное соединение
+        for length in ('abc', '-5'):
+            with socket.create_connection(server.server_address[:2], timeout=5) as raw:
+                raw.sendall(f'POST {WEBHOOK_PATH} HTTP/1.1\r\nHost: test\r\n{SECRET_HEADER}: secret-token\r\n'
+                            f'Content-Length: {length}\r\n\r\n'.encode('ascii'))
+                assert raw.recv(64).startswith(b'HTTP/1.1 400')
+
+        updates = [make_update(user_id, 'text') for _ in range(10) for user_id in range(1, 6)]
+        result = send_updates(url, 'secret-token', updates, connections=3)
+        assert result['statuses'] == {200: 50}
+        assert dispatcher.wait_idle(5)
+
+        assert len(processed) == 50
+        for user_id in range(1, 6):
+            user_ids = [update_id for user, update_id in processed if user == user_id]
+            assert user_ids == sorted(user_ids)
+        assert server.stats == {'received': 50, 'rejected': 2}
+    finally:
+        server.stop()
+        dispatcher.stop()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""Параллельная обработка обновлений Telegram с сохранением порядка для каждого пользователя."""
+
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+_STOP = object()
+
+
+def update_user_id(update: Dict[str, Any]) -> Optional[int]:
+    """Id отправителя обновления (from.id) или None."""
+    for kind in ('message', 'edited_message', 'callback_query'):
+        payload = update.get(kind)
+        if payload and 'from' in payload:
+            return payload['from']['id']
+    return None
+
+
+class UpdateDispatcher:
+    """Раскладывает обновления по фиксированному числу воркеров по id пользователя.
+
+    Обновления одного пользователя попадают в одну очередь и обрабатываются
+    строго по порядку, разные пользователи обрабатываются параллельно.
+    offset() - номер, до которого все обновления уже обработаны: его можно
+    передавать в getUpdates, не рискуя потерять еще не обработанные.
+    Повторно полученные обновления (offset отстает от выданных) пропускаются.
+    Пока есть обновления в работе, новые выдаются не дальше max_in_flight
+    номеров от offset(): так окно getUpdates (limit) всегда содержит новые
+    обновления, а не только уже выданные, даже если обработка одного из них
+    затянулась.
+    Обновления из webhook передаются через push(): Telegram считает их
+    доставленными после ответа на запрос, поэтому offset для них не ведется.
+    """
+
+    def __init__(self, handler: Callable[[Dict[str, Any]], None], workers: int = 8,
+                 max_in_flight: int = 99, name: str = 'update-worker'):
+        self.handler = handler
+        self.workers = workers
+        self.max_in_flight = max_in_flight
+        self._cond = threading.Condition()
+        # Выданные, но еще не обработанные обновления
+        self._in_flight: set = set()
+        # Выданные обновления с номером не меньше offset() (в работе или уже обработанные)
+        self._dispatched: set = set()
+        self._next_offset = 0
+        # Обновления из push(), еще не обработанные
+        self._pushed = 0
+        self._queues = [queue.Queue() for _ in range(workers)]
+        self._threads = [
+            threading.Thread(target=self._work, args=(worker_queue,), name=f'{name}-{index}', daemon=True)
+            for index, worker_queue in enumerate(self._queues)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def _offset(self) -> int:
+        return min(self._in_flight) if self._in_flight else self._next_offset
+
+    def offset(self) -> int:
+        """Первый еще не обработанный номер обновления."""
+        with self._cond:
+            return self._offset()
+
+    def pending(self) -> int:
+        with self._cond:
+            return len(self._in_flight) + self._pushed
+
+    def _enqueue(self, update: Dict[str, Any], tracked: bool):
+        user_id = update_user_id(update)
+        partition = (user_id if user_id is not None else update['update_id']) % self.workers
+        self._queues[partition].put((update, tracked))
+
+    def submit(self, update: Dict[str, Any]) -> bool:
+        """Ставит обновление в очередь его пользователя; False - оно уже было выдано."""
+        update_id = update['update_id']
+        with self._cond:
+            if update_id < self._offset() or update_id in self._dispatched:
+                return False
+            # Ждем, только пока есть что обрабатывать: без обновлений в работе
+            # offset() сразу переходит к этому номеру (первый запуск, пропуск номеров)
+            while self._in_flight and update_id >= self._offset() + self.max_in_flight:
+                self._cond.wait()
+            self._in_flight.add(update_id)
+            self._dispatched.add(update_id)
+            self._next_offset = max(self._next_offset, update_id + 1)
+        self._enqueue(update, True)
+        return True
+
+    def push(self, update: Dict[str, Any]):
+        """Ставит обновление в очередь его пользователя без учета offset (не блокируется)."""
+        with self._cond:
+            self._pushed += 1
+        self._enqueue(update, False)
+
+    def _work(self, worker_queue: queue.Queue):
+        while True:
+            item = worker_queue.get()
+            if item is _STOP:
+                return
+            update, tracked = item
+            try:
+                self.handler(update)
+            except Exception as e:
+                print(f"[UpdateDispatcher] Error processing update {update.get('update_id')}: {e}")
+            finally:
+                self._done(update['update_id'], tracked)
+
+    def _done(self, update_id: int, tracked: bool):
+        with self._cond:
+            if tracked:
+                self._in_flight.discard(update_id)
+                offset = self._offset()
+                self._dispatched = {dispatched for dispatched in self._dispatched if dispatched >= offset}
+            else:
+                self._pushed -= 1
+            self._cond.notify_all()
+
+    def wait_idle(self, timeout: Optional[float] = None) -> bool:
+        """Дожидается обработки всех выданных обновлений."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._in_flight or self._pushed:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def stop(self, timeout: float = 10.0):
+        """Дорабатывает уже выданные обновления и останавливает воркеры."""
+        for worker_queue in self._queues:
+            worker_queue.put(_STOP)
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+"""Компактная запись пользователя: __slots__, битовая маска стендов и время в epoch."""
+
+import threading
+import time
+from collections.abc import Mapping
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional
+
+
+class StandBits:
+    """Реестр номеров битов для id стендов.
+
+    Номер бита выдается стенду один раз и больше не меняется, поэтому маски
+    пользователей не нужно пересчитывать при изменении каталога: стенды,
+    удаленные из каталога, просто отсекаются маской каталога.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._bits: Dict[str, int] = {}
+        self._ids: List[str] = []
+
+    def bit(self, stand_id: str) -> int:
+        """Номер бита стенда (выдается при первом обращении)."""
+        bit = self._bits.get(stand_id)
+        if bit is None:
+            with self._lock:
+                bit = self._bits.get(stand_id)
+                if bit is None:
+                    bit = len(self._ids)
+                    self._ids.append(stand_id)
+                    self._bits[stand_id] = bit
+        return bit
+
+    def mask(self, stand_ids: Iterable[str]) -> int:
+        """Маска из набора id стендов."""
+        mask = 0
+        for stand_id in stand_ids:
+            mask |= 1 << self.bit(stand_id)
+        return mask
+
+    def ids(self, mask: int) -> List[str]:
+        """id стендов из маски в порядке номеров битов."""
+        result = []
+        bit = 0
+        while mask:
+            if mask & 1:
+                result.append(self._ids[bit])
+            mask >>= 1
+            bit += 1
+        return result
+
+
+# Общий реестр битов стендов процесса
+stand_bits = StandBits()
+
+
+def popcount(mask: int) -> int:
+    """Число установленных битов (int.bit_count есть только с Python 3.10)."""
+    return bin(mask).count('1')
+
+
+# Обычные поля записи в порядке JSON-представления
+FIELDS = (
+    'full_name',
+    'awaiting_name',
+    'awaiting_vk_link',
+    'vk_profile',
+    'vk_verified',
+    'stand_status',
+    'pending_question',
+    'menu_message_id',
+    'giveaway_message_id',
+    'last_keyboard_state',
+    'created_at',
+    'updated_at',
+)
+_PLAIN_FIELDS = tuple(f for f in FIELDS if f not in ('stand_status', 'created_at', 'updated_at'))
+_TIME_FIELDS = ('created_at', 'updated_at')
+
+# Поле отсутствовало в исходном словаре
+MISSING = object()
+
+
+def _parse_time(value: Any) -> Any:
+    """ISO-строка -> epoch float; если обратное преобразование не совпадает, значение остается как есть."""
+    if not isinstance(value, str):
+        return value
+    try:
+        ts = datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        return value
+    if _format_time(ts) != value:
+        return value
+    return ts
+
+
+def _format_time(value: Any) -> Any:
+    if isinstance(value, float):
+        return datetime.fromtimestamp(value).isoformat()
+    return value
+
+
+def now() -> float:
+    """Текущее время в epoch, округленное так, чтобы оно без потерь проходило через JSON."""
+    return _parse_time(_format_time(time.time()))
+
+
+class UserRecord:
+    """Запись пользователя в памяти.
+
+    Прогресс по стендам хранится двумя масками: known_mask - стенды,
+    присутствующие в stand_status, done_mask - пройденные. Время хранится
+    как epoch float. to_dict()/from_dict() без потерь переводят запись
+    в прежний JSON-формат и обратно; для чтения поддерживается доступ
+    как к словарю (user['full_name'], user.get('pending_question')).
+    """
+
+    __slots__ = _PLAIN_FIELDS + ('known_mask', 'done_mask', 'created_at', 'updated_at', 'extra')
+
+    def __init__(self):
+        for field in _PLAIN_FIELDS:
+            setattr(self, field, MISSING)
+        self.known_mask: Optional[int] = None
+        self.done_mask = 0
+        self.created_at: Any = MISSING
+        self.updated_at: Any = MISSING
+        # Нестандартные ключи и значения, которые нельзя упаковать без потерь
+        self.extra: Optional[Dict[str, Any]] = None
+
+    @classmethod
+    def new(cls, stand_mask: int) -> 'UserRecord':
+        """Новый пользователь со всеми стендами каталога в статусе 'не пройден'."""
+        record = cls()
+        record.full_name = None
+        record.awaiting_name = True
+        record.awaiting_vk_link = False
+        record.vk_profile = None
+        record.vk_verified = False
+        record.pending_question = None
+        record.menu_message_id = None
+        record.giveaway_message_id = None
+        record.last_keyboard_state = ''
+        record.known_mask = stand_mask
+        record.created_at = record.updated_at = now()
+        return record
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'UserRecord':
+        record = cls()
+        record.update(data)
+        return record
+
+    def copy(self) -> 'UserRecord':
+        record = UserRecord.__new__(UserRecord)
+        for slot in UserRecord.__slots__:
+            setattr(record, slot, getattr(self, slot))
+        if self.extra is not None:
+            record.extra = dict(self.extra)
+        return record
+
+    def update(self, updates: Dict[str, Any]):
+        """Применяет изменения в формате JSON-словаря."""
+        for key, value in updates.items():
+            if key == 'stand_status':
+                self._set_stand_status(value)
+            elif key in _TIME_FIELDS:
+                self._set_extra(key, MISSING)
+                setattr(self, key, _parse_time(value))
+                if isinstance(getattr(self, key), str):
+                    # Нестандартная строка времени - храним как есть
+                    self._set_extra(key, value)
+                    setattr(self, key, MISSING)
+            elif key in _PLAIN_FIELDS:
+                setattr(self, key, value)
+            else:
+                self._set_extra(key, value)
+
+    def _set_extra(self, key: str, value: Any):
+        if value is MISSING:
+            if self.extra and key in self.extra:
+                del self.extra[key]
+                if not self.extra:
+                    self.extra = None
+            return
+        if self.extra is None:
+            self.extra = {}
+        self.extra[key] = value
+
+    def _set_stand_status(self, stand_status: Any):
+        self._set_extra('stand_status', MISSING)
+        if not isinstance(stand_status, dict) or not all(
+            isinstance(status, dict) and status.keys() == {'done'} and isinstance(status['done'], bool)
+            for status in stand_status.values()
+        ):
+            # Нестандартный формат - сохраняем без упаковки
+            self.known_mask = None
+            self.done_mask = 0
+            self._set_extra('stand_status', stand_status)
+            return
+        known = done = 0
+        for stand_id, status in stand_status.items():
+            bit = 1 << stand_bits.bit(stand_id)
+            known |= bit
+            if status['done']:
+                done |= bit
+        self.known_mask = known
+        self.done_mask = done
+
+    def take_fields(self, other: 'UserRecord', fields: Iterable[str]):
+        """Копирует указанные поля (в именах JSON-формата) из другой записи."""
+        other_extra = other.extra or {}
+        for field in fields:
+            if field == 'stand_status':
+                self.known_mask = other.known_mask
+                self.done_mask = other.done_mask
+            elif field in _PLAIN_FIELDS or field in _TIME_FIELDS:
+                setattr(self, field, getattr(other, field))
+            self._set_extra(field, other_extra.get(field, MISSING))
+
+    # --- Прогресс по стендам ---
+
+    def is_done(self, stand_id: str) -> bool:
+        return bool(self.done_mask >> stand_bits.bit(stand_id) & 1)
+
+    def set_done(self, stand_id: str, done: bool = True):
+        bit = 1 << stand_bits.bit(stand_id)
+        self._set_extra('stand_status', MISSING)
+        self.known_mask = (self.known_mask or 0) | bit
+        if done:
+            self.done_mask |= bit
+        else:
+            self.done_mask &= ~bit
+
+    def completed_count(self, stand_mask: int) -> int:
+        """Сколько стендов из маски каталога пройдено."""
+        return popcount(self.done_mask & stand_mask)
+
+    def reconcile(self, stand_mask: int) -> bool:
+        """Приводит набор стендов к маске каталога. Возвращает True, если что-то изменилось."""
+        if self.known_mask == stand_mask and not (self.extra and 'stand_status' in self.extra):
+            return False
+        self._set_extra('stand_status', MISSING)
+        self.known_mask = stand_mask
+        self.done_mask &= stand_mask
+        return True
+
+    def stand_status(self) -> Dict[str, Dict[str, bool]]:
+        """stand_status в прежнем формате {stand_id: {'done': bool}}."""
+        if self.extra and 'stand_status' in self.extra:
+            return self.extra['stand_status']
+        if self.known_mask is None:
+            return {}
+        done = self.done_mask
+        return {
+            stand_id: {'done': bool(done >> stand_bits.bit(stand_id) & 1)}
+            for stand_id in stand_bits.ids(self.known_mask)
+        }
+
+    # --- Преобразование в JSON-формат ---
+
+    def _has(self, field: str) -> bool:
+        if self.extra and field in self.extra:
+            return True
+        if field == 'stand_status':
+            return self.known_mask is not None
+        return getattr(self, field) is not MISSING
+
+    def _value(self, field: str) -> Any:
+        if field == 'stand_status':
+            if not self._has(field):
+                return MISSING
+            return self.stand_status()
+        if self.extra and field in self.extra:
+            return self.extra[field]
+        value = getattr(self, field)
+        if field in _TIME_FIELDS:
+            return _format_time(value)
+        return value
+
+    def keys(self) -> List[str]:
+        keys = [field for field in FIELDS if self._has(field)]
+        if self.extra:
+            keys.extend(key for key in self.extra if key not in FIELDS)
+        return keys
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {key: self._value(key) for key in self.keys()}
+
+    def diff(self, other: 'UserRecord') -> frozenset:
+        """Имена полей, отличающихся от другой записи."""
+        changed = set()
+        for field in _PLAIN_FIELDS + _TIME_FIELDS:
+            if getattr(self, field) != getattr(other, field):
+                changed.add(field)
+        if self.known_mask != other.known_mask or self.done_mask != other.done_mask:
+            changed.add('stand_status')
+        if self.extra or other.extra:
+            mine, theirs = self.extra or {}, other.extra or {}
+            changed.update(k for k in mine.keys() | theirs.keys() if mine.get(k, MISSING) != theirs.get(k, MISSING))
+        return frozenset(changed)
+
+    def __eq__(self, other: Any) -> bool:
+        if not isinstance(other, UserRecord):
+            return NotImplemented
+        return not self.diff(other)
+
+    __hash__ = None
+
+    # --- Доступ как к словарю ---
+
+    def __getitem__(self, key: str) -> Any:
+        value = self._value(key) if key in FIELDS else (self.extra or {}).get(key, MISSING)
+        if value is MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key: str, value: Any):
+        """Изменение поля; допустимо только для копий (например, в transaction())."""
+        self.update({key: value})
+
+    def get(self, key: str, default: Any = None) -> Any:
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key, MISSING) is not MISSING
+
+    def __repr__(self):
+        return f"UserRecord({self.to_dict()!r})"
+
+
+def to_json(value: Any) -> Any:
+    """default= для json.dumps: сериализует UserRecord в прежний формат
+    (и словари-обертки вроде ленивого словаря пользователей из снимка)."""
+    if isinstance(value, UserRecord):
+        return value.to_dict()
+    if isinstance(value, Mapping):
+        return dict(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""Прием обновлений Telegram через webhook (за nginx)."""
+
+import hmac
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Tuple
+
+# Заголовок, в котором Telegram передает secret_token из setWebhook
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+WEBHOOK_PATH = '/telegram/webhook'
+# Обновление Telegram намного меньше; больший запрос не читаем
+MAX_BODY_SIZE = 1 << 20
+
+
+class _WebhookHandler(BaseHTTPRequestHandler):
+    # Keep-alive: nginx и Telegram переиспользуют соединения
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        server: WebhookServer = self.server
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            # Без корректной длины тело не отделить от следующего запроса
+            self.close_connection = True
+            return self._reply(400)
+        # Путь и секрет проверяются до чтения тела: тело чужого запроса не разбираем
+        if self.path.split('?', 1)[0] != server.webhook_path:
+            return self._reject(404, length)
+        secret = self.headers.get(SECRET_HEADER, '')
+        if not hmac.compare_digest(secret.encode('utf-8'), server.secret_token.encode('utf-8')):
+            server.count('rejected')
+            return self._reject(403, length)
+        if length > MAX_BODY_SIZE:
+            return self._reject(413, length)
+        body = self.rfile.read(length)
+
+        try:
+            update = json.loads(body)
+        except ValueError:
+            return self._reply(400)
+        if not isinstance(update, dict) or not isinstance(update.get('update_id'), int):
+            return self._reply(400)
+
+        # Обработка идет в очереди, Telegram получает ответ сразу
+        server.on_update(update)
+        server.count('received')
+        self._reply(200)
+
+    def do_GET(self):
+        if self.path == '/health':
+            return self._reply(200, b'healthy\n')
+        self._reply(404)
+
+    def _reject(self, status: int, length: int):
+        """Отвечает ошибкой, не разбирая тело запроса.
+
+        Небольшое тело пропускается по частям, чтобы соединение осталось
+        пригодным для keep-alive; после слишком большого оно закрывается.
+        """
+        if length > MAX_BODY_SIZE:
+            self.close_connection = True
+        else:
+            while length > 0:
+                chunk = self.rfile.read(min(length, 65536))
+                if not chunk:
+                    break
+                length -= len(chunk)
+        self._reply(status)
+
+    def _reply(self, status: int, body: bytes = b''):
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Запросы и так пишутся в access.log nginx
+        pass
+
+
+class WebhookServer(ThreadingHTTPServer):
+    """HTTP-сервер для webhook Telegram.
+
+    Принимает POST на webhook_path, проверяет секрет из заголовка
+    X-Telegram-Bot-Api-Secret-Token, передает обновление в on_update и сразу
+    отвечает 200. on_update не должен блокироваться: обновление только
+    ставится в очередь (UpdateDispatcher.push).
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], on_update: Callable[[Dict[str, Any]], None],
+                 secret_token: str, webhook_path: str = WEBHOOK_PATH):
+        self.on_update = on_update
+        self.secret_token = secret_token
+        self.webhook_path = webhook_path
+        self._stats_lock = threading.Lock()
+        self.stats = {'received': 0, 'rejected': 0}
+        super().__init__(address, _WebhookHandler)
+
+    def count(self, name: str):
+        with self._stats_lock:
+            self.stats[name] += 1
+
+    def start(self) -> threading.Thread:
+        """Запускает обработку запросов в фоновом потоке."""
+        thread = threading.Thread(target=self.serve_forever, name='webhook-server', daemon=True)
+        thread.start()
+        host, port = self.server_address[:2]
+        print(f"[Webhook] Listening on http://{host}:{port}{self.webhook_path}")
+        return thread
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        print(f"[Webhook] Stopped: {self.stats}")